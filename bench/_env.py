@@ -0,0 +1,15 @@
+"""Переменные окружения по умолчанию, чтобы src.* импортировался без .env."""
+import base64
+import os
+
+
+def setup_env(**overrides: str) -> None:
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("OPENAI_API_KEYS", "bench-key-1,bench-key-2")
+    os.environ.setdefault(
+        "SYSTEM_PROMPT_ENC",
+        base64.b64encode("Ты — полезный ассистент.".encode("utf-8")).decode("ascii"),
+    )
+    os.environ.setdefault("ALLOWED_USERS", "1")
+    for key, value in overrides.items():
+        os.environ[key] = value
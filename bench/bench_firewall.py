@@ -0,0 +1,77 @@
+"""Микробенчмарк фильтра текста на входах ~100 КБ.
+
+    python -m bench.bench_firewall --size 100000 --repeat 20
+
+«legacy» — прежние sanitize_request + is_request_safe (два прохода по
+каждому паттерну, без предкомпиляции) и sanitize_text с regex на каждый вызов;
+«firewall» — TextFirewall из src/utils/firewall.py.
+"""
+import argparse
+import logging
+import random
+import re
+import time
+
+from bench._env import setup_env
+
+setup_env()
+
+from src.utils.firewall import DEFAULT_RULES, TextFirewall  # noqa: E402
+
+LEGACY_PATTERNS = [f"({rule.pattern})" for rule in DEFAULT_RULES]
+
+WORDS = (
+    "def main(): return 0 лог ошибки traceback при запуске token password "
+    "файл system prompt конфигурация sk-abcdefghijklmnopqrstuvwxyz012345 "
+    "ответ пользователь код ок значит api_key сервер"
+).split()
+
+
+def legacy_inbound(text: str) -> bool:
+    for pattern in LEGACY_PATTERNS:
+        if re.search(pattern, text, re.IGNORECASE):
+            text = re.sub(pattern, "[REDACTED]", text, flags=re.IGNORECASE)
+    for pattern in LEGACY_PATTERNS:
+        if re.search(pattern, text, re.IGNORECASE):
+            return False
+    return True
+
+
+def legacy_outbound(text: str) -> str:
+    return re.sub(r"[^А-Яа-яЁё0-9\s.,:;!?()\[\]«»\"'—\-…]", "", text)
+
+
+def make_text(size: int, seed: int = 1) -> str:
+    rnd = random.Random(seed)
+    out, total = [], 0
+    while total < size:
+        word = rnd.choice(WORDS)
+        out.append(word)
+        total += len(word) + 1
+    return " ".join(out)[:size]
+
+
+def bench(label: str, fn, text: str, repeat: int) -> None:
+    fn(text)  # прогрев
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    per_call = (time.perf_counter() - t0) / repeat * 1000
+    print(f"{label:<20} {per_call:8.2f} ms/вызов  ({len(text) / 1024:.0f} КБ)")
+
+
+def main(args):
+    logging.disable(logging.WARNING)  # каждое срабатывание правила пишет предупреждение
+    text = make_text(args.size)
+    fw = TextFirewall()
+    bench("legacy inbound", legacy_inbound, text, args.repeat)
+    bench("firewall inbound", fw.inspect_request, text, args.repeat)
+    bench("legacy outbound", legacy_outbound, text, args.repeat)
+    bench("firewall outbound", lambda t: fw.clean_response(t, "ru"), text, args.repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,77 @@
+"""Бенчмарк: новый httpx.AsyncClient на каждый запрос против общего пула.
+
+    python -m bench.bench_http_pool --requests 200 --concurrency 10 --handshake-delay 0.05
+
+«before» повторяет старое поведение chat() (клиент открывается внутри цикла
+попыток), «after» — OpenAICompatibleClient с долгоживущим пулом.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from bench._env import setup_env
+
+setup_env()
+
+import httpx  # noqa: E402
+
+from bench.stub_provider import StubProvider  # noqa: E402
+from src.ai_providers.openai_compatible import API_KEYS, OpenAICompatibleClient, make_headers  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+async def _run(label, one_request, total: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def worker():
+        async with sem:
+            t0 = time.perf_counter()
+            await one_request()
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(total)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print(f"{label:<8} {total / elapsed:8.1f} req/s   p50 {p50:7.1f} ms   p99 {p99:7.1f} ms")
+
+
+async def main(args):
+    stub = await StubProvider(latency=args.latency, handshake_delay=args.handshake_delay).start()
+    payload = {"model": "stub", "messages": MESSAGES, "stream": False}
+
+    async def per_attempt():
+        async with httpx.AsyncClient(timeout=60) as client:
+            resp = await client.post(f"{stub.base_url}/chat/completions", headers=make_headers(API_KEYS[0]), json=payload)
+            resp.raise_for_status()
+
+    pooled = OpenAICompatibleClient(stub.base_url)
+    await pooled.start()
+
+    async def pooled_request():
+        await pooled.chat("stub", MESSAGES)
+
+    conn_before = stub.connections
+    await _run("before", per_attempt, args.requests, args.concurrency)
+    print(f"         соединений: {stub.connections - conn_before}")
+
+    conn_before = stub.connections
+    await _run("after", pooled_request, args.requests, args.concurrency)
+    print(f"         соединений: {stub.connections - conn_before}")
+
+    await pooled.aclose()
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--handshake-delay", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,145 @@
+"""Бенчмарк: входные токены без конспекта, с фоновым конспектом и с долгой памятью.
+
+Записанные диалоги (JSONL, {"turns": [...]} на строку) прогоняются через
+заглушку провайдера дважды:
+
+- «full»    — вся история в пределах бюджета MAX_CONTEXT_TOKENS;
+- «summary» — конспект + последние SUMMARY_KEEP_RECENT сообщений, свёртка
+  через тот же клиент (её токены тоже учитываются);
+- «recall»  — последние RECALL_RECENT_MESSAGES сообщений + RECALL_TOP_K
+  похожих прошлых ходов (src/utils/recall.py, нужен numpy).
+
+    python -m bench.bench_summary bench/conversations_sample.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+
+from bench._env import setup_env
+
+setup_env()
+
+from bench.stub_provider import StubProvider  # noqa: E402
+from src.ai_providers.openai_compatible import OpenAICompatibleClient  # noqa: E402
+from src.config import MAX_CONTEXT_TOKENS, RECALL_TOP_K, RECALL_RECENT_MESSAGES, RECALL_MIN_SCORE  # noqa: E402
+from src.utils.memory import MESSAGE_OVERHEAD_TOKENS, SimpleMemory, build_context, estimate_tokens  # noqa: E402
+from src.utils.recall import Recall  # noqa: E402
+from src.utils.state_store import StateStore  # noqa: E402
+from src.utils.summarizer import Summarizer  # noqa: E402
+
+SYSTEM = "Ты — полезный ассистент."
+# Типичный ответ модели ~70 слов; заглушка отвечает им и на свёртку
+REPLY = (
+    "Хороший вопрос. Коротко: начните с минимальной рабочей версии, проверьте её на "
+    "реальных данных и только потом усложняйте. Ниже — три шага: сначала опишите "
+    "задачу и ограничения, затем выберите самый простой инструмент, который их "
+    "покрывает, и наконец добавьте измерения, чтобы видеть эффект от каждого "
+    "изменения. Если нужно, разберу любой шаг подробнее с примерами кода и "
+    "типичными ошибками, которые встречаются на практике."
+)
+
+
+def prompt_tokens(messages) -> int:
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def load_conversations(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["turns"] for line in f if line.strip()]
+
+
+async def run_full(client, turns) -> int:
+    memory = SimpleMemory(max_messages=1000)
+    total = 0
+    for text in turns:
+        messages = build_context(SYSTEM, memory.get_context(1), text, MAX_CONTEXT_TOKENS)
+        total += prompt_tokens(messages)
+        answer = await client.chat("stub", messages)
+        memory.add_message(1, "user", text)
+        memory.add_message(1, "assistant", answer)
+    return total
+
+
+async def run_summary(client, turns, store) -> tuple:
+    memory = SimpleMemory(max_messages=1000)
+    folded_tokens = 0
+
+    async def ask(messages, **kwargs):
+        nonlocal folded_tokens
+        folded_tokens += prompt_tokens(messages)
+        return await client.chat("stub", messages)
+
+    summarizer = Summarizer(memory, store, ask=ask, enabled=True)
+    total = 0
+    for text in turns:
+        messages = build_context(
+            SYSTEM, memory.get_context(1), text, MAX_CONTEXT_TOKENS, summary=await summarizer.get(1)
+        )
+        total += prompt_tokens(messages)
+        answer = await client.chat("stub", messages)
+        memory.add_message(1, "user", text)
+        memory.add_message(1, "assistant", answer)
+        summarizer.schedule(1)
+        # в боте свёртка успевает между сообщениями пользователя
+        await asyncio.gather(*summarizer._running.values())
+    summarizer.clear(1)
+    return total, folded_tokens, summarizer.runs
+
+
+async def run_recall(client, turns) -> int:
+    memory = SimpleMemory(max_messages=1000)
+    recall = Recall(enabled=True)
+    total = 0
+    for text in turns:
+        recalled = await recall.search(
+            1, text, RECALL_TOP_K, skip_recent=RECALL_RECENT_MESSAGES // 2, min_score=RECALL_MIN_SCORE
+        )
+        history = memory.get_context(1)[-RECALL_RECENT_MESSAGES:] if RECALL_RECENT_MESSAGES else []
+        messages = build_context(SYSTEM, history, text, MAX_CONTEXT_TOKENS, recalled=recalled)
+        total += prompt_tokens(messages)
+        answer = await client.chat("stub", messages)
+        memory.add_message(1, "user", text)
+        memory.add_message(1, "assistant", answer)
+        await recall.add(1, text, answer)
+    return total
+
+
+async def main(args):
+    stub = await StubProvider(reply=REPLY).start()
+    client = OpenAICompatibleClient(stub.base_url)
+    await client.start()
+    store = StateStore(os.path.join(tempfile.mkdtemp(), "bench_summary.db"))
+
+    with_recall = Recall(enabled=True).enabled
+    grand_full = grand_summary = grand_recall = 0
+    for i, turns in enumerate(load_conversations(args.file), start=1):
+        full = await run_full(client, turns)
+        chat, folded, runs = await run_summary(client, turns, store)
+        grand_full += full
+        grand_summary += chat + folded
+        line = (
+            f"диалог {i}: {len(turns):2d} ходов   full {full:6d}   "
+            f"summary {chat:6d} + свёртка {folded:5d} ({runs} раз)   "
+            f"экономия {100 * (1 - (chat + folded) / full):5.1f}%"
+        )
+        if with_recall:
+            recalled = await run_recall(client, turns)
+            grand_recall += recalled
+            line += f"   recall {recalled:6d} ({100 * (1 - recalled / full):5.1f}%)"
+        print(line)
+    print(f"итого: full {grand_full}, summary {grand_summary}, "
+          f"экономия {100 * (1 - grand_summary / grand_full):.1f}%")
+    if with_recall:
+        print(f"recall {grand_recall}, экономия {100 * (1 - grand_recall / grand_full):.1f}%")
+
+    await store.close()
+    await client.aclose()
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("file", nargs="?", default="bench/conversations_sample.jsonl")
+    asyncio.run(main(parser.parse_args()))
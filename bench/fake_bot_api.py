@@ -0,0 +1,127 @@
+"""Локальная заглушка Telegram Bot API.
+
+Отвечает на методы, которые вызывает бот (getMe, sendMessage,
+editMessageText, answerCallbackQuery, ...), правдоподобными объектами и
+запоминает вызовы (с моментом прихода) — так вебхук и обработчики
+проверяются целиком без доступа к Telegram. Бот направляется сюда через
+TELEGRAM_API_BASE_URL. on_call(method, params) вызывается на каждый
+запрос — нагрузочный тест по нему ловит доставку ответов; push_update()
+отдаёт апдейты боту в режиме polling.
+
+    python -m bench.fake_bot_api --port 8082
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8082/bot BOT_MODE=webhook python -m src.bot
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+from src.utils.http_server import HttpServer, Request, Response
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+def _params(request: Request) -> Dict[str, Any]:
+    ctype = request.headers.get("content-type", "")
+    if not request.body:
+        return dict(request.query)
+    if "application/json" in ctype:
+        return request.json()
+    params: Dict[str, Any] = {}
+    for key, value in parse_qsl(request.body.decode("utf-8")):
+        try:
+            params[key] = json.loads(value)  # вложенные объекты PTB кодирует в JSON
+        except ValueError:
+            params[key] = value
+    return params
+
+
+class FakeBotApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.latency = latency
+        self.server = HttpServer(host, port)
+        self.server.route("POST", "/bot*", self._handle)
+        self.server.route("GET", "/bot*", self._handle)
+        self.calls: Counter = Counter()
+        self.log: List[Dict[str, Any]] = []
+        self.keep_log = True
+        self.on_call: Optional[Callable[[str, Dict[str, Any]], None]] = None
+        self.updates: List[Dict[str, Any]] = []  # отдаются через getUpdates (push_update)
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.server.port}/bot"
+
+    async def start(self) -> "FakeBotApi":
+        await self.server.start()
+        return self
+
+    async def stop(self) -> None:
+        await self.server.close()
+
+    def _message(self, params: Dict[str, Any], message_id: int) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def _handle(self, request: Request) -> Response:
+        method = request.path.rsplit("/", 1)[-1]
+        params = _params(request)
+        self.calls[method] += 1
+        if self.keep_log:
+            self.log.append({"method": method, "at": time.monotonic(), **params})
+        if self.on_call is not None:
+            self.on_call(method, params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result: Any = BOT_USER
+        elif method == "sendMessage":
+            result = self._message(params, next(self._message_ids))
+        elif method == "editMessageText" and "inline_message_id" not in params:
+            result = self._message(params, int(params.get("message_id", 0)))
+        elif method == "getUpdates":
+            offset = int(params.get("offset", 0) or 0)
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates:
+                await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            result = self.updates[:100]
+        else:
+            result = True
+        return Response.json({"ok": True, "result": result})
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        """Апдейт для бота в режиме polling."""
+        self.updates.append(update)
+
+    def sent_texts(self) -> List[str]:
+        return [c.get("text", "") for c in self.log if c["method"] in ("sendMessage", "editMessageText")]
+
+
+async def main(args):
+    api = await FakeBotApi(args.host, args.port, args.latency).start()
+    print(f"Bot API заглушка: {api.base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0)
+    asyncio.run(main(parser.parse_args()))
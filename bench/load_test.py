@@ -0,0 +1,269 @@
+"""Сквозной нагрузочный тест: N пользователей пишут боту, ИИ и Telegram — заглушки.
+
+Апдейты идут через настоящий стек: build_app() → register_handlers →
+OrderedUpdateProcessor → коалесцер → клиент ИИ → bench/stub_provider.py,
+ответы уходят в bench/fake_bot_api.py. Каждый пользователь шлёт реплики из
+записанных диалогов по одной и ждёт ответа (замкнутый цикл с паузой --think).
+Ответ ИИ узнаётся по кнопке меню (callback_data=menu_open) на сообщении.
+
+Отчёт: пропускная способность, p50/p95/p99 от апдейта до ответа, запросов
+к провайдеру на сообщение (вместе со свёрткой конспекта), рост памяти,
+с --stream — число промежуточных правок. Сеть не нужна. Для CI:
+--max-p99-ms / --max-calls-per-message — код возврата 1 при превышении;
+с --stream код 1 и тогда, когда ни одна промежуточная правка не дошла до
+Telegram.
+
+    python -m bench.load_test --users 200 --messages 5 --latency 0.3 --latency-sigma 0.5
+    python -m bench.load_test --users 50 --rate-limit-ratio 0.05 --stream --json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from bench._env import setup_env
+from bench.fake_bot_api import FakeBotApi
+from bench.stub_provider import StubProvider
+
+# Тексты отказов (src/ai_providers/resilience.describe_error, лимиты доступа)
+_ERROR_PREFIXES = ("⚠", "⏳", "⌛", "⛔")
+_USER_ID_BASE = 10_000
+
+
+def load_turns(path: str) -> List[List[str]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["turns"] for line in f if line.strip()]
+
+
+def message_update(update_id: int, user_id: int, message_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (Linux), иначе пиковый."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class AnswerWaiter:
+    """Связывает ответы из заглушки Bot API с ожидающими пользователями."""
+
+    def __init__(self):
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self.progress_edits = 0
+
+    def expect(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[chat_id] = future
+        return future
+
+    def on_call(self, method: str, params: dict) -> None:
+        if method not in ("sendMessage", "editMessageText"):
+            return
+        try:
+            chat_id = int(params.get("chat_id", 0))
+        except (TypeError, ValueError):
+            return
+        future = self._waiting.get(chat_id)
+        if future is None or future.done():
+            return
+        text = str(params.get("text", ""))
+        if "menu_open" in json.dumps(params.get("reply_markup", ""), ensure_ascii=False):
+            future.set_result(True)
+        elif text.startswith(_ERROR_PREFIXES):
+            future.set_result(False)
+        elif method == "editMessageText" and "parse_mode" not in params:
+            # промежуточная правка потокового ответа: простой текст без меню
+            self.progress_edits += 1
+
+
+async def run(args) -> Dict[str, object]:
+    stub = await StubProvider(
+        reply=args.reply,
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        tail_ratio=args.tail_ratio,
+        tail_latency=args.tail_latency,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        token_delay=args.token_delay,
+        seed=args.seed,
+    ).start()
+    api = await FakeBotApi(latency=args.bot_api_latency).start()
+    api.keep_log = False
+    user_ids = [_USER_ID_BASE + i for i in range(args.users)]
+    setup_env(
+        OPENAI_BASE_URL=stub.base_url,
+        TELEGRAM_API_BASE_URL=api.base_url,
+        ALLOWED_USERS=",".join(map(str, user_ids)),
+        STATE_DB_PATH=os.path.join(tempfile.mkdtemp(), "load_test.db"),
+        STATE_IMPORT_FILE="",
+        COALESCE_WINDOW=str(args.coalesce_window),
+        STREAM_REPLIES="1" if args.stream else "0",
+        SUMMARY_ENABLED="1" if args.summary else "0",
+        RESPONSE_CACHE="0",
+        RATE_MESSAGES_PER_MIN="0",
+        RATE_TOKENS_PER_MIN="0",
+        METRICS_PORT="0",
+    )
+    from telegram import Update
+    from src.bot import build_app
+    from src.utils.metrics import metrics
+    from src.utils.state_store import state_store
+
+    # строка лога на каждый HTTP-запрос исказила бы замер
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    app = build_app()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    for uid in user_ids:
+        state_store.put("user", uid, {"ai_enabled": True})
+
+    waiter = AnswerWaiter()
+    api.on_call = waiter.on_call
+    conversations = load_turns(args.conversations)
+    latencies: List[float] = []
+    failed = timed_out = 0
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def user(index: int, uid: int) -> None:
+        nonlocal failed, timed_out
+        turns = conversations[index % len(conversations)]
+        for n in range(args.messages):
+            text = turns[n % len(turns)]
+            answer = waiter.expect(uid)
+            started = time.perf_counter()
+            await app.update_queue.put(Update.de_json(message_update(next(update_ids), uid, n + 1, text), app.bot))
+            try:
+                ok = await asyncio.wait_for(answer, args.timeout)
+            except asyncio.TimeoutError:
+                timed_out += 1
+                continue
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failed += 1
+            if args.think:
+                await asyncio.sleep(args.think)
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*(user(i, uid) for i, uid in enumerate(user_ids)))
+    elapsed = time.perf_counter() - started
+    rss_after = rss_mb()
+    memory_stats = metrics.snapshot()["state"].get("memory", {})
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await api.stop()
+    await stub.stop()
+
+    sent = args.users * args.messages
+    return {
+        "users": args.users,
+        "messages": sent,
+        "answered": len(latencies),
+        "failed": failed,
+        "timed_out": timed_out,
+        "seconds": round(elapsed, 2),
+        "throughput_msg_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "e2e_p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "e2e_p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "e2e_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "e2e_mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        "upstream_calls": stub.requests,
+        "upstream_429": stub.rate_limited,
+        "upstream_calls_per_message": round(stub.requests / sent, 3) if sent else 0.0,
+        "bot_api_calls": dict(api.calls),
+        "progress_edits": waiter.progress_edits,
+        "rss_mb_before": round(rss_before, 1),
+        "rss_mb_after": round(rss_after, 1),
+        "rss_growth_kb_per_user": round((rss_after - rss_before) * 1024 / max(1, args.users), 1),
+        "memory_store_bytes": memory_stats.get("bytes") if isinstance(memory_stats, dict) else None,
+    }
+
+
+def check(report: Dict[str, object], args) -> List[str]:
+    problems = []
+    if report["timed_out"]:
+        problems.append(f"без ответа: {report['timed_out']}")
+    if args.stream and report["answered"] and not report["progress_edits"]:
+        problems.append("потоковый режим: ни одной промежуточной правки")
+    if args.max_p99_ms and report["e2e_p99_ms"] > args.max_p99_ms:
+        problems.append(f"p99 {report['e2e_p99_ms']} мс > {args.max_p99_ms}")
+    if args.max_calls_per_message and report["upstream_calls_per_message"] > args.max_calls_per_message:
+        problems.append(
+            f"запросов к провайдеру на сообщение {report['upstream_calls_per_message']} > {args.max_calls_per_message}"
+        )
+    return problems
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5, help="сообщений на пользователя")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя после ответа, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="сколько ждать ответа, с")
+    parser.add_argument("--conversations", default="bench/conversations_sample.jsonl")
+    parser.add_argument("--reply", default="Короткий ответ заглушки: всё работает, вот три пункта и пример.")
+    parser.add_argument("--latency", type=float, default=0.2, help="медиана задержки провайдера, с")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tail-ratio", type=float, default=0.01)
+    parser.add_argument("--tail-latency", type=float, default=3.0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--bot-api-latency", type=float, default=0.0)
+    parser.add_argument("--coalesce-window", type=float, default=0.05)
+    parser.add_argument("--stream", action="store_true", help="STREAM_REPLIES=1")
+    parser.add_argument("--summary", action="store_true", help="включить фоновый конспект")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="отчёт одной строкой JSON")
+    parser.add_argument("--max-p99-ms", type=float, default=0.0)
+    parser.add_argument("--max-calls-per-message", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for key, value in report.items():
+            print(f"{key:28s} {value}")
+    problems = check(report, args)
+    for problem in problems:
+        print("РЕГРЕССИЯ:", problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
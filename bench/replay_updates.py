@@ -0,0 +1,76 @@
+"""Отправляет записанные апдейты Telegram на локальный вебхук.
+
+Файл — JSONL, по одному объекту Update на строку. --repeat N шлёт каждый
+апдейт N раз (проверка отсева повторов по update_id).
+
+    python -m bench.replay_updates bench/updates_sample.jsonl \
+        --url http://127.0.0.1:8080/telegram --secret s3cret
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+from typing import Dict, List
+
+import httpx
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(
+    updates: List[dict],
+    url: str,
+    secret: str = "",
+    concurrency: int = 1,
+    repeat: int = 1,
+) -> Dict[str, object]:
+    headers = {SECRET_HEADER: secret} if secret else {}
+    statuses: Counter = Counter()
+    latencies: List[float] = []
+    queue = [u for u in updates for _ in range(repeat)]
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(timeout=10) as client:
+        async def send(update: dict) -> None:
+            async with sem:
+                t0 = time.perf_counter()
+                resp = await client.post(url, json=update, headers=headers)
+                latencies.append(time.perf_counter() - t0)
+                statuses[resp.status_code] += 1
+
+        if concurrency == 1:
+            # по порядку — как Telegram доставляет апдейты одного чата
+            for update in queue:
+                await send(update)
+        else:
+            await asyncio.gather(*(send(u) for u in queue))
+
+    latencies.sort()
+    return {
+        "sent": len(queue),
+        "statuses": dict(statuses),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else 0.0,
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+async def main(args):
+    report = await replay(load_updates(args.file), args.url, args.secret, args.concurrency, args.repeat)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("file")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/telegram")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,221 @@
+"""Локальная заглушка OpenAI-совместимого API для бенчмарков.
+
+Сервер на чистом asyncio (HTTP/1.1 с keep-alive), без внешних зависимостей.
+handshake_delay имитирует стоимость TCP+TLS-рукопожатия: задержка
+добавляется один раз на каждое новое соединение, а не на каждый запрос.
+Запросы со stream=True получают SSE-поток (token_delay между чанками),
+если не включён reject_stream — тогда сервер отвечает 400, как провайдеры
+без поддержки стрима.
+
+Задержка ответа — логнормальная с медианой latency и разбросом
+latency_sigma (0 — фиксированная), плюс редкие выбросы: с вероятностью
+tail_ratio ответ ждёт tail_latency. С вероятностью rate_limit_ratio
+запрос получает 429 с Retry-After: retry_after.
+
+Ответ содержит usage (токены — по словам); в стриме — последним чанком,
+если запрошено stream_options.include_usage, как у OpenAI.
+
+    python -m bench.stub_provider --port 8081 --latency 0.05 --handshake-delay 0.08
+    python -m bench.stub_provider --latency 0.8 --latency-sigma 0.5 --tail-ratio 0.02 --rate-limit-ratio 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+
+class StubProvider:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        handshake_delay: float = 0.0,
+        reply: str = "pong",
+        token_delay: float = 0.0,
+        reject_stream: bool = False,
+        latency_sigma: float = 0.0,
+        tail_ratio: float = 0.0,
+        tail_latency: float = 0.0,
+        rate_limit_ratio: float = 0.0,
+        retry_after: float = 1.0,
+        seed: int = 0,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.handshake_delay = handshake_delay
+        self.reply = reply
+        self.token_delay = token_delay
+        self.reject_stream = reject_stream
+        self.latency_sigma = latency_sigma
+        self.tail_ratio = tail_ratio
+        self.tail_latency = tail_latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self.connections = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self._server: asyncio.AbstractServer | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self) -> "StubProvider":
+        self._server = await asyncio.start_server(self._handle_conn, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        if self.handshake_delay:
+            await asyncio.sleep(self.handshake_delay)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                length = int(headers.get("content-length", "0"))
+                if length:
+                    body = await reader.readexactly(length)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                status, payload = await self._route(method, path, body)
+                if not isinstance(payload, bytes):
+                    await self._write_chunked(writer, status, payload)
+                    continue
+                extra = f"Retry-After: {self.retry_after:g}\r\n" if status.startswith("429") else ""
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"{extra}"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                    "\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write_chunked(self, writer: asyncio.StreamWriter, status: str, chunks):
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "\r\n".encode("latin-1")
+        )
+        async for chunk in chunks:
+            writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def _usage(self, request: dict) -> dict:
+        prompt = sum(len(str(m.get("content", "")).split()) + 4 for m in request.get("messages", []))
+        completion = len(self.reply.split())
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    async def _sse(self, request: dict):
+        model = request.get("model", "stub")
+        for i, word in enumerate(self.reply.split(" ")):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            delta = word if i == 0 else " " + word
+            chunk = {
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunk = {"object": "chat.completion.chunk", "model": model, "choices": [], "usage": self._usage(request)}
+            yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+        yield b"data: [DONE]\n\n"
+
+    def sample_latency(self) -> float:
+        if self.tail_ratio and self._rng.random() < self.tail_ratio:
+            return self.tail_latency
+        if self.latency_sigma and self.latency:
+            return self._rng.lognormvariate(0.0, self.latency_sigma) * self.latency
+        return self.latency
+
+    async def _route(self, method: str, path: str, body: bytes):
+        if method == "GET" and path.endswith("/models"):
+            return "200 OK", b'{"object": "list", "data": [{"id": "stub", "object": "model"}]}'
+        if method != "POST" or not path.endswith("/chat/completions"):
+            return "404 Not Found", b'{"error": "not found"}'
+        self.requests += 1
+        if self.rate_limit_ratio and self._rng.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return "429 Too Many Requests", b'{"error": {"message": "rate limit exceeded"}}'
+        delay = self.sample_latency()
+        if delay:
+            await asyncio.sleep(delay)
+        request = json.loads(body or b"{}")
+        if request.get("stream"):
+            if self.reject_stream:
+                return "400 Bad Request", b'{"error": {"message": "stream is not supported"}}'
+            return "200 OK", self._sse(request)
+        data = {
+            "id": f"stub-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": self._usage(request),
+        }
+        return "200 OK", json.dumps(data).encode("utf-8")
+
+
+async def _serve(args):
+    stub = await StubProvider(
+        port=args.port,
+        latency=args.latency,
+        handshake_delay=args.handshake_delay,
+        latency_sigma=args.latency_sigma,
+        tail_ratio=args.tail_ratio,
+        tail_latency=args.tail_latency,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+    ).start()
+    print("Stub provider:", stub.base_url)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--handshake-delay", type=float, default=0.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.0)
+    parser.add_argument("--tail-ratio", type=float, default=0.0)
+    parser.add_argument("--tail-latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    asyncio.run(_serve(parser.parse_args()))
@@ -1,22 +1,32 @@
 import asyncio
-from src.ai_providers.openai_compatible import chat_completion_async, chat_completion_sync
+from src.ai_providers.openai_compatible import ask_ai, ask_ai_stream, close_ai_client
 from src.config import OPENAI_BASE_URL, OPENAI_MODEL
 
-def run_sync():
+async def run_once():
     print("BASE_URL:", OPENAI_BASE_URL)
     print("MODEL   :", OPENAI_MODEL)
-    print("SYNC TEST…")
-    out = chat_completion_sync("Ответь словом: pong")
-    print("REPLY:", out)
+    print("ASYNC TEST…")
+    try:
+        out = await ask_ai("Ответь словом: pong", use_cache=False)
+        print("REPLY:", out)
+    finally:
+        await close_ai_client()
 
-async def run_async():
+async def run_stream():
     print("BASE_URL:", OPENAI_BASE_URL)
     print("MODEL   :", OPENAI_MODEL)
-    print("ASYNC TEST…")
-    out = await chat_completion_async("Ответь словом: pong")
-    print("REPLY:", out)
+    print("STREAM TEST…")
+    try:
+        async for delta in ask_ai_stream("Ответь словом: pong", use_cache=False):
+            print(delta, end="", flush=True)
+        print()
+    finally:
+        await close_ai_client()
+
+def run_sync():
+    asyncio.run(run_once())
 
 if __name__ == "__main__":
     # Выбери один из вариантов:
-    # run_sync()
-    asyncio.run(run_async())
+    # asyncio.run(run_stream())
+    run_sync()
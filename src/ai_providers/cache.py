@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+_WS_RE = re.compile(r"\s+")
+# Накладные расходы на запись в памяти (ключ, кортеж, узел OrderedDict)
+_ENTRY_OVERHEAD = 200
+# Результат для ждущих, если ведущий запрос отменён: проверить кэш и повторить самим
+_RETRY = object()
+
+
+def normalize_text(text: str) -> str:
+    return _WS_RE.sub(" ", text).strip().casefold()
+
+
+def is_one_shot(messages: List[Dict[str, str]]) -> bool:
+    """Запрос без истории: ровно одно пользовательское сообщение и ни одного ответа."""
+    roles = [m["role"] for m in messages if m["role"] != "system"]
+    return roles == ["user"]
+
+
+def make_cache_key(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    settings: Optional[Dict[str, str]] = None,
+) -> str:
+    """Ключ по нормализованным сообщениям и эффективным настройкам пользователя."""
+    settings = settings or {}
+    material = {
+        "model": model,
+        "temperature": round(temperature, 3),
+        "lang": settings.get("lang"),
+        "spec": settings.get("spec"),
+        "messages": [
+            [m["role"], normalize_text(m["content"]) if m["role"] == "user" else m["content"]]
+            for m in messages
+        ],
+    }
+    raw = json.dumps(material, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class _DiskTier:
+    """SQLite-слой кэша; все обращения идут из потоков, не блокируя event loop."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[1] <= time.time():
+                self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+        return row
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            self._db.commit()
+
+    def purge_expired(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class ResponseCache:
+    """Кэш ответов ИИ: LRU по байтам + TTL, опционально SQLite на диске.
+
+    Одинаковые запросы, пришедшие одновременно, объединяются (single-flight):
+    к провайдеру уходит один вызов, остальные ждут его результат.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, db_path: str = ""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Tuple[float, str, int]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._disk = _DiskTier(db_path) if db_path else None
+        if self._disk is not None:
+            self._disk.purge_expired()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # --- память ---
+    def _mem_get(self, key: str) -> Optional[str]:
+        entry = self._mem.get(key)
+        if entry is None:
+            return None
+        expires_at, value, size = entry
+        if expires_at <= time.time():
+            del self._mem[key]
+            self._bytes -= size
+            return None
+        self._mem.move_to_end(key)
+        return value
+
+    def _mem_put(self, key: str, value: str, expires_at: float) -> None:
+        size = len(value.encode("utf-8")) + len(key) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._mem[key] = (expires_at, value, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, _, evicted) = self._mem.popitem(last=False)
+            self._bytes -= evicted
+
+    # --- публичный API ---
+    async def get(self, key: str) -> Optional[str]:
+        value = self._mem_get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self._disk is not None:
+            row = await asyncio.to_thread(self._disk.get, key)
+            if row is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                self._mem_put(key, row[0], row[1])
+                return row[0]
+        return None
+
+    async def put(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl
+        self._mem_put(key, value, expires_at)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.put, key, value, expires_at)
+
+    async def get_or_call(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        value = await self.join(key)
+        if value is not None:
+            return value
+
+        future = self.begin(key)
+        try:
+            value = await factory()
+        except BaseException as e:
+            self.fail(key, future, e)
+            raise
+        await self.finish(key, future, value)
+        return value
+
+    async def join(self, key: str) -> Optional[str]:
+        """Ответ из кэша или уже идущего запроса с тем же ключом.
+
+        None — ответа нет и запрос надо делать самому (begin/finish/fail).
+        Если ведущий запрос отменён (например, коалесцер заменил его ход),
+        ждущие не получают ошибку: один из них становится новым ведущим.
+        """
+        while True:
+            value = await self.get(key)
+            if value is not None:
+                return value
+            pending = self._inflight.get(key)
+            if pending is None:
+                return None
+            self.coalesced += 1
+            value = await asyncio.shield(pending)
+            if value is not _RETRY:
+                return value
+
+    def begin(self, key: str) -> asyncio.Future:
+        """Промах: регистрирует запрос, одинаковые будут ждать его результат."""
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    async def finish(self, key: str, future: asyncio.Future, value: str) -> None:
+        future.set_result(value)
+        try:
+            await self.put(key, value)
+        finally:
+            self._inflight.pop(key, None)
+
+    def fail(self, key: str, future: asyncio.Future, error: BaseException) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if future.done():
+            return
+        if isinstance(error, Exception):
+            future.set_exception(error)
+            future.exception()  # помечаем как прочитанное, если ждущих нет
+        else:
+            # отмена или закрытый поток — не ошибка запроса: ждущие повторят сами
+            future.set_result(_RETRY)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "entries": len(self._mem),
+            "bytes": self._bytes,
+        }
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
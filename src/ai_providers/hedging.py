@@ -0,0 +1,181 @@
+"""Хеджирование запросов к ИИ: дубль на другой ключ или эндпоинт.
+
+Если ответ (в стриме — первый токен) не пришёл за delay, уходит второй
+такой же запрос; первый успешный побеждает, проигравший отменяется. delay —
+перцентиль недавних задержек эндпоинта, зажатый в [min_delay, max_delay].
+Доля дублей ограничена бюджетом: каждый запрос добавляет max_ratio жетона
+(не больше burst), дубль тратит целый жетон, так что расход квоты растёт
+не больше чем на max_ratio.
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from src.ai_providers.latency import LatencyTracker
+from src.config import (
+    HEDGE_ENABLED,
+    HEDGE_QUANTILE,
+    HEDGE_MIN_DELAY,
+    HEDGE_MAX_DELAY,
+    HEDGE_MAX_RATIO,
+    HEDGE_BURST,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Пока задержек меньше — перцентилю не верим и ждём max_delay
+_MIN_SAMPLES = 20
+# Признак пустого стрима
+_EOF = object()
+
+
+class HedgePolicy:
+    def __init__(
+        self,
+        enabled: bool = False,
+        quantile: float = 0.95,
+        min_delay: float = 0.5,
+        max_delay: float = 10.0,
+        max_ratio: float = 0.1,
+        burst: float = 5.0,
+        window: int = 200,
+    ):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.tracker = LatencyTracker(window)
+        self._tokens = burst
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self.skipped = 0
+
+    def delay(self, key: str) -> float:
+        stats = self.tracker.get(key)
+        if len(stats.samples) < _MIN_SAMPLES:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, stats.percentile(self.quantile)))
+
+    def _take(self) -> bool:
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.fired += 1
+            return True
+        self.skipped += 1
+        return False
+
+    async def _timed(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            # отменённый проигравший даёт нижнюю оценку задержки — без неё перцентиль ползёт вниз
+            self.tracker.observe(key, time.monotonic() - started, True)
+            raise
+        self.tracker.observe(key, time.monotonic() - started, True)
+        return result
+
+    async def race(
+        self,
+        key: str,
+        primary: Callable[[], Awaitable[T]],
+        backup: Optional[Callable[[], Awaitable[T]]] = None,
+    ) -> Tuple[int, T]:
+        """(0, результат основного) или (1, результат дубля)."""
+        self.requests += 1
+        self._tokens = min(self.burst, self._tokens + self.max_ratio)
+        hedged = self.enabled and backup is not None
+        tasks: List[asyncio.Future] = [asyncio.ensure_future(self._timed(key, primary))]
+        try:
+            if hedged:
+                await asyncio.wait(tasks, timeout=self.delay(key))
+            if tasks[0].done() or not hedged or not self._take():
+                return 0, await tasks[0]
+
+            logger.debug("[API] %s: нет ответа за %.2f с, отправляем дубль", key, self.delay(key))
+            tasks.append(asyncio.ensure_future(self._timed(key, backup)))
+            while True:
+                await asyncio.wait([t for t in tasks if not t.done()], return_when=asyncio.FIRST_COMPLETED)
+                for index, task in enumerate(tasks):
+                    if task.done() and task.exception() is None:
+                        self.won += index
+                        return index, task.result()
+                if all(task.done() for task in tasks):
+                    raise tasks[0].exception()
+        finally:
+            leftover = [t for t in tasks if not t.done()]
+            for task in leftover:
+                task.cancel()
+            if leftover:
+                await asyncio.wait(leftover)
+
+    async def run(
+        self,
+        key: str,
+        primary: Callable[[], Awaitable[T]],
+        backup: Optional[Callable[[], Awaitable[T]]] = None,
+    ) -> T:
+        return (await self.race(key, primary, backup))[1]
+
+    async def stream(
+        self,
+        key: str,
+        primary: Callable[[], AsyncIterator[str]],
+        backup: Optional[Callable[[], AsyncIterator[str]]] = None,
+    ) -> AsyncIterator[str]:
+        """Гонка до первого токена; дальше читается только победивший поток."""
+        streams: List[Optional[AsyncIterator[str]]] = [None, None]
+
+        def head(index: int, factory: Callable[[], AsyncIterator[str]]):
+            async def first():
+                streams[index] = factory()
+                try:
+                    return await streams[index].__anext__()
+                except StopAsyncIteration:
+                    return _EOF
+            return first
+
+        # при ошибке race оба потока уже завершены исключением или отменой
+        index, delta = await self.race(
+            key, head(0, primary), head(1, backup) if backup is not None else None
+        )
+        loser = streams[1 - index]
+        if loser is not None:
+            await loser.aclose()
+        winner = streams[index]
+        try:
+            if delta is _EOF:
+                return
+            yield delta
+            async for delta in winner:
+                yield delta
+        finally:
+            await winner.aclose()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "hedges_fired": self.fired,
+            "hedges_won": self.won,
+            "skipped_budget": self.skipped,
+            "delays_ms": {
+                key: round(self.delay(key) * 1000, 1) for key in self.tracker.snapshot()
+            },
+        }
+
+
+hedge_policy = HedgePolicy(
+    enabled=HEDGE_ENABLED,
+    quantile=HEDGE_QUANTILE,
+    min_delay=HEDGE_MIN_DELAY,
+    max_delay=HEDGE_MAX_DELAY,
+    max_ratio=HEDGE_MAX_RATIO,
+    burst=HEDGE_BURST,
+)
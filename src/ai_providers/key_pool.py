@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+import httpx
+
+from src.utils.metrics import metrics
+from src.config import (
+    AI_KEY_MAX_IN_FLIGHT,
+    AI_KEY_ACQUIRE_TIMEOUT,
+    AI_KEY_DEFAULT_COOLDOWN,
+    AI_BREAKER_FAILURES,
+    AI_BREAKER_RESET,
+)
+
+logger = logging.getLogger(__name__)
+
+# Максимальная пауза после серии 429 без подсказки от провайдера
+_MAX_BACKOFF = 60.0
+# Вес нового наблюдения в скользящей оценке здоровья ключа
+_HEALTH_ALPHA = 0.2
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class KeyPoolExhausted(RuntimeError):
+    """Нет ключа, который освободится до истечения таймаута ожидания."""
+
+
+def mask_key(key: str) -> str:
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 12 else "…"
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Разбирает длительность из заголовков: "7.66s", "1m30s", "250ms" или просто "12"."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(num) * _DURATION_UNITS[unit] for num, unit in parts)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After бывает в секундах или HTTP-датой."""
+    seconds = parse_duration(value)
+    if seconds is not None or not value:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _header_int(headers: httpx.Headers, name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class KeyState:
+    __slots__ = (
+        "key", "in_flight", "cooldown_until", "consecutive_429", "consecutive_errors",
+        "remaining_requests", "remaining_tokens", "limit_requests",
+        "health", "requests", "rate_limited", "errors", "last_used",
+    )
+
+    def __init__(self, key: str):
+        self.key = key
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_429 = 0
+        self.consecutive_errors = 0
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.limit_requests: Optional[int] = None
+        self.health = 1.0
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.last_used = 0.0
+
+    def quota_ratio(self) -> float:
+        if self.remaining_requests is None or not self.limit_requests:
+            return 1.0
+        return self.remaining_requests / self.limit_requests
+
+    def _score_health(self, ok: float) -> None:
+        self.health += _HEALTH_ALPHA * (ok - self.health)
+
+
+class KeyPool:
+    """Планировщик API-ключей.
+
+    Выдаёт наименее загруженный ключ (затем — с большим остатком квоты и
+    лучшим здоровьем), ограничивает число параллельных запросов на ключ,
+    читает Retry-After и x-ratelimit-* и «паркует» ключ на объявленное время.
+    Ключ с error_threshold ошибками подряд (5xx, обрывы) паркуется на
+    error_cooldown с удвоением — после паузы следующий запрос служит пробой.
+    Если свободных ключей нет, acquire() ждёт, но не дольше acquire_timeout.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable[str],
+        max_in_flight: int = AI_KEY_MAX_IN_FLIGHT,
+        acquire_timeout: float = AI_KEY_ACQUIRE_TIMEOUT,
+        default_cooldown: float = AI_KEY_DEFAULT_COOLDOWN,
+        error_threshold: int = AI_BREAKER_FAILURES,
+        error_cooldown: float = AI_BREAKER_RESET,
+    ):
+        self._states: List[KeyState] = [KeyState(k) for k in dict.fromkeys(keys)]
+        if not self._states:
+            raise ValueError("Пул ключей пуст")
+        self.max_in_flight = max_in_flight
+        self.acquire_timeout = acquire_timeout
+        self.default_cooldown = default_cooldown
+        self.error_threshold = error_threshold
+        self.error_cooldown = error_cooldown
+        self._changed = asyncio.Condition()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def _pick(self, now: float, exclude: Iterable[str]) -> Optional[KeyState]:
+        best = None
+        best_rank = None
+        for st in self._states:
+            if st.key in exclude or st.cooldown_until > now or st.in_flight >= self.max_in_flight:
+                continue
+            rank = (st.in_flight, -st.quota_ratio(), -st.health, st.last_used)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = st, rank
+        return best
+
+    def _next_free_at(self, now: float, exclude: Iterable[str]) -> float:
+        # занятые, но не запаркованные ключи разбудит release(), а не таймер
+        parked = [st.cooldown_until for st in self._states if st.key not in exclude and st.cooldown_until > now]
+        return min(parked) if parked else float("inf")
+
+    async def acquire(self, exclude: Iterable[str] = ()) -> KeyState:
+        exclude = frozenset(exclude)
+        deadline = time.monotonic() + self.acquire_timeout
+        async with self._changed:
+            while True:
+                now = time.monotonic()
+                st = self._pick(now, exclude)
+                if st is not None:
+                    st.in_flight += 1
+                    st.requests += 1
+                    st.last_used = now
+                    return st
+
+                left = deadline - now
+                wake_in = self._next_free_at(now, exclude) - now
+                if left <= 0 or (wake_in > left and all(
+                    s.in_flight == 0 for s in self._states if s.key not in exclude
+                )):
+                    # Ни один ключ не освободится вовремя — не держим пользователя
+                    raise KeyPoolExhausted("Все API ключи исчерпали лимит")
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=max(0.0, min(left, wake_in)))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, st: KeyState) -> None:
+        async with self._changed:
+            st.in_flight -= 1
+            self._changed.notify_all()
+
+    @asynccontextmanager
+    async def lease(self, exclude: Iterable[str] = ()) -> AsyncIterator[KeyState]:
+        st = await self.acquire(exclude)
+        try:
+            yield st
+        except (asyncio.CancelledError, httpx.HTTPStatusError):
+            raise  # статус ответа уже учтён в observe()
+        except Exception:
+            self._failed(st)
+            raise
+        finally:
+            await self.release(st)
+
+    def _failed(self, st: KeyState) -> None:
+        st.errors += 1
+        st.consecutive_errors += 1
+        st._score_health(0.0)
+        if st.consecutive_errors >= self.error_threshold:
+            wait = min(_MAX_BACKOFF, self.error_cooldown * 2 ** (st.consecutive_errors - self.error_threshold))
+            st.cooldown_until = time.monotonic() + wait
+            logger.warning("[API] Ключ %s: %d ошибок подряд, пауза %.1f с", mask_key(st.key), st.consecutive_errors, wait)
+
+    def observe(self, st: KeyState, resp: httpx.Response) -> None:
+        """Учитывает ответ провайдера: остаток квоты, 429 и Retry-After."""
+        headers = resp.headers
+        remaining = _header_int(headers, "x-ratelimit-remaining-requests")
+        if remaining is not None:
+            st.remaining_requests = remaining
+        limit = _header_int(headers, "x-ratelimit-limit-requests")
+        if limit is not None:
+            st.limit_requests = limit
+        tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+        if tokens is not None:
+            st.remaining_tokens = tokens
+
+        now = time.monotonic()
+        if resp.status_code == 429:
+            metrics.inc("ai_rate_limited")
+            st.rate_limited += 1
+            st.consecutive_429 += 1
+            st._score_health(0.0)
+            wait = parse_retry_after(headers.get("retry-after"))
+            if wait is None:
+                wait = max(
+                    parse_duration(headers.get("x-ratelimit-reset-requests")) or 0.0,
+                    parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0,
+                ) or None
+            if wait is None:
+                wait = min(_MAX_BACKOFF, self.default_cooldown * 2 ** (st.consecutive_429 - 1))
+            st.cooldown_until = now + wait
+            logger.warning("[API] Лимит на ключе %s, пауза %.1f с", mask_key(st.key), wait)
+            return
+
+        st.consecutive_429 = 0
+        if resp.status_code >= 500:
+            self._failed(st)
+        else:
+            st.consecutive_errors = 0
+            st._score_health(1.0)
+        if remaining == 0:
+            # Квота кончилась без 429 — паркуем до сброса окна
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset:
+                st.cooldown_until = now + reset
+
+    # ====== Общие паузы для нескольких процессов ======
+    @staticmethod
+    def fingerprint(key: str) -> str:
+        """Имя ключа в общем хранилище: сам ключ туда не пишется."""
+        return "key:" + hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def parked(self) -> Dict[str, float]:
+        """Запаркованные ключи: отпечаток -> конец паузы по time.time()."""
+        now = time.monotonic()
+        wall = time.time()
+        return {
+            self.fingerprint(st.key): wall + st.cooldown_until - now
+            for st in self._states if st.cooldown_until > now
+        }
+
+    def apply_parked(self, parked: Dict[str, float]) -> None:
+        """Продлевает паузы ключей, запаркованных другими процессами."""
+        now = time.monotonic()
+        wall = time.time()
+        for st in self._states:
+            until = parked.get(self.fingerprint(st.key))
+            if until is not None:
+                st.cooldown_until = max(st.cooldown_until, now + until - wall)
+
+    def snapshot(self) -> List[Dict[str, object]]:
+        """Состояние пула для мониторинга (ключи замаскированы)."""
+        now = time.monotonic()
+        return [
+            {
+                "key": mask_key(st.key),
+                "in_flight": st.in_flight,
+                "cooldown": round(max(0.0, st.cooldown_until - now), 2),
+                "remaining_requests": st.remaining_requests,
+                "remaining_tokens": st.remaining_tokens,
+                "health": round(st.health, 3),
+                "requests": st.requests,
+                "rate_limited": st.rate_limited,
+                "errors": st.errors,
+            }
+            for st in self._states
+        ]
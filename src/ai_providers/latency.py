@@ -0,0 +1,80 @@
+"""Скользящая статистика задержек и ошибок по маршрутам моделей.
+
+На маршрут хранится окно последних window вызовов: длительность успешных и
+исход каждого. По окну считаются перцентили задержки и доля ошибок —
+этого достаточно, чтобы решить, стоит ли сейчас идти на маршрут или сразу
+на следующий в цепочке отката.
+"""
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+
+class RouteStats:
+    __slots__ = ("samples", "outcomes", "calls", "failures", "last_probe")
+
+    def __init__(self, window: int):
+        self.samples: Deque[float] = deque(maxlen=window)  # длительности успешных вызовов, с
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+        self.last_probe = 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 50):
+        self.window = window
+        self._routes: Dict[str, RouteStats] = {}
+
+    def get(self, route: str) -> RouteStats:
+        stats = self._routes.get(route)
+        if stats is None:
+            stats = self._routes[route] = RouteStats(self.window)
+        return stats
+
+    def observe(self, route: str, seconds: float, ok: bool) -> None:
+        stats = self.get(route)
+        stats.calls += 1
+        stats.outcomes.append(ok)
+        if ok:
+            stats.samples.append(seconds)
+        else:
+            stats.failures += 1
+
+    def should_probe(self, route: str, interval: float) -> bool:
+        """Раз в interval секунд пропускает один запрос на проблемный маршрут."""
+        stats = self.get(route)
+        now = time.monotonic()
+        if now - stats.last_probe < interval:
+            return False
+        stats.last_probe = now
+        return True
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        def ms(value: Optional[float]) -> Optional[float]:
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            name: {
+                "calls": st.calls,
+                "failures": st.failures,
+                "error_rate": round(st.error_rate(), 3),
+                "p50_ms": ms(st.percentile(0.5)),
+                "p95_ms": ms(st.percentile(0.95)),
+            }
+            for name, st in self._routes.items()
+        }
+
+
+latency_tracker = LatencyTracker()
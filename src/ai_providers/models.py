@@ -0,0 +1,153 @@
+"""Реестр моделей: что на самом деле стоит за выбором в меню.
+
+Маршрут — это эндпоинт (base_url), группа ключей (имя переменной окружения
+со списком ключей через запятую), id модели, окно контекста, классы
+стоимости и задержки и цепочка отката на другие маршруты. Реестр читается
+из JSON (MODELS_FILE). Без него в реестре один маршрут — OPENAI_MODEL на
+OPENAI_BASE_URL: других моделей у настроенного эндпоинта может не быть, и
+каждый запрос к ним падал бы и уходил в откат. Пример — models.example.json:
+
+    {"default": "default",
+     "routes": [{"name": "gpt4", "label": "GPT‑4", "base_url": "https://api.openai.com/v1",
+                 "model": "gpt-4o", "key_group": "OPENAI_API_KEYS", "context_window": 128000,
+                 "cost": "high", "latency": "slow", "fallback": ["default"]}]}
+"""
+import json
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from src.ai_providers.latency import LatencyTracker, latency_tracker
+from src.config import OPENAI_BASE_URL, OPENAI_MODEL, MODELS_FILE
+
+logger = logging.getLogger(__name__)
+
+# Сколько токенов окна оставлять под ответ модели
+OUTPUT_RESERVE_TOKENS = 2048
+
+# Порог медианной задержки для класса: выше — маршрут считается медленным
+LATENCY_BUDGETS = {"fast": 10.0, "normal": 25.0, "slow": 60.0}
+COST_CLASSES = ("low", "medium", "high")
+
+# Меньше стольких вызовов в окне — статистике ещё не верим
+_MIN_SAMPLES = 5
+# Как часто пропускать пробный запрос на медленный/ошибающийся маршрут
+_PROBE_INTERVAL = 30.0
+_MAX_ERROR_RATE = 0.5
+
+
+class ModelRoute(NamedTuple):
+    name: str
+    label: str
+    base_url: str
+    model: str
+    key_group: str = "OPENAI_API_KEYS"
+    context_window: int = 16000
+    cost: str = "medium"
+    latency: str = "normal"
+    fallback: Tuple[str, ...] = ()
+    menu: bool = True  # показывать в меню выбора модели
+
+    @property
+    def latency_budget(self) -> float:
+        return LATENCY_BUDGETS.get(self.latency, LATENCY_BUDGETS["normal"])
+
+    @property
+    def prompt_budget(self) -> int:
+        return max(0, self.context_window - OUTPUT_RESERVE_TOKENS)
+
+
+DEFAULT_ROUTES = (
+    ModelRoute("default", OPENAI_MODEL, OPENAI_BASE_URL, OPENAI_MODEL,
+               context_window=128000, cost="low", latency="fast"),
+)
+
+
+def load_routes(path: str) -> Tuple[List[ModelRoute], str]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    routes = []
+    for item in data["routes"]:
+        item = dict(item)
+        item["fallback"] = tuple(item.get("fallback", ()))
+        routes.append(ModelRoute(**item))
+    return routes, data.get("default", routes[0].name if routes else "")
+
+
+class ModelRegistry:
+    def __init__(self, routes: List[ModelRoute], default: str, tracker: LatencyTracker = latency_tracker):
+        self._routes: Dict[str, ModelRoute] = {r.name: r for r in routes}
+        if default not in self._routes:
+            raise ValueError(f"Маршрут по умолчанию {default!r} не найден в реестре моделей")
+        for route in routes:
+            missing = [name for name in route.fallback if name not in self._routes]
+            if missing:
+                raise ValueError(f"Маршрут {route.name}: неизвестные маршруты отката {missing}")
+        self.default = self._routes[default]
+        self.tracker = tracker
+        self._by_label = {r.label: r for r in routes}
+        self._by_model = {r.model: r for r in routes}
+
+    def get(self, name: str) -> Optional[ModelRoute]:
+        return self._routes.get(name)
+
+    def routes(self) -> List[ModelRoute]:
+        return list(self._routes.values())
+
+    def menu_routes(self) -> List[ModelRoute]:
+        return [r for r in self._routes.values() if r.menu]
+
+    def resolve(self, value: Optional[str]) -> Optional[ModelRoute]:
+        """Маршрут по имени, подписи в меню или id модели."""
+        if not value:
+            return None
+        return self._routes.get(value) or self._by_label.get(value) or self._by_model.get(value)
+
+    def for_settings(self, settings: Optional[dict]) -> ModelRoute:
+        """Маршрут, выбранный пользователем (старые состояния хранят только подпись)."""
+        if settings:
+            route = self.resolve(settings.get("model_route")) or self.resolve(settings.get("model"))
+            if route is not None:
+                return route
+        return self.default
+
+    def _degraded(self, route: ModelRoute) -> bool:
+        stats = self.tracker.get(route.name)
+        if len(stats.outcomes) < _MIN_SAMPLES:
+            return False
+        p50 = stats.percentile(0.5)
+        return stats.error_rate() >= _MAX_ERROR_RATE or (p50 is not None and p50 > route.latency_budget)
+
+    def chain(self, route: ModelRoute, prompt_tokens: int = 0) -> List[ModelRoute]:
+        """Порядок попыток: маршрут и его откаты (в глубину, без повторов).
+
+        Маршруты, в окно которых запрос не влезает, пропускаются; медленные и
+        ошибающиеся уходят в конец цепочки, кроме редких пробных запросов.
+        """
+        order: List[ModelRoute] = []
+        stack = [route]
+        while stack:
+            current = stack.pop(0)
+            if current in order:
+                continue
+            order.append(current)
+            stack[:0] = [self._routes[name] for name in current.fallback]
+
+        fitting = [r for r in order if prompt_tokens <= r.prompt_budget] or order
+        healthy, degraded = [], []
+        for r in fitting:
+            if self._degraded(r) and not self.tracker.should_probe(r.name, _PROBE_INTERVAL):
+                degraded.append(r)
+            else:
+                healthy.append(r)
+        return healthy + degraded
+
+
+def _build_registry() -> ModelRegistry:
+    if MODELS_FILE:
+        routes, default = load_routes(MODELS_FILE)
+        logger.info("Реестр моделей загружен из %s: %d маршрутов", MODELS_FILE, len(routes))
+        return ModelRegistry(routes, default)
+    return ModelRegistry(list(DEFAULT_ROUTES), "default")
+
+
+model_registry = _build_registry()
@@ -1,59 +1,79 @@
 import os
-import itertools
+import asyncio
+import json
+import time
 import httpx
-import re
 import base64
-from typing import List, Dict, Any, Union
-from src.config import OPENAI_BASE_URL, OPENAI_MODEL, AI_TIMEOUT
+from typing import List, Dict, Any, Union, Optional, AsyncIterator, Awaitable, Callable, Set
+from src.config import (
+    OPENAI_BASE_URL, AI_TIMEOUT,
+    AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT, AI_WRITE_TIMEOUT, AI_POOL_TIMEOUT,
+    AI_HTTP2, AI_MAX_CONNECTIONS, AI_MAX_KEEPALIVE, AI_KEEPALIVE_EXPIRY,
+    RESPONSE_CACHE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB,
+    AI_RETRY_5XX, SHARD_WORKERS, SHARD_SYNC_INTERVAL, USAGE_STREAM_OPTIONS,
+)
+from src.ai_providers.cache import ResponseCache, is_one_shot, make_cache_key
+from src.ai_providers.hedging import HedgePolicy, hedge_policy
+from src.ai_providers.key_pool import KeyPool, KeyPoolExhausted
+from src.ai_providers.latency import latency_tracker
+from src.ai_providers.models import ModelRoute, model_registry
+from src.ai_providers.resilience import backoff_delay, make_breaker, make_deadlines
+from src.ai_providers.usage import meter
+from src.utils.firewall import firewall
+from src.utils.metrics import metrics
+from src.utils.memory import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+from src.utils.state_store import state_store
+
+try:
+    import h2  # noqa: F401  (нужен httpx для HTTP/2)
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
 
 import logging
 logger = logging.getLogger(__name__)
 
-# ====== Ротация ключей (твоя реализация) ======
+# ====== Пул ключей ======
 API_KEYS = os.getenv("OPENAI_API_KEYS", "").split(",")
 API_KEYS = [k.strip() for k in API_KEYS if k.strip()]
 
 if not API_KEYS:
     raise ValueError("Не найдены API ключи в переменной OPENAI_API_KEYS")
 
-_key_cycle = itertools.cycle(API_KEYS)
-_current_key = next(_key_cycle)
+key_pool = KeyPool(API_KEYS)
+
+# Группа ключей маршрута — имя переменной окружения со списком ключей.
+# Пулы создаются при загрузке: маршрут без ключей — ошибка конфигурации, а не первого запроса
+_key_pools: Dict[str, KeyPool] = {"OPENAI_API_KEYS": key_pool}
 
-def get_current_key():
-    return _current_key
+for _route in model_registry.routes():
+    if _route.key_group not in _key_pools:
+        _keys = [k.strip() for k in os.getenv(_route.key_group, "").split(",") if k.strip()]
+        if not _keys:
+            raise ValueError(f"Маршрут {_route.name}: не найдены API ключи в переменной {_route.key_group}")
+        _key_pools[_route.key_group] = KeyPool(_keys)
 
-def rotate_key():
-    global _current_key
-    _current_key = next(_key_cycle)
-    logger.warning(f"[API] Переключение на следующий ключ: {_current_key}")
+def keys_for(group: str) -> KeyPool:
+    return _key_pools[group]
 
-def make_headers():
+def make_headers(key: str):
     return {
-        "Authorization": f"Bearer {_current_key}",
+        "Authorization": f"Bearer {key}",
         "Content-Type": "application/json",
     }
 
 # ====== Фильтр-файервол ======
-BLOCK_PATTERNS = [
-    r"(sk-[A-Za-z0-9]{20,})",  # API ключи
-    r"(?:\bpassword\b|\btoken\b|\bapi_key\b)",  # чувствительные слова
-    r"(system prompt|hidden prompt|internal instruction)",  # попытка вытащить промпт
-]
+# Правила и движок — в src/utils/firewall.py (один проход по тексту)
+
+REQUEST_REJECTED = "Запрос отклонён политикой безопасности."
 
 def sanitize_request(user_input: str) -> str:
     """Маскирует опасные данные"""
-    for pattern in BLOCK_PATTERNS:
-        if re.search(pattern, user_input, re.IGNORECASE):
-            logger.warning("Обнаружен запрещённый паттерн в запросе")
-            user_input = re.sub(pattern, "[REDACTED]", user_input, flags=re.IGNORECASE)
-    return user_input
+    return firewall.inspect_request(user_input).text
 
 def is_request_safe(user_input: str) -> bool:
     """Проверяет, можно ли отправлять запрос"""
-    for pattern in BLOCK_PATTERNS:
-        if re.search(pattern, user_input, re.IGNORECASE):
-            return False
-    return True
+    return not firewall.inspect_request(user_input).blocked
 
 # ====== Загрузка скрытого системного промпта из .env ======
 def load_system_prompt() -> str:
@@ -74,20 +94,125 @@ def _messages(user_text: str) -> List[Dict[str, str]]:
         {"role": "user", "content": user_text}
     ]
 
+# ====== Потоковый ответ (SSE) ======
+# Коды, которыми провайдеры отвечают на неподдерживаемый stream=True
+_STREAM_REJECT_CODES = {400, 404, 405, 415, 422, 501}
+
+async def _iter_sse_deltas(resp: httpx.Response, usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """Разбирает SSE-поток chat/completions и отдаёт текстовые дельты.
+
+    Поле usage (последний чанк при stream_options.include_usage) копируется в usage.
+    """
+    async for line in resp.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            logger.warning("[API] Не удалось разобрать SSE-чанк: %.200s", data)
+            continue
+        if usage is not None and chunk.get("usage"):
+            usage.update(chunk["usage"])
+        choices = chunk.get("choices") or []
+        if not choices:
+            continue
+        content = (choices[0].get("delta") or {}).get("content")
+        if content:
+            yield content
+
 # ====== Клиент ======
+def _default_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        AI_TIMEOUT,
+        connect=AI_CONNECT_TIMEOUT,
+        read=AI_READ_TIMEOUT,
+        write=AI_WRITE_TIMEOUT,
+        pool=AI_POOL_TIMEOUT,
+    )
+
+def _default_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=AI_MAX_CONNECTIONS,
+        max_keepalive_connections=AI_MAX_KEEPALIVE,
+        keepalive_expiry=AI_KEEPALIVE_EXPIRY,
+    )
+
 class OpenAICompatibleClient:
-    def __init__(self, base_url: str):
-        self.base_url = base_url
+    """Клиент OpenAI-совместимого API с общим пулом соединений.
+
+    Один httpx.AsyncClient живёт всё время работы бота: keep-alive и
+    (если установлен h2) HTTP/2 убирают TCP/TLS-рукопожатие из каждого ответа.
+    Пул открывается в start() и закрывается в aclose(); если start() не вызван,
+    клиент создаётся лениво при первом запросе.
+
+    Медленный запрос хеджируется (см. hedging.py): дубль уходит на другой
+    ключ пула, а если ключ один — на hedge_to (например, следующий эндпоинт).
+    Таймауты подстраиваются под наблюдаемые задержки, а при серии отказов
+    предохранитель сразу отвечает CircuitOpenError (см. resilience.py).
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        *,
+        http2: bool = AI_HTTP2,
+        timeout: Optional[httpx.Timeout] = None,
+        limits: Optional[httpx.Limits] = None,
+        keys: Optional[KeyPool] = None,
+        hedge: Optional[HedgePolicy] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.keys = keys or key_pool
+        self.hedge = hedge or hedge_policy
+        self.deadlines = make_deadlines()
+        self.breaker = make_breaker(self.base_url, self._probe)
+        self._probe_keys = self.keys
+        if http2 and not _HTTP2_AVAILABLE:
+            logger.warning("[API] Пакет h2 не установлен, HTTP/2 отключён")
+            http2 = False
+        self.http2 = http2
+        self.timeout = timeout or _default_timeout()
+        self.limits = limits or _default_limits()
+        self._http: Optional[httpx.AsyncClient] = None
+        # Сбрасывается в False, если провайдер отверг stream=True
+        self.stream_supported = True
+
+    def _get_http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._http
+
+    async def start(self) -> None:
+        """Открывает пул соединений (вызывается при старте Application)."""
+        self._get_http()
+
+    async def aclose(self) -> None:
+        """Закрывает пул соединений (вызывается при остановке Application)."""
+        await self.breaker.aclose()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     async def chat(
         self,
         model: str,
         messages: Union[str, List[Dict[str, str]]],
         temperature: float = 0.7,
-        max_tokens: int = 2048
+        max_tokens: int = 2048,
+        keys: Optional[KeyPool] = None,
+        hedge_to: Optional[Callable[[], Awaitable[str]]] = None,
     ) -> str:
         if isinstance(messages, str):
             messages = _messages(messages)
+        keys = keys or self.keys
 
         payload: Dict[str, Any] = {
             "model": model,
@@ -96,40 +221,439 @@ class OpenAICompatibleClient:
             "stream": False,
             "max_tokens": max_tokens,
         }
+        busy: Set[str] = set()
+        request = lambda: self._post_chat(payload, keys, busy)
+        backup = request if len(keys) > 1 else hedge_to
+        return await self.hedge.run(self.base_url, request, backup)
+
+    async def _probe(self) -> bool:
+        """Фоновая проба разомкнутого эндпоинта: лёгкий GET /models."""
+        async with self._probe_keys.lease() as key:
+            resp = await self._get_http().get(
+                "/models", headers=make_headers(key.key), timeout=self.deadlines.timeout("chat")
+            )
+        return resp.status_code < 500
 
-        # Пробуем столько раз, сколько у нас ключей
-        for attempt in range(len(API_KEYS)):
-            try:
-                async with httpx.AsyncClient(timeout=AI_TIMEOUT) as client:
-                    resp = await client.post(
-                        f"{self.base_url}/chat/completions",
-                        headers=make_headers(),
-                        json=payload
+    def _transport_failed(self, kind: str, exc: Exception) -> None:
+        if isinstance(exc, (httpx.TimeoutException, asyncio.TimeoutError)):
+            metrics.inc("ai_timeouts")
+            self.deadlines.timed_out(kind, exc)
+        else:
+            metrics.inc("ai_transport_errors")
+        self.breaker.record_failure()
+
+    @staticmethod
+    def _record_usage(key: str, payload: Dict[str, Any], usage: Optional[Dict[str, Any]], text: str) -> None:
+        """Токены ответа из usage провайдера, а если их нет — локальная оценка."""
+        prompt = completion = None
+        if usage:
+            prompt, completion = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        estimated = not isinstance(prompt, int) or not isinstance(completion, int)
+        if estimated:
+            prompt, completion = _prompt_tokens(payload["messages"]), estimate_tokens(text)
+        meter.record(KeyPool.fingerprint(key), payload["model"], prompt, completion, estimated)
+
+    async def _backoff(self, attempt: int, deadline: float) -> bool:
+        """Пауза перед повтором после 5xx; False — не успеваем до дедлайна."""
+        delay = backoff_delay(attempt)
+        if time.monotonic() + delay >= deadline:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    async def _post_chat(self, payload: Dict[str, Any], keys: KeyPool, busy: Set[str]) -> str:
+        # 429: пробуем столько раз, сколько у нас ключей (но не меньше двух:
+        # единственный ключ после паузы по Retry-After тоже стоит повторить).
+        # 5xx: до AI_RETRY_5XX повторов с паузой, пока укладываемся в дедлайн.
+        # busy — ключи, занятые параллельным дублем этого же запроса
+        started = time.monotonic()
+        deadline = started + self.deadlines.budget("chat", "total")
+        rate_limited = server_errors = 0
+        while True:
+            self.breaker.check()
+            self._probe_keys = keys
+            async with keys.lease(exclude=busy) as key:
+                busy.add(key.key)
+                try:
+                    resp = await asyncio.wait_for(
+                        self._get_http().post(
+                            "/chat/completions",
+                            headers=make_headers(key.key),
+                            json=payload,
+                            timeout=self.deadlines.timeout("chat"),
+                            extensions={"trace": self.deadlines.trace("chat")},
+                        ),
+                        max(0.0, deadline - time.monotonic()),
                     )
+                except (httpx.TransportError, asyncio.TimeoutError) as e:
+                    self._transport_failed("chat", e)
+                    raise
+                finally:
+                    busy.discard(key.key)
+                keys.observe(key, resp)
 
-                if resp.status_code == 429:  # лимит
-                    logger.warning(f"[API] Лимит на ключе {_current_key}, переключаем...")
-                    rotate_key()
+            if resp.status_code == 429:  # лимит — пул уже припарковал ключ
+                rate_limited += 1
+                if rate_limited >= max(2, len(keys)):
+                    raise KeyPoolExhausted("Все API ключи исчерпали лимит")
+                metrics.inc("ai_key_rotations")
+                continue
+
+            if resp.status_code >= 500:
+                metrics.inc("ai_server_errors")
+                self.breaker.record_failure()
+                if server_errors < AI_RETRY_5XX and await self._backoff(server_errors, deadline):
+                    server_errors += 1
                     continue
+            else:
+                self.breaker.record_success()
+            resp.raise_for_status()
+            data = resp.json()
+            self.deadlines.observe("chat", "total", time.monotonic() - started)
+            text = data["choices"][0]["message"]["content"].strip()
+            self._record_usage(key.key, payload, data.get("usage"), text)
+            return text
 
-                resp.raise_for_status()
-                data = resp.json()
-                return data["choices"][0]["message"]["content"].strip()
+    async def chat_stream(
+        self,
+        model: str,
+        messages: Union[str, List[Dict[str, str]]],
+        temperature: float = 0.7,
+        max_tokens: int = 2048,
+        keys: Optional[KeyPool] = None,
+        hedge_to: Optional[Callable[[], AsyncIterator[str]]] = None,
+    ) -> AsyncIterator[str]:
+        """Отдаёт ответ по частям через SSE.
 
-            except httpx.HTTPStatusError as e:
-                if e.response.status_code == 429:
-                    logger.warning(f"[API] Лимит на ключе {_current_key}, переключаем...")
-                    rotate_key()
-                    continue
-                raise e
+        Если провайдер не принимает stream=True, ответ запрашивается обычным
+        chat() и отдаётся одним куском; после этого клиент больше не пробует стрим.
+        """
+        if isinstance(messages, str):
+            messages = _messages(messages)
+        keys = keys or self.keys
 
-        raise RuntimeError("Все API ключи исчерпали лимит")
+        if not self.stream_supported:
+            yield await self.chat(model, messages, temperature=temperature, max_tokens=max_tokens, keys=keys)
+            return
+
+        payload: Dict[str, Any] = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+            "max_tokens": max_tokens,
+        }
+        if USAGE_STREAM_OPTIONS:
+            payload["stream_options"] = {"include_usage": True}
+        busy: Set[str] = set()
+        request = lambda: self._open_stream(payload, keys, busy)
+        backup = request if len(keys) > 1 else hedge_to
+        async for delta in self.hedge.stream(f"{self.base_url} ttfb", request, backup):
+            yield delta
+
+    async def _open_stream(self, payload: Dict[str, Any], keys: KeyPool, busy: Set[str]) -> AsyncIterator[str]:
+        started = time.monotonic()
+        deadline = started + self.deadlines.budget("stream", "total")
+        rate_limited = server_errors = 0
+        while True:
+            self.breaker.check()
+            self._probe_keys = keys
+            async with keys.lease(exclude=busy) as key:
+                busy.add(key.key)
+                try:
+                    async with self._get_http().stream(
+                        "POST",
+                        "/chat/completions",
+                        headers=make_headers(key.key),
+                        json=payload,
+                        timeout=self.deadlines.timeout("stream"),
+                        extensions={"trace": self.deadlines.trace("stream")},
+                    ) as resp:
+                        keys.observe(key, resp)
+                        status = resp.status_code
+                        if status < 400:
+                            self.breaker.record_success()
+                            content_type = resp.headers.get("content-type", "")
+                            if "text/event-stream" not in content_type:
+                                # Провайдер проигнорировал stream и вернул обычный JSON
+                                await resp.aread()
+                                data = resp.json()
+                                text = data["choices"][0]["message"]["content"].strip()
+                                self._record_usage(key.key, payload, data.get("usage"), text)
+                                yield text
+                                return
+                            usage: Dict[str, Any] = {}
+                            parts: List[str] = []
+                            try:
+                                async for delta in _iter_sse_deltas(resp, usage):
+                                    if time.monotonic() > deadline:
+                                        raise asyncio.TimeoutError("Превышен дедлайн потокового ответа")
+                                    parts.append(delta)
+                                    yield delta
+                            finally:
+                                # оборванный ответ тоже оплачен — считаем то, что успело прийти
+                                self._record_usage(key.key, payload, usage, "".join(parts))
+                            self.deadlines.observe("stream", "total", time.monotonic() - started)
+                            return
+                except (httpx.TransportError, asyncio.TimeoutError) as e:
+                    self._transport_failed("stream", e)
+                    raise
+                finally:
+                    busy.discard(key.key)
+
+            if status == 429:  # лимит — пул уже припарковал ключ
+                rate_limited += 1
+                if rate_limited >= max(2, len(keys)):
+                    raise KeyPoolExhausted("Все API ключи исчерпали лимит")
+                metrics.inc("ai_key_rotations")
+                continue
+
+            if status in _STREAM_REJECT_CODES:
+                self.breaker.record_success()
+                plain = {k: v for k, v in payload.items() if k != "stream_options"}
+                text = await self._post_chat(dict(plain, stream=False), keys, busy)
+                logger.warning("[API] Провайдер не поддерживает stream=True, переходим на обычные ответы")
+                self.stream_supported = False
+                yield text
+                return
+
+            if status >= 500:
+                metrics.inc("ai_server_errors")
+                self.breaker.record_failure()
+                if server_errors < AI_RETRY_5XX and await self._backoff(server_errors, deadline):
+                    server_errors += 1
+                    continue
+            else:
+                self.breaker.record_success()
+            resp.raise_for_status()
 
 # ====== Публичная функция ======
 _client = OpenAICompatibleClient(OPENAI_BASE_URL)
+# Один клиент (пул соединений) на эндпоинт; ключи выбираются по маршруту
+_clients: Dict[str, OpenAICompatibleClient] = {_client.base_url: _client}
+
+def client_for(base_url: str) -> OpenAICompatibleClient:
+    base_url = base_url.rstrip("/")
+    client = _clients.get(base_url)
+    if client is None:
+        client = _clients[base_url] = OpenAICompatibleClient(base_url)
+    return client
+
+response_cache: Optional[ResponseCache] = (
+    ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+    if RESPONSE_CACHE else None
+)
+
+_share_task: Optional[asyncio.Task] = None
+
+async def _share_key_cooldowns() -> None:
+    """Паузы ключей после 429 видны всем процессам-обработчикам (SHARD_WORKERS > 1)."""
+    while True:
+        await asyncio.sleep(SHARD_SYNC_INTERVAL)
+        try:
+            parked: Dict[str, float] = {}
+            for pool in _key_pools.values():
+                parked.update(pool.parked())
+            if parked:
+                await state_store.share_until(parked)
+            remote = await state_store.shared_until()
+            for pool in _key_pools.values():
+                pool.apply_parked(remote)
+        except Exception as e:
+            logger.warning("[API] Не удалось обменяться паузами ключей: %s", e)
+
+async def start_ai_client() -> None:
+    global _share_task
+    for route in model_registry.routes():
+        await client_for(route.base_url).start()
+    if SHARD_WORKERS > 1 and _share_task is None:
+        _share_task = asyncio.create_task(_share_key_cooldowns())
+
+async def close_ai_client() -> None:
+    global _share_task
+    if _share_task is not None:
+        _share_task.cancel()
+        await asyncio.gather(_share_task, return_exceptions=True)
+        _share_task = None
+    for client in list(_clients.values()):
+        await client.aclose()
+    if response_cache is not None:
+        response_cache.close()
+
+def ai_stats() -> Dict[str, object]:
+    """Состояние клиента ИИ для /stats и /metrics."""
+    return {
+        "keys": {group: pool.snapshot() for group, pool in _key_pools.items()},
+        "endpoints": {
+            url: {"breaker": client.breaker.stats(), "deadlines": client.deadlines.snapshot()}
+            for url, client in _clients.items()
+        },
+        "routes": latency_tracker.snapshot(),
+        "hedge": hedge_policy.stats(),
+        "cache": response_cache.stats() if response_cache is not None else {},
+    }
+
+def _prepare_messages(prompt: Union[str, List[Dict[str, str]]]) -> Optional[List[Dict[str, str]]]:
+    """Прогоняет пользовательские сообщения через фильтр; None — запрос отклонён."""
+    if isinstance(prompt, str):
+        prompt = _messages(prompt)
+    messages = []
+    with metrics.span("firewall"):
+        for msg in prompt:
+            if msg["role"] == "user":
+                result = firewall.inspect_request(msg["content"])
+                if result.blocked:
+                    return None
+                msg = {"role": "user", "content": result.text}
+            messages.append(msg)
+    return messages
+
+def _cache_key(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    settings: Optional[Dict[str, str]],
+    use_cache: bool,
+) -> Optional[str]:
+    """Ключ кэша или None, если ответ кэшировать нельзя (выключено или есть история)."""
+    if response_cache is None or not use_cache or not is_one_shot(messages):
+        return None
+    return make_cache_key(messages, model, temperature, settings)
+
+def _route_for(model: Optional[str], settings: Optional[Dict[str, str]]) -> ModelRoute:
+    """Явная модель (имя маршрута, подпись или id) или выбор пользователя из settings."""
+    if model:
+        route = model_registry.resolve(model)
+        if route is None:
+            # произвольный id модели — на эндпоинте маршрута по умолчанию, без отката
+            route = model_registry.default._replace(name=model, model=model, fallback=())
+        return route
+    return model_registry.for_settings(settings)
+
+def _prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+def _route_chat(route: ModelRoute, messages: List[Dict[str, str]], temperature: float, hedge_to=None):
+    return client_for(route.base_url).chat(
+        route.model, messages, temperature=temperature, keys=keys_for(route.key_group), hedge_to=hedge_to
+    )
+
+def _route_stream(route: ModelRoute, messages: List[Dict[str, str]], temperature: float, hedge_to=None):
+    return client_for(route.base_url).chat_stream(
+        route.model, messages, temperature=temperature, keys=keys_for(route.key_group), hedge_to=hedge_to
+    )
+
+async def _chat_routed(route: ModelRoute, messages: List[Dict[str, str]], temperature: float) -> str:
+    """Запрос по цепочке маршрутов: при ошибке или превышении бюджета задержки — следующий.
 
-async def ask_ai(user_text: str, model: str = OPENAI_MODEL, temperature: float = 0.7) -> str:
-    clean_text = sanitize_request(user_text)
-    if not is_request_safe(clean_text):
-        return "Запрос отклонён политикой безопасности."
-    return await _client.chat(model, _messages(clean_text), temperature=temperature)
+    Следующий маршрут цепочки служит и целью дубля, если у маршрута один ключ.
+    """
+    await meter.check()
+    chain = model_registry.chain(route, _prompt_tokens(messages))
+    for i, r in enumerate(chain):
+        last = i == len(chain) - 1
+        started = time.monotonic()
+        hedge_to = None if last else (lambda n=chain[i + 1]: _route_chat(n, messages, temperature))
+        try:
+            call = _route_chat(r, messages, temperature, hedge_to)
+            # на последнем маршруте ждём сколько позволяют таймауты клиента
+            text = await (call if last else asyncio.wait_for(call, r.latency_budget))
+        except Exception as e:
+            latency_tracker.observe(r.name, time.monotonic() - started, False)
+            if last:
+                raise
+            logger.warning("[API] Маршрут %s не ответил (%s), откат на %s", r.name, type(e).__name__, chain[i + 1].name)
+            continue
+        latency_tracker.observe(r.name, time.monotonic() - started, True)
+        metrics.observe("ai_request", time.monotonic() - started)
+        return text
+    raise RuntimeError("Нет доступных маршрутов")
+
+async def _stream_routed(
+    route: ModelRoute, messages: List[Dict[str, str]], temperature: float
+) -> AsyncIterator[str]:
+    """Потоковый вариант: откат возможен, только пока пользователю ничего не отдано."""
+    await meter.check()
+    chain = model_registry.chain(route, _prompt_tokens(messages))
+    for i, r in enumerate(chain):
+        last = i == len(chain) - 1
+        started = time.monotonic()
+        delivered = False
+        hedge_to = None if last else (lambda n=chain[i + 1]: _route_stream(n, messages, temperature))
+        try:
+            async for delta in _route_stream(r, messages, temperature, hedge_to):
+                if not delivered:
+                    delivered = True
+                    metrics.observe("ai_first_token", time.monotonic() - started)
+                yield delta
+        except Exception as e:
+            latency_tracker.observe(r.name, time.monotonic() - started, False)
+            if last or delivered:
+                raise
+            logger.warning("[API] Маршрут %s не ответил (%s), откат на %s", r.name, type(e).__name__, chain[i + 1].name)
+            continue
+        latency_tracker.observe(r.name, time.monotonic() - started, True)
+        metrics.observe("ai_request", time.monotonic() - started)
+        return
+
+async def ask_ai(
+    prompt: Union[str, List[Dict[str, str]]],
+    model: Optional[str] = None,
+    temperature: float = 0.7,
+    *,
+    settings: Optional[Dict[str, str]] = None,
+    use_cache: bool = True,
+) -> str:
+    """prompt — текст одного сообщения или готовый список messages (см. build_context).
+
+    Модель берётся из реестра: явный model или выбор пользователя в settings
+    (lang/spec из settings также входят в ключ кэша ответов).
+    """
+    messages = _prepare_messages(prompt)
+    if messages is None:
+        return REQUEST_REJECTED
+    route = _route_for(model, settings)
+    key = _cache_key(messages, route.name, temperature, settings, use_cache)
+    if key is None:
+        return await _chat_routed(route, messages, temperature)
+    return await response_cache.get_or_call(
+        key, lambda: _chat_routed(route, messages, temperature)
+    )
+
+async def ask_ai_stream(
+    prompt: Union[str, List[Dict[str, str]]],
+    model: Optional[str] = None,
+    temperature: float = 0.7,
+    *,
+    settings: Optional[Dict[str, str]] = None,
+    use_cache: bool = True,
+) -> AsyncIterator[str]:
+    messages = _prepare_messages(prompt)
+    if messages is None:
+        yield REQUEST_REJECTED
+        return
+
+    route = _route_for(model, settings)
+    key = _cache_key(messages, route.name, temperature, settings, use_cache)
+    if key is not None:
+        cached = await response_cache.join(key)
+        if cached is not None:
+            yield cached
+            return
+
+    if key is None:
+        async for delta in _stream_routed(route, messages, temperature):
+            yield delta
+        return
+
+    # как в ask_ai: одинаковые запросы, пришедшие во время потока, ждут его целиком
+    future = response_cache.begin(key)
+    parts = []
+    try:
+        async for delta in _stream_routed(route, messages, temperature):
+            parts.append(delta)
+            yield delta
+    except BaseException as e:
+        response_cache.fail(key, future, e)
+        raise
+    await response_cache.finish(key, future, "".join(parts).strip())
@@ -0,0 +1,280 @@
+"""Отказоустойчивость клиента ИИ: адаптивные дедлайны, предохранитель, повторы 5xx.
+
+Дедлайны. Для каждого эндпоинта и вида запроса (chat/stream) копятся
+длительности фаз: установка соединения, время до заголовков ответа (TTFB)
+и весь запрос. Бюджет фазы — перцентиль × множитель, зажатый между
+минимумом и статическими AI_CONNECT_TIMEOUT / AI_READ_TIMEOUT / AI_TIMEOUT
+(они же действуют, пока статистики мало). Таймаут засчитывается как
+наблюдение со значением бюджета, иначе при деградации бюджет бы не рос.
+
+Предохранитель. После failure_threshold подряд ошибок эндпоинта (5xx,
+обрывы, таймауты) цепь размыкается: запросы сразу получают
+CircuitOpenError, а фоновая проба (GET /models) раз в reset_timeout
+проверяет, ожил ли эндпоинт; пауза удваивается до max_reset_timeout.
+Ключи с серией ошибок паркуются в KeyPool тем же способом, что и после 429.
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from src.ai_providers.key_pool import KeyPoolExhausted
+from src.ai_providers.latency import LatencyTracker
+from src.ai_providers.usage import BudgetExceeded
+from src.utils.metrics import metrics
+from src.config import (
+    AI_TIMEOUT,
+    AI_CONNECT_TIMEOUT,
+    AI_READ_TIMEOUT,
+    AI_WRITE_TIMEOUT,
+    AI_POOL_TIMEOUT,
+    AI_DEADLINE_QUANTILE,
+    AI_DEADLINE_MULTIPLIER,
+    AI_DEADLINE_MIN_CONNECT,
+    AI_DEADLINE_MIN_TTFB,
+    AI_DEADLINE_MIN_TOTAL,
+    AI_BREAKER_FAILURES,
+    AI_BREAKER_RESET,
+    AI_BREAKER_MAX_RESET,
+    AI_RETRY_BASE_DELAY,
+    AI_RETRY_MAX_DELAY,
+)
+
+logger = logging.getLogger(__name__)
+
+# Пока наблюдений меньше — используем статические таймауты
+_MIN_SAMPLES = 20
+
+
+class CircuitOpenError(RuntimeError):
+    """Эндпоинт признан недоступным; запрос не отправлялся."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} временно недоступен (повтор через {retry_in:.0f} с)")
+        self.retry_in = retry_in
+
+
+def is_failure(exc: BaseException) -> bool:
+    """Ошибка, которая говорит о нездоровье эндпоинта, а не о плохом запросе."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def backoff_delay(attempt: int, base: float = AI_RETRY_BASE_DELAY, cap: float = AI_RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная пауза с полным джиттером: U(0, min(cap, base·2^attempt))."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# ====== Адаптивные дедлайны ======
+class _PhaseTrace:
+    """trace-колбэк httpcore: меряет установку соединения и время до заголовков."""
+
+    __slots__ = ("deadlines", "key", "started", "connect_started", "connect_done")
+
+    def __init__(self, deadlines: "AdaptiveDeadlines", key: str):
+        self.deadlines = deadlines
+        self.key = key
+        self.started = time.monotonic()
+        self.connect_started = 0.0
+        self.connect_done = 0.0
+
+    async def __call__(self, event: str, info: dict) -> None:
+        if event == "connection.connect_tcp.started":
+            self.connect_started = time.monotonic()
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connect_done = time.monotonic()
+        elif event.endswith("receive_response_headers.complete"):
+            now = time.monotonic()
+            if self.connect_started and self.connect_done:
+                self.deadlines.observe(self.key, "connect", self.connect_done - self.connect_started)
+                metrics.observe("ai_connect", self.connect_done - self.connect_started)
+            self.deadlines.observe(self.key, "ttfb", now - self.started)
+            metrics.observe("ai_ttfb", now - self.started)
+
+
+class AdaptiveDeadlines:
+    def __init__(
+        self,
+        quantile: float = 0.99,
+        multiplier: float = 3.0,
+        floors: Optional[Dict[str, float]] = None,
+        ceilings: Optional[Dict[str, float]] = None,
+        window: int = 200,
+    ):
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.floors = floors or {"connect": 1.0, "ttfb": 5.0, "total": 15.0}
+        self.ceilings = ceilings or {"connect": 10.0, "ttfb": 60.0, "total": 60.0}
+        self.tracker = LatencyTracker(window)
+        self.timeouts = 0
+
+    def budget(self, key: str, phase: str) -> float:
+        stats = self.tracker.get(f"{key} {phase}")
+        ceiling = self.ceilings[phase]
+        if len(stats.samples) < _MIN_SAMPLES:
+            return ceiling
+        return min(ceiling, max(self.floors[phase], stats.percentile(self.quantile) * self.multiplier))
+
+    def observe(self, key: str, phase: str, seconds: float) -> None:
+        self.tracker.observe(f"{key} {phase}", seconds, True)
+
+    def timed_out(self, key: str, exc: BaseException) -> None:
+        """Таймаут — наблюдение, равное бюджету фазы (цензурированное снизу)."""
+        self.timeouts += 1
+        if isinstance(exc, httpx.ConnectTimeout):
+            phase = "connect"
+        elif isinstance(exc, httpx.TimeoutException):
+            phase = "ttfb"
+        else:
+            phase = "total"
+        self.observe(key, phase, self.budget(key, phase))
+
+    def timeout(self, key: str) -> httpx.Timeout:
+        """Таймауты httpx на один запрос: read ограничивает ожидание первого байта и паузы в потоке."""
+        return httpx.Timeout(
+            self.budget(key, "total"),
+            connect=self.budget(key, "connect"),
+            read=self.budget(key, "ttfb"),
+            write=AI_WRITE_TIMEOUT,
+            pool=AI_POOL_TIMEOUT,
+        )
+
+    def trace(self, key: str) -> _PhaseTrace:
+        return _PhaseTrace(self, key)
+
+    def snapshot(self) -> Dict[str, float]:
+        keys = {name.rsplit(" ", 1)[0] for name in self.tracker.snapshot()}
+        return {
+            f"{key} {phase}": round(self.budget(key, phase), 2)
+            for key in sorted(keys)
+            for phase in ("connect", "ttfb", "total")
+        }
+
+
+# ====== Предохранитель ======
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"  # идёт фоновая проба
+
+    def __init__(
+        self,
+        name: str,
+        probe: Callable[[], Awaitable[bool]],
+        failure_threshold: int = 5,
+        reset_timeout: float = 15.0,
+        max_reset_timeout: float = 120.0,
+    ):
+        self.name = name
+        self._probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self._probe_task: Optional[asyncio.Task] = None
+        self.opened = 0
+        self.rejected = 0
+
+    def check(self) -> None:
+        """Бросает CircuitOpenError, пока цепь разомкнута."""
+        if self.state == self.CLOSED:
+            return
+        self.rejected += 1
+        raise CircuitOpenError(self.name, max(1.0, self.open_until - time.monotonic()))
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self.state != self.CLOSED:
+            self._close()
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened += 1
+            self.open_until = time.monotonic() + self.reset_timeout
+            logger.warning("[API] %s: %d ошибок подряд, цепь разомкнута", self.name, self.failures)
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    def _close(self) -> None:
+        logger.info("[API] %s снова доступен", self.name)
+        self.state = self.CLOSED
+        self.failures = 0
+        if self._probe_task is not None and self._probe_task is not asyncio.current_task():
+            self._probe_task.cancel()
+        self._probe_task = None
+
+    async def _probe_loop(self) -> None:
+        delay = self.reset_timeout
+        while self.state != self.CLOSED:
+            await asyncio.sleep(max(0.0, self.open_until - time.monotonic()))
+            self.state = self.HALF_OPEN
+            try:
+                healthy = await self._probe()
+            except Exception as e:
+                logger.debug("[API] %s: проба не прошла: %s", self.name, e)
+                healthy = False
+            if healthy:
+                self._close()
+                return
+            delay = min(self.max_reset_timeout, delay * 2)
+            self.state = self.OPEN
+            self.open_until = time.monotonic() + delay
+
+    async def aclose(self) -> None:
+        task, self._probe_task = self._probe_task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_in": round(max(0.0, self.open_until - time.monotonic()), 1) if self.state != self.CLOSED else 0,
+        }
+
+
+def make_deadlines() -> AdaptiveDeadlines:
+    return AdaptiveDeadlines(
+        quantile=AI_DEADLINE_QUANTILE,
+        multiplier=AI_DEADLINE_MULTIPLIER,
+        floors={"connect": AI_DEADLINE_MIN_CONNECT, "ttfb": AI_DEADLINE_MIN_TTFB, "total": AI_DEADLINE_MIN_TOTAL},
+        ceilings={"connect": AI_CONNECT_TIMEOUT, "ttfb": AI_READ_TIMEOUT, "total": float(AI_TIMEOUT)},
+    )
+
+
+def make_breaker(name: str, probe: Callable[[], Awaitable[bool]]) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        probe,
+        failure_threshold=AI_BREAKER_FAILURES,
+        reset_timeout=AI_BREAKER_RESET,
+        max_reset_timeout=AI_BREAKER_MAX_RESET,
+    )
+
+
+# ====== Сообщение пользователю ======
+def describe_error(exc: BaseException) -> str:
+    """Понятный пользователю текст вместо сырого исключения."""
+    if isinstance(exc, CircuitOpenError):
+        return f"⏳ ИИ временно недоступен. Попробуйте через {max(1, round(exc.retry_in))} с."
+    if isinstance(exc, BudgetExceeded):
+        hours = exc.retry_in / 3600
+        when = f"{max(1, round(hours))} ч" if hours < 48 else f"{round(hours / 24)} дн"
+        return f"⛔ {exc}. Лимит обновится через {when}, расход — /usage."
+    if isinstance(exc, KeyPoolExhausted):
+        return "⏳ ИИ сейчас перегружен. Попробуйте через минуту."
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "⌛ ИИ не ответил вовремя. Попробуйте ещё раз."
+    if is_failure(exc):
+        return "⚠ Сервис ИИ временно недоступен. Попробуйте позже."
+    return "⚠ Не удалось получить ответ ИИ. Попробуйте ещё раз."
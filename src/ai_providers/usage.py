@@ -0,0 +1,241 @@
+"""Учёт токенов: кто и через какой ключ их тратит, бюджеты пользователей.
+
+Каждый ответ провайдера записывается в счётчики трёх разрезов — ключ
+(отпечаток KeyPool.fingerprint), модель и пользователь — за текущие сутки
+и месяц (UTC). Токены берутся из поля usage ответа; если его нет
+(провайдер не прислал, стрим без stream_options, оборванный ответ) —
+локальная оценка estimate_tokens, такие записи считаются в stats().
+
+Пользователь запроса передаётся через contextvar current_user: обработчик
+ставит его перед обращением к ИИ, и он доходит до клиента через все
+маршруты, дубли и фоновые задачи, созданные в этом контексте (конспект
+тоже списывается с пользователя).
+
+Приращения копятся в памяти и раз в flush_interval уходят в SQLite одной
+транзакцией (таблица usage, сложение на стороне базы — безопасно и для
+нескольких процессов). Бюджеты проверяются до отправки запроса: сохранённое
+значение читается один раз на пользователя и период, дальше к нему
+прибавляется локальный расход.
+"""
+import asyncio
+import calendar
+import logging
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.config import (
+    ADMIN_USERS,
+    USAGE_DAILY_TOKENS,
+    USAGE_MONTHLY_TOKENS,
+    USAGE_FLUSH_INTERVAL,
+)
+from src.utils.metrics import metrics
+from src.utils.state_store import state_store
+
+logger = logging.getLogger(__name__)
+
+# user_id, от имени которого идут запросы к ИИ в текущем контексте
+current_user: ContextVar[Optional[int]] = ContextVar("usage_user", default=None)
+
+Counter3 = List[int]  # [prompt, completion, requests]
+CounterKey = Tuple[str, str, str]  # (scope, name, period)
+
+_PERIOD_NAMES = {"day": "дневной", "month": "месячный"}
+
+
+class BudgetExceeded(RuntimeError):
+    """Бюджет токенов пользователя на период исчерпан."""
+
+    def __init__(self, period: str, limit: int, retry_in: float):
+        super().__init__(f"Исчерпан {_PERIOD_NAMES.get(period, period)} лимит токенов ({limit})")
+        self.period = period
+        self.limit = limit
+        self.retry_in = retry_in
+
+
+def periods(now: Optional[float] = None) -> Tuple[str, str]:
+    """Текущие сутки и месяц по UTC: ("2026-10-18", "2026-10")."""
+    t = time.gmtime(time.time() if now is None else now)
+    return time.strftime("%Y-%m-%d", t), time.strftime("%Y-%m", t)
+
+
+def seconds_until_reset(period: str, now: Optional[float] = None) -> float:
+    now = time.time() if now is None else now
+    t = time.gmtime(now)
+    if period == "day":
+        start = calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0)) + 86400
+    else:
+        year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+        start = calendar.timegm((year, month, 1, 0, 0, 0))
+    return max(0.0, start - now)
+
+
+class UsageMeter:
+    def __init__(
+        self,
+        store=None,
+        daily_tokens: int = USAGE_DAILY_TOKENS,
+        monthly_tokens: int = USAGE_MONTHLY_TOKENS,
+        flush_interval: float = USAGE_FLUSH_INTERVAL,
+        exempt: Iterable[int] = (),
+    ):
+        self.store = store
+        self.budgets = {"day": daily_tokens, "month": monthly_tokens}
+        self.flush_interval = flush_interval
+        self.exempt = frozenset(exempt)
+        # ещё не записанные приращения
+        self._pending: Dict[CounterKey, Counter3] = {}
+        # полный расход пользователя за период: сохранённый + локальный
+        self._users: Dict[Tuple[int, str], Counter3] = {}
+        self._loading: Dict[Tuple[int, str], asyncio.Future] = {}
+        # с момента запуска процесса, для /stats
+        self._since_start: Dict[Tuple[str, str], Counter3] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.requests = 0
+        self.estimated = 0
+        self.rejected = 0
+
+    # ====== Запись ======
+    @staticmethod
+    def _add(table: dict, key, prompt: int, completion: int, requests: int = 1) -> None:
+        counter = table.get(key)
+        if counter is None:
+            table[key] = [prompt, completion, requests]
+        else:
+            counter[0] += prompt
+            counter[1] += completion
+            counter[2] += requests
+
+    def record(self, key: str, model: str, prompt: int, completion: int, estimated: bool = False) -> None:
+        """Расход одного ответа провайдера; пользователь — из current_user."""
+        user_id = current_user.get()
+        day, month = periods()
+        names = [("key", key), ("model", model)]
+        if user_id is not None:
+            names.append(("user", str(user_id)))
+            for label in (day, month):
+                counter = self._users.get((user_id, label))
+                if counter is not None:
+                    counter[0] += prompt
+                    counter[1] += completion
+                    counter[2] += 1
+        for scope, name in names:
+            for label in (day, month):
+                self._add(self._pending, (scope, name, label), prompt, completion)
+            if scope != "user":
+                self._add(self._since_start, (scope, name), prompt, completion)
+        self.requests += 1
+        if estimated:
+            self.estimated += 1
+        metrics.inc("ai_prompt_tokens", prompt)
+        metrics.inc("ai_completion_tokens", completion)
+
+    # ====== Расход пользователя и бюджеты ======
+    async def _user_counter(self, user_id: int, label: str) -> Counter3:
+        key = (user_id, label)
+        counter = self._users.get(key)
+        if counter is not None:
+            return counter
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            # под замком сброса: приращение не окажется одновременно в базе и в _pending
+            async with self._flush_lock:
+                saved = (0, 0, 0)
+                if self.store is not None:
+                    saved = (await self.store.usage("user", str(user_id), [label])).get(label, saved)
+                counter = list(saved)
+                extra = self._pending.get(("user", str(user_id), label))
+                if extra is not None:
+                    counter = [a + b for a, b in zip(counter, extra)]
+                counter = self._users.setdefault(key, counter)
+            future.set_result(counter)
+            return counter
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(key, None)
+
+    async def user_usage(self, user_id: int) -> Dict[str, Counter3]:
+        """{"day": [prompt, completion, requests], "month": [...]} за текущие сутки и месяц."""
+        day, month = periods()
+        return {"day": await self._user_counter(user_id, day), "month": await self._user_counter(user_id, month)}
+
+    async def check(self) -> None:
+        """BudgetExceeded, если пользователь текущего контекста исчерпал бюджет."""
+        user_id = current_user.get()
+        if user_id is None or user_id in self.exempt or not any(self.budgets.values()):
+            return
+        used = await self.user_usage(user_id)
+        for period, limit in self.budgets.items():
+            if limit and used[period][0] + used[period][1] >= limit:
+                self.rejected += 1
+                raise BudgetExceeded(period, limit, seconds_until_reset(period))
+
+    # ====== Запись на диск ======
+    async def start(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить счётчики токенов")
+
+    async def flush(self) -> None:
+        """Записывает накопленные приращения одной транзакцией."""
+        async with self._flush_lock:
+            if not self._pending or self.store is None:
+                return
+            flushing, self._pending = self._pending, {}
+            rows = [(scope, name, label, *counter) for (scope, name, label), counter in flushing.items()]
+            try:
+                await self.store.add_usage(rows)
+            except BaseException:
+                # вернём приращения, чтобы записать их в следующий раз
+                for key, counter in flushing.items():
+                    self._add(self._pending, key, *counter)
+                raise
+            # счётчики прошлых суток и месяцев больше не понадобятся
+            day, month = periods()
+            for key in [k for k in self._users if k[1] not in (day, month)]:
+                del self._users[key]
+
+    def stats(self) -> Dict[str, object]:
+        def totals(scope: str) -> Dict[str, Dict[str, int]]:
+            return {
+                name: {"prompt": c[0], "completion": c[1], "requests": c[2]}
+                for (s, name), c in self._since_start.items() if s == scope
+            }
+
+        return {
+            "requests": self.requests,
+            "estimated": self.estimated,
+            "rejected": self.rejected,
+            "pending": len(self._pending),
+            "keys": totals("key"),
+            "models": totals("model"),
+        }
+
+
+meter = UsageMeter(state_store, exempt=ADMIN_USERS)
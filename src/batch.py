@@ -0,0 +1,242 @@
+"""Пакетный прогон промптов через тот же клиент ИИ, что и в боте.
+
+Вход — JSONL, по объекту на строку:
+
+    {"id": "greet-1", "prompt": "Привет!"}
+    {"id": "long", "messages": [{"role": "user", "content": "..."}], "model": "fast", "lang": "Русский"}
+
+id необязателен (по умолчанию — номер строки). prompt идёт с SYSTEM_PROMPT,
+как сообщение пользователя в боте; messages — как есть. model,
+temperature, lang и spec — те же, что в ask_ai и настройках пользователя.
+Запросы проходят фильтр, реестр моделей, пул ключей и откаты маршрутов;
+ответ чистится firewall.clean_response, с --html добавляется разметка
+Telegram, нарезанная на сообщения.
+
+Вход читается потоком, одновременно выполняется не больше --concurrency
+запросов. Каждый результат сразу дописывается строкой в выход. При
+повторном запуске с тем же выходом id, у которых уже есть успешный
+результат, пропускаются; неудачные пробуются снова (в файле остаются обе
+строки, действует последняя).
+
+В конце — отчёт: запросов и токенов в секунду, ошибки по видам, p50/p95/p99.
+Токены — из usage ответов провайдера (src/ai_providers/usage.py; без usage —
+локальная оценка, их число в estimated_usage). Счётчики по ключам и моделям
+сохраняются в ту же базу STATE_DB_PATH, что и у бота.
+
+    python -m src.batch prompts.jsonl results.jsonl --concurrency 16
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 python -m src.batch bench/prompts_sample.jsonl /tmp/out.jsonl --json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import httpx
+
+from src.ai_providers.openai_compatible import REQUEST_REJECTED, ask_ai, close_ai_client, start_ai_client
+from src.ai_providers.usage import meter
+from src.utils.firewall import firewall
+from src.utils.state_store import state_store
+from src.utils.tg_html import render_blocks, split_messages
+from src.config import TG_MAX_MESSAGE_LEN
+
+logger = logging.getLogger(__name__)
+
+
+# ====== Вход и выход ======
+def read_jobs(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """(id, задание) по строкам файла; пустые строки пропускаются."""
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if "prompt" not in job and "messages" not in job:
+                raise ValueError(f"{path}:{number}: нужен prompt или messages")
+            yield str(job.get("id", number)), job
+
+
+def done_ids(path: str) -> Set[str]:
+    """id с успешным результатом в уже существующем выходе."""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # строка, оборванная прерыванием
+            if record.get("ok"):
+                done.add(str(record["id"]))
+            else:
+                done.discard(str(record.get("id")))
+    return done
+
+
+def error_kind(exc: BaseException) -> str:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"http_{exc.response.status_code}"
+    return type(exc).__name__
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# ====== Прогон ======
+class BatchRunner:
+    def __init__(self, out, concurrency: int = 8, html: bool = False, use_cache: bool = False):
+        self.out = out
+        self.concurrency = concurrency
+        self.html = html
+        self.use_cache = use_cache
+        self.latencies: List[float] = []
+        self.errors: Counter = Counter()
+        self.ok = 0
+        self.skipped = 0
+
+    async def run_one(self, job_id: str, job: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = job.get("messages") or job["prompt"]
+        settings = {k: job[k] for k in ("lang", "spec") if k in job} or None
+        lang = job.get("lang", "")
+        record: Dict[str, Any] = {"id": job_id}
+        started = time.perf_counter()
+        try:
+            text = await ask_ai(
+                prompt,
+                model=job.get("model"),
+                temperature=float(job.get("temperature", 0.7)),
+                settings=settings,
+                use_cache=self.use_cache,
+            )
+        except Exception as e:
+            kind = error_kind(e)
+            self.errors[kind] += 1
+            record.update(ok=False, error=kind, detail=str(e)[:300])
+        else:
+            elapsed = time.perf_counter() - started
+            if text == REQUEST_REJECTED:
+                self.errors["rejected"] += 1
+                record.update(ok=False, error="rejected")
+            else:
+                self.ok += 1
+                self.latencies.append(elapsed)
+                record.update(ok=True, text=text, clean=firewall.clean_response(text, lang))
+                if self.html:
+                    record["html"] = split_messages(render_blocks(record["clean"]), TG_MAX_MESSAGE_LEN)
+        record["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return record
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # строка на диске до следующего результата: прерывание теряет только незаконченные
+        self.out.flush()
+
+    async def run(self, jobs: Iterator[Tuple[str, Dict[str, Any]]], skip: Set[str]) -> None:
+        # очередь ограничена: файл читается по мере выполнения, а не целиком
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * self.concurrency)
+
+        async def worker() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                self.write(await self.run_one(*item))
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for job_id, job in jobs:
+                if job_id in skip:
+                    self.skipped += 1
+                    continue
+                await queue.put((job_id, job))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def report(self, elapsed: float) -> Dict[str, object]:
+        failed = sum(self.errors.values())
+        usage = meter.stats()
+        prompt_tokens = sum(m["prompt"] for m in usage["models"].values())
+        completion_tokens = sum(m["completion"] for m in usage["models"].values())
+        return {
+            "requests": self.ok + failed,
+            "ok": self.ok,
+            "failed": failed,
+            "skipped": self.skipped,
+            "errors": dict(self.errors.most_common()),
+            "seconds": round(elapsed, 2),
+            "requests_s": round((self.ok + failed) / elapsed, 2) if elapsed else 0.0,
+            "tokens_s": round((prompt_tokens + completion_tokens) / elapsed, 1) if elapsed else 0.0,
+            "completion_tokens_s": round(completion_tokens / elapsed, 1) if elapsed else 0.0,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "estimated_usage": usage["estimated"],
+            "latency_p50_ms": round(percentile(self.latencies, 0.5) * 1000, 1),
+            "latency_p95_ms": round(percentile(self.latencies, 0.95) * 1000, 1),
+            "latency_p99_ms": round(percentile(self.latencies, 0.99) * 1000, 1),
+        }
+
+
+async def run(args) -> Dict[str, object]:
+    skip = set() if args.restart else done_ids(args.output)
+    mode = "w" if args.restart else "a"
+    await start_ai_client()
+    started = time.perf_counter()
+    with open(args.output, mode, encoding="utf-8") as out:
+        runner = BatchRunner(out, args.concurrency, html=args.html, use_cache=args.cache)
+        try:
+            await runner.run(read_jobs(args.input), skip)
+        except asyncio.CancelledError:
+            # Ctrl+C: готовые строки уже в файле, следующий запуск продолжит с места остановки
+            logger.warning("Прервано; повторный запуск с тем же выходом продолжит прогон")
+        finally:
+            await close_ai_client()
+            await meter.close()
+            await state_store.close()
+    return runner.report(time.perf_counter() - started)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.batch", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", help="JSONL с промптами")
+    parser.add_argument("output", help="JSONL с результатами (дописывается)")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных запросов")
+    parser.add_argument("--html", action="store_true", help="добавить разметку Telegram (поле html)")
+    parser.add_argument("--cache", action="store_true", help="использовать кэш ответов (RESPONSE_CACHE)")
+    parser.add_argument("--restart", action="store_true", help="перезаписать выход и прогнать всё заново")
+    parser.add_argument("--json", action="store_true", help="отчёт одной строкой JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+    # строка лога на каждый HTTP-запрос утопила бы отчёт
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    try:
+        report = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        return 130
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for key, value in report.items():
+            print(f"{key:22s} {value}")
+    return 0 if not report["failed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from telegram import (
@@ -8,9 +9,25 @@ from telegram.ext import (
 
 )
 
-from src.handlers.commands import register_handlers
+from src.handlers.commands import menu, register_handlers, turn_coalescer
+from src.ai_providers.openai_compatible import ai_stats, start_ai_client, close_ai_client
+from src.ai_providers.usage import meter
+from src.utils.access import access
+from src.utils.http_server import HttpServer
+from src.utils.memory import user_memory
+from src.utils.metrics import TimedHTTPXRequest, metrics, prometheus_handler
+from src.utils.recall import recall
+from src.utils.send_scheduler import send_scheduler
+from src.utils.sharding import run_sharded
+from src.utils.state_store import state_store
+from src.utils.summarizer import summarizer
+from src.utils.update_processor import OrderedUpdateProcessor
+from src.utils.webhook import run_webhook
 
-from src.config import TELEGRAM_BOT_TOKEN
+from src.config import (
+    TELEGRAM_BOT_TOKEN, TELEGRAM_API_BASE_URL, STATE_IMPORT_FILE, UPDATE_CONCURRENCY,
+    UPDATE_FAST_CONCURRENCY, BOT_MODE, SHUTDOWN_DRAIN_TIMEOUT, METRICS_HOST, METRICS_PORT, SHARD_WORKERS,
+)
 
 
 # Логирование
@@ -20,15 +37,97 @@ logging.basicConfig(
 )
 logger = logging.getLogger("tg-ai-bot")
 
+_metrics_server = None
 
-def main():
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+
+async def on_startup(app):
+    # Открываем общий пул соединений к провайдеру ИИ
+    await start_ai_client()
+    # Хранилище состояния; старый settings.json импортируется один раз
+    await state_store.start()
+    await meter.start()
+    if STATE_IMPORT_FILE:
+        await state_store.import_settings_json(STATE_IMPORT_FILE)
+    # Метрики для Prometheus — отдельный локальный порт
+    global _metrics_server
+    if METRICS_PORT:
+        _metrics_server = HttpServer(METRICS_HOST, METRICS_PORT)
+        _metrics_server.route("GET", "/metrics", prometheus_handler)
+        await _metrics_server.start()
+        logger.info("Метрики: http://%s:%d/metrics", METRICS_HOST, _metrics_server.port)
+
+
+async def on_stop(app):
+    # Бот ещё может отправлять сообщения: даём начатым ответам ИИ дойти
+    await turn_coalescer.drain(SHUTDOWN_DRAIN_TIMEOUT)
+
+
+async def on_shutdown(app):
+    if _metrics_server is not None:
+        await _metrics_server.close()
+    await turn_coalescer.close()
+    await summarizer.close()
+    recall.close()
+    await close_ai_client()
+    # Сбрасываем несохранённые изменения на диск
+    await meter.close()
+    await state_store.close()
+
+
+def register_metrics(app, processor):
+    """Снимки состояния компонентов для /stats и /metrics."""
+    metrics.collect("update_queue", lambda: {"size": app.update_queue.qsize()})
+    metrics.collect("updates", processor.stats)
+    metrics.collect("turns", turn_coalescer.stats)
+    metrics.collect("memory", user_memory.stats)
+    metrics.collect("access", access.stats)
+    metrics.collect("summary", summarizer.stats)
+    metrics.collect("recall", recall.stats)
+    metrics.collect("ai", ai_stats)
+    metrics.collect("usage", meter.stats)
+    metrics.collect("menu", menu.stats)
+    if send_scheduler is not None:
+        metrics.collect("send", send_scheduler.stats)
+
+
+def build_app():
+    # Пользователи обрабатываются параллельно, сообщения одного — по порядку
+    processor = OrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_FAST_CONCURRENCY)
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        # Каждый вызов Bot API (кроме getUpdates) попадает в гистограмму telegram_send
+        .request(TimedHTTPXRequest(connection_pool_size=256))
+        .concurrent_updates(processor)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if send_scheduler is not None:
+        # Все отправки — через очередь с лимитами Telegram
+        builder.rate_limiter(send_scheduler)
+    app = builder.build()
 
     # Регистрируем хендлеры централизованно
     register_handlers(app)
+    register_metrics(app, processor)
+    return app
+
 
-    logger.info("Бот запущен. Ожидаю сообщения...")
-    app.run_polling()
+def main():
+    if SHARD_WORKERS > 1:
+        # Приёмник апдейтов в этом процессе, обработка — в SHARD_WORKERS процессах
+        logger.info("Бот запущен в %d процессах (%s)", SHARD_WORKERS, BOT_MODE)
+        asyncio.run(run_sharded(SHARD_WORKERS))
+        return
+    app = build_app()
+    if BOT_MODE == "webhook":
+        logger.info("Бот запущен в режиме вебхука")
+        asyncio.run(run_webhook(app))
+    else:
+        logger.info("Бот запущен. Ожидаю сообщения...")
+        app.run_polling()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,38 @@
+import logging
 import os
+import re
 from dotenv import load_dotenv
 
 load_dotenv()  # загрузит .env из корня репозитория
 
-ALLOWED_USERS = list(map(int, os.getenv("ALLOWED_USERS", "").split(",")))
+logger = logging.getLogger(__name__)
+
+_ID_SEPARATORS_RE = re.compile(r"[\s,;{}\[\]]+")
+_ID_RE = re.compile(r"-?\d+")
+
+
+def env_ids(key: str) -> frozenset:
+    """Множество id: "123,4325", "123 4325" и "{123, 4325}" читаются одинаково.
+
+    Элемент, не похожий на id, пропускается с предупреждением в логе —
+    иначе опечатка молча оставила бы белый список пустым.
+    """
+    ids = set()
+    for token in _ID_SEPARATORS_RE.split(os.getenv(key, "")):
+        if not token:
+            continue
+        if _ID_RE.fullmatch(token):
+            ids.add(int(token))
+        else:
+            logger.warning("%s: пропущен элемент %r — ожидаются числовые id через запятую", key, token)
+    return frozenset(ids)
+
+
+# Множество id: проверка доступа O(1)
+ALLOWED_USERS = env_ids("ALLOWED_USERS")
+
+# Администраторы: команда /stats
+ADMIN_USERS = env_ids("ADMIN_USERS")
 
 # 996208453 - main
 # 580510842 - Ali
@@ -42,13 +71,163 @@ def env_int(key: str, default: int) -> int:
     except ValueError:
         return default
 
+def env_bool(key: str, default: bool) -> bool:
+    val = os.getenv(key)
+    if val is None or val.strip() == "":
+        return default
+    return val.strip().lower() in ("1", "true", "yes", "on")
+
 TELEGRAM_BOT_TOKEN = env_str("TELEGRAM_BOT_TOKEN", required=True)
+# Адрес Bot API (к нему дописывается токен); для тестов — локальная заглушка
+TELEGRAM_API_BASE_URL = env_str("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
 API_KEY = env_str("OPENAI_API_KEYS", required=True)
 BASE_URL = env_str("BASE_URL", "https://api.groq.com/openai/v1")
 MODEL = env_str("MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
 TEMPERATURE = env_float("TEMPERATURE", 0.7)
 MAX_HISTORY_CHARS = env_int("MAX_HISTORY_CHARS", 12000)
+# Бюджет входных токенов на запрос (оценивается локально)
+MAX_CONTEXT_TOKENS = env_int("MAX_CONTEXT_TOKENS", MAX_HISTORY_CHARS // 4)
 
 TG_MAX_MESSAGE_LEN = 4096
 
+# HTTP-пул клиента ИИ (одно долгоживущее соединение на процесс)
+AI_CONNECT_TIMEOUT = env_float("AI_CONNECT_TIMEOUT", 10.0)
+AI_READ_TIMEOUT = env_float("AI_READ_TIMEOUT", float(AI_TIMEOUT))
+AI_WRITE_TIMEOUT = env_float("AI_WRITE_TIMEOUT", 10.0)
+AI_POOL_TIMEOUT = env_float("AI_POOL_TIMEOUT", 10.0)
+AI_HTTP2 = env_bool("AI_HTTP2", True)
+AI_MAX_CONNECTIONS = env_int("AI_MAX_CONNECTIONS", 100)
+AI_MAX_KEEPALIVE = env_int("AI_MAX_KEEPALIVE", 20)
+AI_KEEPALIVE_EXPIRY = env_float("AI_KEEPALIVE_EXPIRY", 30.0)
+
+# Пул API-ключей
+AI_KEY_MAX_IN_FLIGHT = env_int("AI_KEY_MAX_IN_FLIGHT", 8)  # параллельных запросов на один ключ
+AI_KEY_ACQUIRE_TIMEOUT = env_float("AI_KEY_ACQUIRE_TIMEOUT", 10.0)  # сколько ждать свободный ключ
+AI_KEY_DEFAULT_COOLDOWN = env_float("AI_KEY_DEFAULT_COOLDOWN", 2.0)  # пауза после 429 без Retry-After
+
+# Кэш ответов для одиночных вопросов без истории
+RESPONSE_CACHE = env_bool("RESPONSE_CACHE", False)
+RESPONSE_CACHE_MAX_BYTES = env_int("RESPONSE_CACHE_MAX_BYTES", 8 * 1024 * 1024)
+RESPONSE_CACHE_TTL = env_float("RESPONSE_CACHE_TTL", 3600.0)
+RESPONSE_CACHE_DB = env_str("RESPONSE_CACHE_DB", "")  # путь к SQLite; пусто — только память
+
+# Фильтр запросов: JSON с правилами, перечитывается без перезапуска
+FIREWALL_RULES_FILE = env_str("FIREWALL_RULES_FILE", "")
+FIREWALL_RELOAD_INTERVAL = env_float("FIREWALL_RELOAD_INTERVAL", 5.0)
+
+# Хранилище состояния пользователей (SQLite WAL)
+STATE_DB_PATH = env_str("STATE_DB_PATH", "bot_state.db")
+STATE_CACHE_SIZE = env_int("STATE_CACHE_SIZE", 5000)  # записей в горячем кэше
+STATE_FLUSH_INTERVAL = env_float("STATE_FLUSH_INTERVAL", 2.0)  # сек между пакетными записями
+STATE_IMPORT_FILE = env_str("STATE_IMPORT_FILE", "settings.json")  # разовый импорт при старте
+
+# Память диалогов: общий бюджет байт, сжатие «холодных» и выгрузка неактивных историй
+MEMORY_MAX_MESSAGES = env_int("MEMORY_MAX_MESSAGES", 10)  # сообщений в истории пользователя
+MEMORY_MAX_BYTES = env_int("MEMORY_MAX_BYTES", 32 * 1024 * 1024)  # бюджет на все истории
+MEMORY_COMPRESS_AFTER = env_float("MEMORY_COMPRESS_AFTER", 300.0)  # сек простоя до сжатия zlib
+MEMORY_IDLE_TTL = env_float("MEMORY_IDLE_TTL", 3600.0)  # сек простоя до выгрузки из памяти
+MEMORY_COMPACT_INTERVAL = env_float("MEMORY_COMPACT_INTERVAL", 30.0)  # сек между проходами
+
+# Долгая память: похожие прошлые ходы вместо всей истории (нужен numpy)
+RECALL_ENABLED = env_bool("RECALL_ENABLED", True)
+RECALL_TOP_K = env_int("RECALL_TOP_K", 3)  # прошлых ходов в контексте
+RECALL_RECENT_MESSAGES = env_int("RECALL_RECENT_MESSAGES", 4)  # последних реплик идут всегда
+RECALL_MIN_SCORE = env_float("RECALL_MIN_SCORE", 0.15)  # косинус, ниже которого ход не берётся
+RECALL_DIM = env_int("RECALL_DIM", 1024)  # размер хеш-вектора
+RECALL_MAX_TURNS = env_int("RECALL_MAX_TURNS", 200)  # ходов в индексе пользователя
+RECALL_MAX_CHARS = env_int("RECALL_MAX_CHARS", 800)  # символов реплики/ответа в индексе
+RECALL_CACHE_USERS = env_int("RECALL_CACHE_USERS", 200)  # индексов в памяти процесса
+RECALL_DIR = env_str("RECALL_DIR", "")  # каталог для матриц np.memmap; пусто — только в памяти
+
+# Параллельная обработка апдейтов: генерации ИИ и быстрая полоса (кнопки, команды)
+UPDATE_CONCURRENCY = env_int("UPDATE_CONCURRENCY", 32)
+UPDATE_FAST_CONCURRENCY = env_int("UPDATE_FAST_CONCURRENCY", 16)
+
+# Склейка быстрых сообщений подряд в один запрос к ИИ
+COALESCE_WINDOW = env_float("COALESCE_WINDOW", 1.0)  # сек тишины, после которых ход уходит в ИИ
+COALESCE_MAX_WAIT = env_float("COALESCE_MAX_WAIT", 3.0)  # сек максимум от первого сообщения хода
+AI_MAX_CONCURRENT_TURNS = env_int("AI_MAX_CONCURRENT_TURNS", UPDATE_CONCURRENCY)  # одновременных генераций
+
+# Режим получения апдейтов: polling | webhook
+BOT_MODE = env_str("BOT_MODE", "polling").strip().lower()
+WEBHOOK_HOST = env_str("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = env_int("WEBHOOK_PORT", 8080)
+WEBHOOK_PATH = env_str("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = env_str("WEBHOOK_URL", "")  # публичный адрес для setWebhook; пусто — не регистрировать
+WEBHOOK_SECRET = env_str("WEBHOOK_SECRET", "")  # secret_token; пусто — сгенерировать (только вместе с WEBHOOK_URL)
+WEBHOOK_MAX_BODY = env_int("WEBHOOK_MAX_BODY", 1024 * 1024)
+# Сколько секунд при остановке ждать недоставленные ответы ИИ
+SHUTDOWN_DRAIN_TIMEOUT = env_float("SHUTDOWN_DRAIN_TIMEOUT", 20.0)
+
+# Несколько процессов: приёмник апдейтов + SHARD_WORKERS обработчиков (0 или 1 — один процесс)
+SHARD_WORKERS = env_int("SHARD_WORKERS", 0)
+SHARD_RESTART_LIMIT = env_int("SHARD_RESTART_LIMIT", 5)  # падений за минуту, после которых обработчик выводится из кольца
+SHARD_SYNC_INTERVAL = env_float("SHARD_SYNC_INTERVAL", 1.0)  # сек между обменом паузами API-ключей
+
+# Доступ и лимиты запросов к ИИ (0 — без лимита)
+ALLOWED_USERS_FILE = env_str("ALLOWED_USERS_FILE", "")  # id через запятую/строку, перечитывается без перезапуска
+ACCESS_RELOAD_INTERVAL = env_float("ACCESS_RELOAD_INTERVAL", 10.0)
+ACCESS_DENY_REPLY_INTERVAL = env_float("ACCESS_DENY_REPLY_INTERVAL", 60.0)  # сек между ответами об отказе
+RATE_MESSAGES_PER_MIN = env_float("RATE_MESSAGES_PER_MIN", 20)
+RATE_MESSAGES_BURST = env_float("RATE_MESSAGES_BURST", 10)
+RATE_TOKENS_PER_MIN = env_float("RATE_TOKENS_PER_MIN", 20000)
+RATE_TOKENS_BURST = env_float("RATE_TOKENS_BURST", 40000)
+
+# Учёт токенов по пользователям, ключам и моделям; бюджеты пользователя (0 — без лимита, UTC)
+USAGE_DAILY_TOKENS = env_int("USAGE_DAILY_TOKENS", 0)
+USAGE_MONTHLY_TOKENS = env_int("USAGE_MONTHLY_TOKENS", 0)
+USAGE_FLUSH_INTERVAL = env_float("USAGE_FLUSH_INTERVAL", 10.0)  # сек между пакетными записями счётчиков
+USAGE_STREAM_OPTIONS = env_bool("USAGE_STREAM_OPTIONS", False)  # stream_options.include_usage в потоковых запросах
+
+# Фоновый конспект: старые реплики сворачиваются дешёвой моделью
+SUMMARY_ENABLED = env_bool("SUMMARY_ENABLED", True)
+SUMMARY_TRIGGER = env_int("SUMMARY_TRIGGER", 8)  # сообщений в памяти, после которых запускается свёртка
+SUMMARY_KEEP_RECENT = env_int("SUMMARY_KEEP_RECENT", 4)  # последних сообщений остаются как есть
+SUMMARY_MAX_WORDS = env_int("SUMMARY_MAX_WORDS", 150)
+SUMMARY_MODEL = env_str("SUMMARY_MODEL", OPENAI_MODEL)
+SUMMARY_CONCURRENCY = env_int("SUMMARY_CONCURRENCY", 2)
+
+# Реестр моделей (JSON, см. models.example.json); пусто — маршруты по умолчанию
+MODELS_FILE = env_str("MODELS_FILE", "")
+
+# Хеджирование: дубль запроса на другой ключ/эндпоинт, если ответа нет дольше перцентиля
+HEDGE_ENABLED = env_bool("HEDGE_ENABLED", False)
+HEDGE_QUANTILE = env_float("HEDGE_QUANTILE", 0.95)  # перцентиль задержки, после которого шлём дубль
+HEDGE_MIN_DELAY = env_float("HEDGE_MIN_DELAY", 0.5)  # сек
+HEDGE_MAX_DELAY = env_float("HEDGE_MAX_DELAY", 10.0)  # сек; до накопления статистики ждём столько
+HEDGE_MAX_RATIO = env_float("HEDGE_MAX_RATIO", 0.1)  # не больше 10% дублей от числа запросов
+HEDGE_BURST = env_float("HEDGE_BURST", 5.0)  # запас дублей на всплеск
+
+# Отказоустойчивость клиента ИИ. Дедлайн фазы = перцентиль × множитель,
+# не меньше MIN_* и не больше AI_CONNECT_TIMEOUT / AI_READ_TIMEOUT / AI_TIMEOUT
+AI_DEADLINE_QUANTILE = env_float("AI_DEADLINE_QUANTILE", 0.99)
+AI_DEADLINE_MULTIPLIER = env_float("AI_DEADLINE_MULTIPLIER", 3.0)
+AI_DEADLINE_MIN_CONNECT = env_float("AI_DEADLINE_MIN_CONNECT", 1.0)  # сек
+AI_DEADLINE_MIN_TTFB = env_float("AI_DEADLINE_MIN_TTFB", 5.0)  # сек до заголовков ответа
+AI_DEADLINE_MIN_TOTAL = env_float("AI_DEADLINE_MIN_TOTAL", 15.0)  # сек на весь запрос
+AI_BREAKER_FAILURES = env_int("AI_BREAKER_FAILURES", 5)  # ошибок подряд до размыкания
+AI_BREAKER_RESET = env_float("AI_BREAKER_RESET", 15.0)  # сек до первой пробы
+AI_BREAKER_MAX_RESET = env_float("AI_BREAKER_MAX_RESET", 120.0)  # потолок паузы между пробами
+AI_RETRY_5XX = env_int("AI_RETRY_5XX", 2)  # повторов после 5xx
+AI_RETRY_BASE_DELAY = env_float("AI_RETRY_BASE_DELAY", 0.5)  # сек, удваивается, с джиттером
+AI_RETRY_MAX_DELAY = env_float("AI_RETRY_MAX_DELAY", 8.0)
+
+# Метрики в формате Prometheus на локальном порту (0 — выключено)
+METRICS_HOST = env_str("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = env_int("METRICS_PORT", 0)
+
+# Очередь отправки в Telegram: общий лимит бота (~30 сообщений/с) и лимиты чатов
+# (~1/с в личный чат, 20/мин в группу); RetryAfter ставит чат на паузу и повторяет запрос
+SEND_SCHEDULER = env_bool("SEND_SCHEDULER", True)
+SEND_GLOBAL_RATE = env_float("SEND_GLOBAL_RATE", 30.0)  # запросов/с на бота
+SEND_CHAT_RATE = env_float("SEND_CHAT_RATE", 1.0)  # запросов/с в личный чат
+SEND_CHAT_BURST = env_int("SEND_CHAT_BURST", 3)  # запас на несколько кусков длинного ответа
+SEND_GROUP_PER_MIN = env_float("SEND_GROUP_PER_MIN", 20.0)  # запросов/мин в группу
+SEND_MAX_RETRIES = env_int("SEND_MAX_RETRIES", 3)  # повторов после RetryAfter
+
+# Потоковые ответы: плейсхолдер + периодические edit_message_text
+STREAM_REPLIES = env_bool("STREAM_REPLIES", False)
+STREAM_EDIT_INTERVAL = env_float("STREAM_EDIT_INTERVAL", 1.0)  # сек между правками (лимит Telegram ~1/сек на чат)
+STREAM_MIN_DELTA_CHARS = env_int("STREAM_MIN_DELTA_CHARS", 40)  # минимум новых символов для правки
+
 
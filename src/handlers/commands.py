@@ -1,9 +1,31 @@
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters
-from src.ai_providers.openai_compatible import ask_ai, SYSTEM_PROMPT
-from src.utils.access import deny_if_not_allowed
-
-import re
+from src.ai_providers.openai_compatible import ask_ai, ask_ai_stream, SYSTEM_PROMPT
+from src.ai_providers.models import model_registry
+from src.ai_providers.resilience import describe_error
+from src.ai_providers.usage import current_user, meter
+from src.config import (
+    ADMIN_USERS,
+    STREAM_REPLIES, STREAM_EDIT_INTERVAL, STREAM_MIN_DELTA_CHARS, TG_MAX_MESSAGE_LEN,
+    MAX_CONTEXT_TOKENS, COALESCE_WINDOW, COALESCE_MAX_WAIT, AI_MAX_CONCURRENT_TURNS,
+    RECALL_TOP_K, RECALL_RECENT_MESSAGES, RECALL_MIN_SCORE, TEMPERATURE,
+)
+from src.utils.access import access, deny_if_not_allowed, deny_if_rate_limited, notify_rate_limited
+from src.utils.coalescer import Turn, TurnCoalescer
+from src.utils.firewall import firewall
+from src.utils.menu import Menu, Press, show
+from src.utils.metrics import metrics
+from src.utils.recall import recall
+from src.utils.send_scheduler import PRIORITY_PROGRESS, send_scheduler
+from src.utils.state_store import state_store
+from src.utils.summarizer import summarizer
+from src.utils.tg_html import render_blocks, split_messages
+
+import asyncio
+import html
+import logging
+
+from src.utils.memory import build_context, estimate_tokens, MESSAGE_OVERHEAD_TOKENS
 
 try:
     from src.utils.memory import user_memory
@@ -11,42 +33,119 @@ except ImportError:
     user_memory = None
 
 from telegram.constants import ParseMode  # ✅ для HTML форматирования
+from telegram.error import BadRequest, RetryAfter, TelegramError
 
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CallbackQueryHandler
 
-# Храним состояние включён/выключен ИИ по пользователю
-_user_ai_enabled = {}
-_user_settings = {}  # user_id -> {"model": "...", "lang": "...", "spec": "..."}
+logger = logging.getLogger(__name__)
+
+# Состояние пользователя хранится в state_store (пространство "user"):
+# {"ai_enabled": bool, "model": "подпись", "model_route": "имя маршрута", "lang": "...", "spec": "...",
+#  "last_response": {"text": str, "msg_id": int}, ...}
+_DEFAULT_STATE = {"ai_enabled": False, "model": "—", "lang": "—", "spec": "—"}
+
+_COST_NAMES = {"low": "💲", "medium": "💲💲", "high": "💲💲💲"}
+_LATENCY_NAMES = {"fast": "быстрая", "normal": "обычная", "slow": "медленная"}
+
+def _model_button_text(route) -> str:
+    return f"{route.label} · {_LATENCY_NAMES.get(route.latency, route.latency)} · {_COST_NAMES.get(route.cost, route.cost)}"
 
-_last_ai_response = {}  # user_id -> {"text": str, "msg_id": int}
+async def _get_user_state(user_id: int) -> dict:
+    state = await state_store.get("user", user_id)
+    for key, value in _DEFAULT_STATE.items():
+        state.setdefault(key, value)
+    return state
+
+def _save_user_state(user_id: int, state: dict) -> None:
+    state_store.put("user", user_id, state)
+
+def _temperature(state: dict) -> float:
+    # temp приходит из импорта settings.json; без него — TEMPERATURE из .env
+    try:
+        return float(state.get("temp", TEMPERATURE))
+    except (TypeError, ValueError):
+        return TEMPERATURE
 
 callback_data="menu_open_from_dialog"
 
 
-def _inline_main_menu(user_id: int) -> InlineKeyboardMarkup:
-    ai_on = _user_ai_enabled.get(user_id, False)
-    kb = [
+# ====== Экраны меню ======
+# Клавиатуры строятся один раз на сочетание полей состояния и берутся из кэша
+menu = Menu()
+
+
+@menu.screen("main", key=lambda state: state["ai_enabled"])
+def _main_rows(state: dict):
+    ai_on = state["ai_enabled"]
+    return [
         [InlineKeyboardButton("🚀 Запустить бота", callback_data="start_bot")],
         [InlineKeyboardButton("🛑 Выключить ИИ" if ai_on else "🤖 Включить ИИ", callback_data="toggle_ai")],
         [
         InlineKeyboardButton("⚙ Настройки", callback_data="settings"),
         InlineKeyboardButton("❓ Помощь", callback_data="help")
         ],
-
     ]
-    return InlineKeyboardMarkup(kb)
 
-def _inline_settings_menu(user_id: int) -> InlineKeyboardMarkup:
-    settings = _user_settings.get(user_id, {"model": "—", "lang": "—", "spec": "—"})
-    kb = [
+
+@menu.screen("main_return", key=lambda state: state["ai_enabled"])
+def _main_return_rows(state: dict):
+    return [*_main_rows(state), [InlineKeyboardButton("⬅ Вернуться к ответу", callback_data="back_to_answer")]]
+
+
+@menu.screen("settings", key=lambda state: (state["model"], state["lang"], state["spec"]))
+def _settings_rows(settings: dict):
+    return [
         [InlineKeyboardButton(f"Модель: {settings['model']}", callback_data="settings_model")],
         [InlineKeyboardButton(f"Язык: {settings['lang']}", callback_data="settings_lang")],
         [InlineKeyboardButton(f"Специализация: {settings['spec']}", callback_data="settings_spec")],
         [InlineKeyboardButton("⬅ Назад", callback_data="back_main")]
     ]
-    return InlineKeyboardMarkup(kb)
+
+
+@menu.screen("models")
+def _models_rows(state: dict):
+    return [
+        *([InlineKeyboardButton(_model_button_text(route), callback_data=f"set_model_{route.name}")]
+          for route in model_registry.menu_routes()),
+        [InlineKeyboardButton("⬅ Назад", callback_data="settings")]
+    ]
+
+
+@menu.screen("langs")
+def _langs_rows(state: dict):
+    return [
+        [InlineKeyboardButton("Русский", callback_data="set_lang_ru")],
+        [InlineKeyboardButton("English", callback_data="set_lang_en")],
+        [InlineKeyboardButton("⬅ Назад", callback_data="settings")]
+    ]
+
+
+@menu.screen("specs")
+def _specs_rows(state: dict):
+    return [
+        [InlineKeyboardButton("Программирование", callback_data="set_spec_code")],
+        [InlineKeyboardButton("Маркетинг", callback_data="set_spec_marketing")],
+        [InlineKeyboardButton("➕ Добавить свою", callback_data="set_spec_custom")],
+        [InlineKeyboardButton("⬅ Назад", callback_data="settings")]
+    ]
+
+
+# кнопка под ответом ИИ
+@menu.screen("answer", key=lambda state: (state["ai_enabled"], state["model"], state["lang"]))
+def _answer_rows(settings: dict):
+    return [[
+        InlineKeyboardButton(
+            f"🤖 {'Вкл' if settings['ai_enabled'] else 'Выкл'} | {settings['model']} | {settings['lang']}",
+            callback_data="menu_open"
+        )
+    ]]
+
+
+def _main_menu(state: dict, from_dialog: bool = False) -> InlineKeyboardMarkup:
+    """Главное меню; из диалога — с возвратом к последнему ответу."""
+    return menu.keyboard("main_return" if from_dialog and state.get("last_response") else "main", state)
 
 # /start
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -54,19 +153,17 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return  # прерываем выполнение, если нет доступа
     
     user_id = update.effective_user.id
-    _user_ai_enabled.setdefault(user_id, False)
-    _user_settings.setdefault(user_id, {"model": "—", "lang": "—", "spec": "—"})
+    state = await _get_user_state(user_id)
     await update.message.reply_text(
         "Привет! Вот твоё меню:",
-        reply_markup=_inline_main_menu(user_id)
+        reply_markup=_main_menu(state)
     )
 
 # компактное меню (при общении)
 async def menu_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отображает краткое меню / статус в процессе общения"""
-    user_id = update.effective_user.id
-    ai_on = _user_ai_enabled.get(user_id, False)
-    settings = _user_settings.get(user_id, {"model": "—", "lang": "—"})
+    settings = await _get_user_state(update.effective_user.id)
+    ai_on = settings["ai_enabled"]
     await update.message.reply_text(
         f"🤖 ИИ: {'Вкл' if ai_on else 'Выкл'} | {settings['model']} | {settings['lang']}\n"
         "Нажми /menu, чтобы открыть полное меню."
@@ -74,104 +171,232 @@ async def menu_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 def sanitize_text(s: str, lang: str) -> str:
-    if lang.lower().startswith("ru"):
-        # только кириллица + базовые знаки препинания
-        return re.sub(r"[^А-Яа-яЁё0-9\s.,:;!?()\[\]«»\"'—\-…]", "", s)
-    elif lang.lower().startswith("en"):
-        # только латиница + базовые знаки препинания
-        return re.sub(r"[^A-Za-z0-9\s.,:;!?()\[\]\"'—\-…]", "", s)
-    else:
-        # без фильтра — если язык не поддерживается или многоязычный
-        return s
+    # только символы выбранного языка (ru/en); иначе без фильтра
+    with metrics.span("sanitize"):
+        return firewall.clean_response(s, lang)
 
 # чат с ИИ
 async def ai_chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await deny_if_not_allowed(update):
+        return
     user_id = update.effective_user.id
-    if not _user_ai_enabled.get(user_id, False):
+    settings = await _get_user_state(user_id)
+    if not settings["ai_enabled"]:
         return await menu_status_handler(update, context)
+    if await deny_if_rate_limited(update):
+        return
 
-    prompt = update.message.text
-    settings = _user_settings.get(user_id, {"model": "—", "lang": "—", "spec": "—"})
+    # Сообщения подряд склеиваются в один ход; ответ готовится в фоне,
+    # новое сообщение отменяет ещё не отправленный ответ
+    turn_coalescer.submit(user_id, update.message.text, update, context)
 
-    # --- Работа с памятью ---
-    context_data = None
+
+async def _answer_turn(turn: Turn):
+    update, context = turn.update, turn.context
+    user_id = turn.user_id
+    # токены всех запросов этого хода (и фонового конспекта) — на счёт пользователя
+    current_user.set(user_id)
+    settings = await _get_user_state(user_id)
+    prompt = turn.prompt
+
+    # --- Работа с памятью: конспект и история до текущего хода ---
+    history = []
+    summary = ""
     if user_memory:
         try:
-            # сохраняем текущее сообщение пользователя
-            user_memory.add_message(user_id, "user", prompt)
-            # достаём историю (например, последние 10 сообщений)
-            context_data = user_memory.get_context(user_id)
+            with metrics.span("memory_read"):
+                await user_memory.load(user_id)
+                history = user_memory.get_context(user_id)
+                summary = await summarizer.get(user_id)
         except Exception:
             pass
 
+    # --- Долгая память: вместо всей истории — последние реплики и похожие прошлые ходы ---
+    recalled = []
+    if recall.enabled:
+        try:
+            with metrics.span("recall"):
+                recalled = await recall.search(
+                    user_id, prompt, RECALL_TOP_K,
+                    skip_recent=RECALL_RECENT_MESSAGES // 2,
+                    min_score=RECALL_MIN_SCORE,
+                )
+            history = history[-RECALL_RECENT_MESSAGES:] if RECALL_RECENT_MESSAGES else []
+        except Exception:
+            logger.exception("Поиск по долгой памяти не удался для пользователя %s", user_id)
+
     # системные инструкции из настроек
     system_instructions = []
-    if settings["model"] != "—":
-        system_instructions.append(f"[Использовать модель: {settings['model']}]")
     if settings["lang"] != "—":
         system_instructions.append(f"[Язык общения: {settings['lang']}]")
     if settings["spec"] != "—":
         system_instructions.append(f"[Специализация: {settings['spec']}]")
 
-    # --- Системный промпт для сохранения контекста ---
-
-    # --- Склеиваем историю в текст ---
-    history_text = ""
-    if context_data:
-        for msg in context_data:
-            role = "Пользователь" if msg["role"] == "user" else "ИИ"
-            history_text += f"{role}: {msg['content']}\n"
-
-    # --- Итоговый промпт ---
-    full_prompt = (
-        SYSTEM_PROMPT + "\n" +
-        "\n".join(system_instructions) +
-        "\n\nИстория диалога:\n" + history_text +
-        f"\nПользователь: {prompt}"
-    )
+    # --- Контекст: системный промпт, инструкции, история по ролям, сообщение ---
+    with metrics.span("prompt_build"):
+        messages = build_context(
+            SYSTEM_PROMPT,
+            history,
+            prompt,
+            # окно выбранной модели тоже ограничивает контекст
+            max_tokens=min(MAX_CONTEXT_TOKENS, model_registry.for_settings(settings).prompt_budget),
+            instructions="\n".join(system_instructions),
+            summary=summary,
+            recalled=recalled,
+        )
+
+    # лимит токенов: входные списываем заранее, ответ — после получения
+    reserved = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+    wait = access.check_tokens(user_id, reserved)
+    if wait:
+        return await notify_rate_limited(update, wait)
 
+    answered = False
     try:
-        ai_response = await ask_ai(full_prompt)
+        short_menu = menu.keyboard("answer", settings)
+
+        if STREAM_REPLIES:
+            raw_response, ai_response, sent_msg = await _stream_ai_reply(update, messages, settings, short_menu, turn)
+        else:
+            raw_response = await ask_ai(messages, temperature=_temperature(settings), settings=settings)
+            turn.begin_delivery()
+            ai_response = sanitize_text(raw_response, settings["lang"])
+            chunks = format_ai_response_chunks(ai_response)
+            for chunk in chunks[:-1]:
+                await update.message.reply_text(chunk, parse_mode=ParseMode.HTML)
+            sent_msg = await update.message.reply_text(
+                chunks[-1],
+                reply_markup=short_menu,
+                parse_mode=ParseMode.HTML
+            )
+
+        answered = True
+        access.charge_tokens(user_id, estimate_tokens(raw_response))
 
-        # --- Сохраняем ответ ассистента в память ---
+        # --- Ответ доставлен: сохраняем ход в память целиком ---
         if user_memory:
             try:
-                user_memory.add_message(user_id, "assistant", ai_response)
+                with metrics.span("memory_write"):
+                    user_memory.add_message(user_id, "user", prompt)
+                    user_memory.add_message(user_id, "assistant", raw_response)
+                # старые реплики сворачиваются в конспект в фоне
+                summarizer.schedule(user_id)
             except Exception:
                 pass
+        try:
+            await recall.add(user_id, prompt, raw_response)
+        except Exception:
+            logger.exception("Не удалось добавить ход в долгую память пользователя %s", user_id)
 
-        ai_response = sanitize_text(ai_response, settings["lang"])
-        formatted = format_ai_response(ai_response)
+        settings["last_response"] = {
+            "text": ai_response,
+            "msg_id": sent_msg.message_id
+        }
+        _save_user_state(user_id, settings)
+        context.user_data["from_dialog_session"] = True
 
-        ai_on = _user_ai_enabled.get(user_id, False)
-        short_menu = InlineKeyboardMarkup([[
-            InlineKeyboardButton(
-                f"🤖 {'Вкл' if ai_on else 'Выкл'} | {settings['model']} | {settings['lang']}",
-                callback_data="menu_open"
-            )
-        ]])
+    except asyncio.CancelledError:
+        # ход заменён новым сообщением: резерв перейдёт на склеенный ход
+        if not answered:
+            access.refund_tokens(user_id, reserved)
+        raise
+    except Exception as e:
+        if not answered:
+            access.refund_tokens(user_id, reserved)
+        logger.warning("Ошибка ИИ для пользователя %s: %r", user_id, e)
+        await update.message.reply_text(describe_error(e))
+
+
+turn_coalescer = TurnCoalescer(
+    _answer_turn,
+    window=COALESCE_WINDOW,
+    max_wait=COALESCE_MAX_WAIT,
+    max_concurrency=AI_MAX_CONCURRENT_TURNS,
+)
+
+
+async def _stream_ai_reply(update: Update, messages: list, settings: dict, short_menu: InlineKeyboardMarkup, turn: Turn):
+    """Потоковый ответ: плейсхолдер, затем редкие правки по мере генерации.
+
+    Правка уходит не чаще STREAM_EDIT_INTERVAL и только если текст вырос
+    на STREAM_MIN_DELTA_CHARS символов. Промежуточные правки — простым текстом,
+    финальная — через format_ai_response_chunks.
+    """
+    placeholder = await update.message.reply_text("…")
+    text = ""
+    shown_len = 0
+    next_edit_at = 0.0
+    progress: set = set()
+    loop = asyncio.get_running_loop()
 
+    try:
+        async for delta in ask_ai_stream(messages, temperature=_temperature(settings), settings=settings):
+            text += delta
+            now = loop.time()
+            if now < next_edit_at or len(text) - shown_len < STREAM_MIN_DELTA_CHARS:
+                continue
+            next_edit_at = now + STREAM_EDIT_INTERVAL
+            if send_scheduler is not None:
+                # не ждём: правку, не дождавшуюся очереди, заменит следующая
+                task = asyncio.create_task(_edit_progress(placeholder, text[:TG_MAX_MESSAGE_LEN]))
+                progress.add(task)
+                task.add_done_callback(progress.discard)
+                shown_len = len(text)
+                continue
+            try:
+                await placeholder.edit_text(text[:TG_MAX_MESSAGE_LEN])
+                shown_len = len(text)
+            except RetryAfter as e:
+                next_edit_at = now + float(e.retry_after)
+            except BadRequest:
+                pass  # например, "message is not modified" — просто ждём следующую правку
+    except asyncio.CancelledError:
+        # ход заменён новым сообщением — недописанный ответ убираем
+        for task in progress:
+            task.cancel()
+        try:
+            await placeholder.delete()
+        except TelegramError:
+            pass
+        raise
+
+    turn.begin_delivery()
+    raw_response = text.strip()
+    ai_response = sanitize_text(raw_response, settings["lang"])
+    chunks = format_ai_response_chunks(ai_response)
+    # первый кусок — в плейсхолдер, остальные — новыми сообщениями; меню — на последнем
+    sent_msg = await placeholder.edit_text(
+        chunks[0],
+        reply_markup=short_menu if len(chunks) == 1 else None,
+        parse_mode=ParseMode.HTML
+    )
+    for i, chunk in enumerate(chunks[1:], start=2):
         sent_msg = await update.message.reply_text(
-            formatted,
-            reply_markup=short_menu,
+            chunk,
+            reply_markup=short_menu if i == len(chunks) else None,
             parse_mode=ParseMode.HTML
         )
+    return raw_response, ai_response, sent_msg
 
-        _last_ai_response[user_id] = {
-            "text": ai_response,
-            "msg_id": sent_msg.message_id
-        }
-        context.user_data["from_dialog_session"] = True
 
-    except Exception as e:
-        await update.message.reply_text(f"⚠ Ошибка при обращении к ИИ: {e}")
+async def _edit_progress(message, text: str) -> None:
+    """Промежуточная правка потокового ответа: низкий приоритет в очереди отправки.
 
+    rate_limit_args принимают только методы ExtBot, не Message.edit_text.
+    Задача не ожидается, поэтому любые ошибки гасятся здесь.
+    """
+    try:
+        await message.get_bot().edit_message_text(
+            chat_id=message.chat_id,
+            message_id=message.message_id,
+            text=text,
+            rate_limit_args=PRIORITY_PROGRESS,
+        )
+    except TelegramError:
+        pass  # например, "message is not modified"; следующая правка всё исправит
+    except Exception:
+        logger.exception("Не удалось обновить потоковый ответ в чате %s", message.chat_id)
 
-def _inline_main_menu_with_return(user_id: int, from_dialog: bool) -> InlineKeyboardMarkup:
-    kb = [list(row) for row in _inline_main_menu(user_id).inline_keyboard]
-    if from_dialog and user_id in _last_ai_response:
-        kb.append([InlineKeyboardButton("⬅ Вернуться к ответу", callback_data="back_to_answer")])
-    return InlineKeyboardMarkup(kb)
 
 # inline меню
 async def inline_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -179,128 +404,144 @@ async def inline_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     query = update.callback_query
+    routed = menu.route(query.data or "")
+    if routed is None:
+        await query.answer("Неизвестная команда кнопки", show_alert=True)
+        return
+    # «часики» на кнопке убираем сразу, до чтения состояния и правки сообщения
     await query.answer()
+    action, arg = routed
     user_id = update.effective_user.id
-    data = query.data
-    from_dialog = context.user_data.get("from_dialog_session", False)
-
-    # Главное меню
-    if data == "start_bot":
-        await query.edit_message_text("Бот запущен ✅", reply_markup=_inline_main_menu_with_return(user_id, from_dialog))
-
-    elif data == "toggle_ai":
-        _user_ai_enabled[user_id] = not _user_ai_enabled.get(user_id, False)
-        await query.edit_message_text(
-            f"ИИ {'включён ✅' if _user_ai_enabled[user_id] else 'выключен ❌'}",
-            reply_markup=_inline_main_menu_with_return(user_id, from_dialog)
-        )
+    state = await _get_user_state(user_id)
+    await action(Press(query, context, user_id, state, arg))
 
-    elif data == "settings":
-        await query.edit_message_text("Раздел настроек 🛠", reply_markup=_inline_settings_menu(user_id))
 
-    elif data == "help":
-        await query.edit_message_text(
-            "ℹ Здесь будет текст помощи.\n"
-            "Например, как пользоваться ботом.",
-            reply_markup=_inline_main_menu_with_return(user_id, from_dialog)
-        )
+def _from_dialog(press: Press) -> bool:
+    return press.context.user_data.get("from_dialog_session", False)
 
-    elif data == "back_main" or data == "menu_open":
-        context.user_data["from_dialog_session"] = False
-        await query.edit_message_text("Главное меню:", reply_markup=_inline_main_menu_with_return(user_id, False))
-
-    elif data == "back_to_answer":
-        last = _last_ai_response.get(user_id)
-        if last:
-            ai_on = _user_ai_enabled.get(user_id, False)
-            settings = _user_settings.get(user_id, {"model": "—", "lang": "—"})
-            short_menu = InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    f"{'Вкл' if ai_on else 'Выкл'} | {settings['model']} | {settings['lang']}",
-                    callback_data="menu_open"
-                )
-            ]])
-            await query.edit_message_text(last["text"], reply_markup=short_menu)
-        context.user_data["from_dialog_session"] = False
-
-    # Настройки: выбор параметров
-    elif data == "settings_model":
-        await query.edit_message_text(
-            "Выберите модель:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("GPT‑4", callback_data="set_model_gpt4")],
-                [InlineKeyboardButton("GPT‑3.5", callback_data="set_model_gpt35")],
-                [InlineKeyboardButton("⬅ Назад", callback_data="settings")]
-            ])
-        )
 
-    elif data == "settings_lang":
-        await query.edit_message_text(
-            "Выберите язык:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Русский", callback_data="set_lang_ru")],
-                [InlineKeyboardButton("English", callback_data="set_lang_en")],
-                [InlineKeyboardButton("⬅ Назад", callback_data="settings")]
-            ])
-        )
+# Главное меню
+@menu.action("start_bot")
+async def _on_start_bot(press: Press):
+    await show(press.query, "Бот запущен ✅", _main_menu(press.state, _from_dialog(press)))
 
-    elif data == "settings_spec":
-        await query.edit_message_text(
-            "Выберите специализацию:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Программирование", callback_data="set_spec_code")],
-                [InlineKeyboardButton("Маркетинг", callback_data="set_spec_marketing")],
-                [InlineKeyboardButton("➕ Добавить свою", callback_data="set_spec_custom")],
-                [InlineKeyboardButton("⬅ Назад", callback_data="settings")]
-            ])
-        )
 
+@menu.action("toggle_ai")
+async def _on_toggle_ai(press: Press):
+    state = press.state
+    state["ai_enabled"] = not state["ai_enabled"]
+    _save_user_state(press.user_id, state)
+    await show(
+        press.query,
+        f"ИИ {'включён ✅' if state['ai_enabled'] else 'выключен ❌'}",
+        _main_menu(state, _from_dialog(press))
+    )
 
-    # Настройки: сохранение выбора
-    elif data == "set_model_gpt4":
-        _user_settings[user_id]["model"] = "GPT‑4"
-        await query.edit_message_text("✅ Модель установлена: GPT‑4", reply_markup=_inline_settings_menu(user_id))
 
-    elif data == "set_model_gpt35":
-        _user_settings[user_id]["model"] = "GPT‑3.5"
-        await query.edit_message_text("✅ Модель установлена: GPT‑3.5", reply_markup=_inline_settings_menu(user_id))
+@menu.action("settings")
+async def _on_settings(press: Press):
+    await show(press.query, "Раздел настроек 🛠", menu.keyboard("settings", press.state))
 
-    elif data == "set_lang_ru":
-        _user_settings[user_id]["lang"] = "Русский"
-        await query.edit_message_text("✅ Язык установлен: Русский", reply_markup=_inline_settings_menu(user_id))
 
-    elif data == "set_lang_en":
-        _user_settings[user_id]["lang"] = "English"
-        await query.edit_message_text("✅ Language set: English", reply_markup=_inline_settings_menu(user_id))
+@menu.action("help")
+async def _on_help(press: Press):
+    await show(
+        press.query,
+        "ℹ Здесь будет текст помощи.\n"
+        "Например, как пользоваться ботом.",
+        _main_menu(press.state, _from_dialog(press))
+    )
 
-    elif data == "set_spec_code":
-        _user_settings[user_id]["spec"] = "Программирование"
-        await query.edit_message_text("✅ Специализация: Программирование", reply_markup=_inline_settings_menu(user_id))
 
-    elif data == "set_spec_marketing":
-        _user_settings[user_id]["spec"] = "Маркетинг"
-        await query.edit_message_text("✅ Специализация: Маркетинг", reply_markup=_inline_settings_menu(user_id))
-    
-    elif data == "set_spec_custom":
-        context.user_data["awaiting_custom_spec"] = True
-        await query.edit_message_text(
-            "✍️ Введите свою специализацию (например: «Финансовый анализ» или «UX-дизайн»):"
-        )  
+@menu.action("back_main", "menu_open")
+async def _on_back_main(press: Press):
+    press.context.user_data["from_dialog_session"] = False
+    await show(press.query, "Главное меню:", _main_menu(press.state))
+
+
+@menu.action("back_to_answer")
+async def _on_back_to_answer(press: Press):
+    last = press.state.get("last_response")
+    if last:
+        await show(press.query, last["text"][:TG_MAX_MESSAGE_LEN], menu.keyboard("answer", press.state))
+    press.context.user_data["from_dialog_session"] = False
+
+
+# Настройки: выбор параметров
+@menu.action("settings_model")
+async def _on_settings_model(press: Press):
+    await show(press.query, "Выберите модель:", menu.keyboard("models", press.state))
+
+
+@menu.action("settings_lang")
+async def _on_settings_lang(press: Press):
+    await show(press.query, "Выберите язык:", menu.keyboard("langs", press.state))
 
-    else:
-        await query.answer("Неизвестная команда кнопки", show_alert=True)
+
+@menu.action("settings_spec")
+async def _on_settings_spec(press: Press):
+    await show(press.query, "Выберите специализацию:", menu.keyboard("specs", press.state))
+
+
+# Настройки: сохранение выбора
+_LANGS = {"ru": ("Русский", "✅ Язык установлен: Русский"), "en": ("English", "✅ Language set: English")}
+_SPECS = {"code": "Программирование", "marketing": "Маркетинг"}
+
+
+@menu.prefix("set_model_")
+async def _on_set_model(press: Press):
+    state = press.state
+    route = model_registry.get(press.arg)
+    if route is None:
+        await show(press.query, "⚠️ Эта модель больше недоступна", menu.keyboard("settings", state))
+        return
+    state["model"] = route.label
+    state["model_route"] = route.name
+    _save_user_state(press.user_id, state)
+    await show(press.query, f"✅ Модель установлена: {route.label}", menu.keyboard("settings", state))
+
+
+@menu.prefix("set_lang_")
+async def _on_set_lang(press: Press):
+    if press.arg not in _LANGS:
+        return
+    state = press.state
+    state["lang"], text = _LANGS[press.arg]
+    _save_user_state(press.user_id, state)
+    await show(press.query, text, menu.keyboard("settings", state))
+
+
+@menu.action("set_spec_custom")
+async def _on_set_spec_custom(press: Press):
+    press.context.user_data["awaiting_custom_spec"] = True
+    await show(
+        press.query,
+        "✍️ Введите свою специализацию (например: «Финансовый анализ» или «UX-дизайн»):"
+    )
+
+
+@menu.prefix("set_spec_")
+async def _on_set_spec(press: Press):
+    if press.arg not in _SPECS:
+        return
+    state = press.state
+    state["spec"] = _SPECS[press.arg]
+    _save_user_state(press.user_id, state)
+    await show(press.query, f"✅ Специализация: {state['spec']}", menu.keyboard("settings", state))
 
 async def custom_spec_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     if context.user_data.get("awaiting_custom_spec"):
         custom_spec = update.message.text.strip()
-        _user_settings[user_id]["spec"] = custom_spec
+        state = await _get_user_state(user_id)
+        state["spec"] = custom_spec
+        _save_user_state(user_id, state)
         context.user_data["awaiting_custom_spec"] = False
 
         await update.message.reply_text(
-            f"✅ Специализация установлена: <b>{custom_spec}</b>",
-            reply_markup=_inline_settings_menu(user_id),
+            f"✅ Специализация установлена: <b>{html.escape(custom_spec)}</b>",
+            reply_markup=menu.keyboard("settings", state),
             parse_mode=ParseMode.HTML
         )
         return
@@ -309,50 +550,54 @@ async def custom_spec_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     await ai_chat_handler(update, context)
 
 
-def format_ai_response(text: str) -> str:
-    # Markdown -> HTML для выделений
-    text = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", text)
-    text = re.sub(r"\*(.+?)\*", r"<i>\1</i>", text)
+def format_ai_response_chunks(text: str) -> list[str]:
+    """Markdown -> HTML Telegram с экранированием, нарезанный на сообщения не длиннее TG_MAX_MESSAGE_LEN."""
+    with metrics.span("format"):
+        return split_messages(render_blocks(text), TG_MAX_MESSAGE_LEN) or ["…"]
 
-
-
-
-    # Списки
-    text = re.sub(r"^\s*[\*\-]\s+", r"• ", text, flags=re.MULTILINE)
-    text = re.sub(r"^(\d+)\.\s+", r"\1) ", text, flags=re.MULTILINE)
-
-    # Кодовые блоки
-    def escape_code_block(match):
-        code = match.group(1)
-        code = code.replace("<", "&lt;").replace(">", "&gt;")
-        code = code.strip("\n")
-        code = re.sub(r"\n{3,}", "\n\n", code)
-        return f"<pre><code>{code}</code></pre>"
-
-    text = re.sub(r"```(.*?)```", escape_code_block, text, flags=re.DOTALL)
-
-    # Однострочный код
-    text = re.sub(
-        r"`([^`\n]+)`",
-        lambda m: f"<code>{m.group(1).replace('<', '&lt;').replace('>', '&gt;')}</code>",
-        text
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Метрики бота — только для ADMIN_USERS; остальным команда не отвечает."""
+    user = update.effective_user
+    if user is None or user.id not in ADMIN_USERS:
+        return
+    text = metrics.render_text()
+    # <pre> плюс экранирование: режем по строкам с запасом под теги
+    chunk = ""
+    for line in text.splitlines():
+        line = html.escape(line, quote=False)[:TG_MAX_MESSAGE_LEN - 20]
+        if len(chunk) + len(line) + 1 > TG_MAX_MESSAGE_LEN - 20:
+            await update.message.reply_text(f"<pre>{chunk}</pre>", parse_mode=ParseMode.HTML)
+            chunk = ""
+        chunk += line + "\n"
+    if chunk:
+        await update.message.reply_text(f"<pre>{chunk}</pre>", parse_mode=ParseMode.HTML)
+
+def _usage_line(title: str, used: list, limit: int) -> str:
+    prompt, completion, requests = used
+    line = f"{title}: {prompt + completion} токенов ({prompt} запрос + {completion} ответ), запросов к ИИ: {requests}"
+    if limit:
+        line += f"\n   лимит {limit}, осталось {max(0, limit - prompt - completion)}"
+    return line
+
+async def usage_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Расход токенов пользователя за сутки и месяц (UTC) и остаток бюджета."""
+    if await deny_if_not_allowed(update):
+        return
+    used = await meter.user_usage(update.effective_user.id)
+    exempt = update.effective_user.id in meter.exempt
+    await update.message.reply_text(
+        "📊 Расход токенов\n"
+        f"{_usage_line('Сегодня', used['day'], 0 if exempt else meter.budgets['day'])}\n"
+        f"{_usage_line('За месяц', used['month'], 0 if exempt else meter.budgets['month'])}"
     )
 
-    # Нормализация пустых строк вне кодовых блоков
-    def normalize_text_block(block):
-        return re.sub(r"\n{3,}", "\n\n", block)
-
-    parts = re.split(r"(<pre><code>.*?</code></pre>)", text, flags=re.DOTALL)
-    for i in range(0, len(parts), 2):
-        parts[i] = normalize_text_block(parts[i])
-    text = "".join(parts)
-
-    return text
-
 # регистрация
 def register_handlers(app):
     app.add_handler(CommandHandler("start", start_handler))
+    app.add_handler(CommandHandler("stats", stats_handler))
+    app.add_handler(CommandHandler("usage", usage_handler))
     app.add_handler(CommandHandler("menu", start_handler))  # открыть полное меню
     app.add_handler(CallbackQueryHandler(inline_menu_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat_handler))
+    # один обработчик текста: в группе срабатывает только первый подходящий,
+    # а custom_spec_handler сам передаёт обычные сообщения в ai_chat_handler
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, custom_spec_handler))
@@ -1,17 +1,328 @@
-from telegram import Update
-from src.config import ALLOWED_USERS
+"""Доступ к боту и лимиты на запросы к ИИ.
+
+Белый список — множество id (проверка O(1)): из ALLOWED_USERS, из файла
+ALLOWED_USERS_FILE (перечитывается по mtime без перезапуска) и из
+state_store (пространство "access", для выдачи доступа из кода — например,
+после оплаты). Отказ отправляется пользователю не чаще раза в
+ACCESS_DENY_REPLY_INTERVAL, остальные сообщения молча игнорируются.
+
+Лимиты — два ведра токенов на пользователя: сообщения в минуту и токены
+ИИ в минуту. Полные вёдра периодически выбрасываются, память не растёт.
+"""
 import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from telegram import Update
+
+from src.config import (
+    ALLOWED_USERS,
+    ALLOWED_USERS_FILE,
+    ACCESS_RELOAD_INTERVAL,
+    ACCESS_DENY_REPLY_INTERVAL,
+    RATE_MESSAGES_PER_MIN,
+    RATE_MESSAGES_BURST,
+    RATE_TOKENS_PER_MIN,
+    RATE_TOKENS_BURST,
+)
+from src.utils.metrics import metrics
+from src.utils.state_store import state_store
 
 logger = logging.getLogger(__name__)
 
+_ID_RE = re.compile(r"-?\d+")
+# Сколько пользователей помнить для отсева повторных уведомлений/проверок
+_RECENT_LIMIT = 10000
+# Как часто выбрасывать заполненные вёдра
+_SWEEP_INTERVAL = 60.0
+
+DENIED_ALERT = "⛔ Доступ запрещён."
+
+
+def parse_ids(text: str) -> Set[int]:
+    """id через запятую/пробел/перевод строки; всё после # — комментарий."""
+    ids = set()
+    for line in text.splitlines():
+        ids.update(int(x) for x in _ID_RE.findall(line.split("#", 1)[0]))
+    return ids
+
+
+@lru_cache(maxsize=1024)
+def _denial_text(user_id: int) -> str:
+    return (
+        f"⛔ Доступ запрещён.\n\nВаш Telegram ID: `{user_id}`\n"
+        "Если вы считаете, что это ошибка — свяжитесь с [поддержкой](https://t.me/VictorEvgenievichh)."
+    )
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate  # пополнение в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float, now: float) -> float:
+        """0, если списано; иначе сколько секунд ждать до нужного остатка."""
+        self._refill(now)
+        # запрос дороже всего ведра пропускаем при полном ведре, иначе он не пройдёт никогда
+        need = min(amount, self.capacity)
+        if self.tokens >= need:
+            self.tokens -= amount
+            return 0.0
+        return (need - self.tokens) / self.rate
+
+    def charge(self, amount: float, now: float) -> None:
+        """Досписывает фактический расход; остаток может уйти в минус (долг)."""
+        self._refill(now)
+        self.tokens -= amount
+
+    def refund(self, amount: float, now: float) -> None:
+        """Возвращает списанное заранее, но не потраченное; не больше ёмкости."""
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class AccessControl:
+    def __init__(
+        self,
+        allowed: Iterable[int] = (),
+        allowed_file: str = "",
+        reload_interval: float = 10.0,
+        store=None,
+        deny_reply_interval: float = 60.0,
+        messages_per_min: float = 0.0,
+        messages_burst: float = 0.0,
+        tokens_per_min: float = 0.0,
+        tokens_burst: float = 0.0,
+    ):
+        self._static: Set[int] = set(allowed)
+        self._from_file: Set[int] = set()
+        self._allowed: Set[int] = set(self._static)
+        self.allowed_file = allowed_file
+        self.reload_interval = reload_interval
+        self._file_mtime: Optional[float] = None
+        self._next_check = 0.0
+        self.store = store
+        self.deny_reply_interval = deny_reply_interval
+        # user_id -> до какого момента считать «не в списке» без похода в store
+        self._negative: "OrderedDict[int, float]" = OrderedDict()
+        # (вид уведомления, user_id) -> когда можно уведомить снова
+        self._notified: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
+
+        self._msg_limit = (messages_per_min / 60.0, messages_burst or messages_per_min)
+        self._tok_limit = (tokens_per_min / 60.0, tokens_burst or tokens_per_min)
+        self._msg_buckets: Dict[int, TokenBucket] = {}
+        self._tok_buckets: Dict[int, TokenBucket] = {}
+        self._next_sweep = time.monotonic() + _SWEEP_INTERVAL
+        self.denied = 0
+        self.limited = 0
+
+        if allowed_file:
+            self._maybe_reload(force=True)
+        if not self._allowed:
+            logger.warning("Белый список пуст: бот ответит только тем, кому доступ выдан через state_store")
+
+    # ====== Белый список ======
+    def _maybe_reload(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        try:
+            mtime = os.stat(self.allowed_file).st_mtime
+        except OSError:
+            return
+        if mtime == self._file_mtime:
+            return
+        self._file_mtime = mtime
+        try:
+            with open(self.allowed_file, encoding="utf-8") as f:
+                ids = parse_ids(f.read())
+        except OSError as e:
+            logger.error("Не удалось прочитать список доступа %s: %s", self.allowed_file, e)
+            return
+        self._from_file = ids
+        self._allowed = self._static | ids
+        self._negative.clear()
+        logger.info("Список доступа загружен из %s: %d id", self.allowed_file, len(ids))
+
+    async def is_allowed(self, user_id: int) -> bool:
+        if self.allowed_file:
+            self._maybe_reload()
+        if user_id in self._allowed:
+            return True
+        if self.store is None:
+            return False
+        now = time.monotonic()
+        until = self._negative.get(user_id)
+        if until is not None and until > now:
+            return False
+        record = await self.store.get("access", user_id)
+        if record.get("allowed"):
+            self._negative.pop(user_id, None)
+            return True
+        self._remember(self._negative, user_id, now + self.deny_reply_interval)
+        return False
+
+    def grant(self, user_id: int) -> None:
+        """Открывает доступ без перезапуска (сохраняется в state_store)."""
+        self._negative.pop(user_id, None)
+        if self.store is not None:
+            self.store.put("access", user_id, {"allowed": True, "granted_at": time.time()})
+        else:
+            self._static.add(user_id)
+            self._allowed.add(user_id)
+
+    def revoke(self, user_id: int) -> None:
+        if self.store is not None:
+            self.store.put("access", user_id, {"allowed": False, "revoked_at": time.time()})
+        self._static.discard(user_id)
+        self._allowed = self._static | self._from_file
+
+    @staticmethod
+    def _remember(table: OrderedDict, key, value: float) -> None:
+        table[key] = value
+        table.move_to_end(key)
+        if len(table) > _RECENT_LIMIT:
+            table.popitem(last=False)
+
+    def should_notify(self, kind: str, user_id: int) -> bool:
+        """Не чаще раза в deny_reply_interval на пользователя и вид уведомления."""
+        now = time.monotonic()
+        key = (kind, user_id)
+        if self._notified.get(key, 0.0) > now:
+            return False
+        self._remember(self._notified, key, now + self.deny_reply_interval)
+        return True
+
+    # ====== Лимиты ======
+    def _bucket(self, table: Dict[int, TokenBucket], limit: Tuple[float, float], user_id: int, now: float):
+        bucket = table.get(user_id)
+        if bucket is None:
+            bucket = table[user_id] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    def _sweep(self, now: float) -> None:
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + _SWEEP_INTERVAL
+        for table in (self._msg_buckets, self._tok_buckets):
+            for user_id in [uid for uid, b in table.items() if b.is_full(now)]:
+                del table[user_id]
+
+    def check_message(self, user_id: int) -> float:
+        """Списывает одно сообщение; 0 — можно, иначе секунды до следующего."""
+        if not self._msg_limit[0]:
+            return 0.0
+        now = time.monotonic()
+        self._sweep(now)
+        wait = self._bucket(self._msg_buckets, self._msg_limit, user_id, now).try_take(1, now)
+        if wait:
+            self.limited += 1
+        return wait
+
+    def check_tokens(self, user_id: int, tokens: int) -> float:
+        """Списывает оценку входных токенов запроса; 0 — можно, иначе секунды ожидания."""
+        if not self._tok_limit[0]:
+            return 0.0
+        now = time.monotonic()
+        wait = self._bucket(self._tok_buckets, self._tok_limit, user_id, now).try_take(tokens, now)
+        if wait:
+            self.limited += 1
+        return wait
+
+    def charge_tokens(self, user_id: int, tokens: int) -> None:
+        """Досписывает токены ответа, когда он уже получен."""
+        if not self._tok_limit[0]:
+            return
+        now = time.monotonic()
+        self._bucket(self._tok_buckets, self._tok_limit, user_id, now).charge(tokens, now)
+
+    def refund_tokens(self, user_id: int, tokens: int) -> None:
+        """Возвращает оценку входных токенов, если ответа так и не было."""
+        if not self._tok_limit[0]:
+            return
+        now = time.monotonic()
+        self._bucket(self._tok_buckets, self._tok_limit, user_id, now).refund(tokens, now)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "allowed": len(self._allowed),
+            "negative_cached": len(self._negative),
+            "message_buckets": len(self._msg_buckets),
+            "token_buckets": len(self._tok_buckets),
+            "denied": self.denied,
+            "limited": self.limited,
+        }
+
+
+access = AccessControl(
+    ALLOWED_USERS,
+    allowed_file=ALLOWED_USERS_FILE,
+    reload_interval=ACCESS_RELOAD_INTERVAL,
+    store=state_store,
+    deny_reply_interval=ACCESS_DENY_REPLY_INTERVAL,
+    messages_per_min=RATE_MESSAGES_PER_MIN,
+    messages_burst=RATE_MESSAGES_BURST,
+    tokens_per_min=RATE_TOKENS_PER_MIN,
+    tokens_burst=RATE_TOKENS_BURST,
+)
+
+
+@metrics.timed("access_check")
 async def deny_if_not_allowed(update: Update) -> bool:
-    user_id = update.effective_user.id
-    if user_id not in ALLOWED_USERS:
-        logger.warning(f"⛔ Доступ запрещён для пользователя: {user_id}")
-        await update.message.reply_text(
-            f"⛔ Доступ запрещён.\n\nВаш Telegram ID: `{user_id}`\n"
-            "Если вы считаете, что это ошибка — свяжитесь с [поддержкой](https://t.me/VictorEvgenievichh).",
-            parse_mode="Markdown"
-        )
+    user = update.effective_user
+    if user is None:
+        return True
+    if await access.is_allowed(user.id):
+        return False
+
+    access.denied += 1
+    query = update.callback_query
+    if access.should_notify("denied", user.id):
+        logger.warning("⛔ Доступ запрещён для пользователя: %s", user.id)
+        if query is not None:
+            await query.answer(DENIED_ALERT, show_alert=True)
+        elif update.effective_message is not None:
+            await update.effective_message.reply_text(_denial_text(user.id), parse_mode="Markdown")
+    elif query is not None:
+        await query.answer()  # убираем «часики» на кнопке без лишнего текста
+    return True
+
+
+async def notify_rate_limited(update: Update, wait: float) -> None:
+    user = update.effective_user
+    if user is None or not access.should_notify("limited", user.id):
+        return
+    logger.warning("Пользователь %s упёрся в лимит запросов", user.id)
+    text = f"⏳ Слишком много запросов. Попробуйте через {max(1, round(wait))} с."
+    if update.callback_query is not None:
+        await update.callback_query.answer(text, show_alert=True)
+    elif update.effective_message is not None:
+        await update.effective_message.reply_text(text)
+
+
+async def deny_if_rate_limited(update: Update) -> bool:
+    """Лимит сообщений к ИИ; при превышении — короткое уведомление (не чаще раза в интервал)."""
+    user = update.effective_user
+    if user is None:
         return True
-    return False
+    wait = access.check_message(user.id)
+    if not wait:
+        return False
+    await notify_rate_limited(update, wait)
+    return True
@@ -0,0 +1,138 @@
+"""Склейка быстрых сообщений пользователя в один ход диалога.
+
+Сообщение не отправляется в ИИ сразу: ход ждёт окно тишины window
+(но не дольше max_wait от первого сообщения), всё пришедшее за это время
+склеивается в один запрос. Генерация идёт в фоновой задаче; если
+пользователь пишет снова, пока ответ ещё не начал отправляться, генерация
+отменяется (вместе с HTTP-запросом к провайдеру), а её текст переходит в
+новый ход. Запись в память делает сам обработчик хода — только после
+доставки ответа, поэтому отменённый ход не оставляет следов в истории.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Turn:
+    """Один ход: склеенные сообщения пользователя и генерация ответа на них."""
+
+    __slots__ = ("user_id", "parts", "update", "context", "first_at", "timer", "task", "delivering", "previous")
+
+    def __init__(self, user_id: int, first_at: float):
+        self.user_id = user_id
+        self.parts: List[str] = []
+        self.update: Any = None  # последний апдейт — ответ уходит в его чат
+        self.context: Any = None
+        self.first_at = first_at
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.task: Optional[asyncio.Task] = None
+        self.delivering = False
+        self.previous: Optional[asyncio.Task] = None  # ход, ответ которого ещё отправляется
+
+    @property
+    def prompt(self) -> str:
+        return "\n".join(self.parts)
+
+    def begin_delivery(self) -> None:
+        """С этого момента ход не отменяется: ответ уже уходит пользователю."""
+        self.delivering = True
+
+
+class TurnCoalescer:
+    def __init__(
+        self,
+        run: Callable[[Turn], Awaitable[None]],
+        window: float,
+        max_wait: float,
+        max_concurrency: int,
+    ):
+        self._run = run
+        self.window = window
+        self.max_wait = max_wait
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._pending: Dict[int, Turn] = {}  # ждут конца окна
+        self._active: Dict[int, Turn] = {}  # генерируются или отправляются
+        self._tasks: Set[asyncio.Task] = set()
+        self.turns = 0
+        self.merged = 0
+        self.cancelled = 0
+
+    def submit(self, user_id: int, text: str, update: Any, context: Any) -> None:
+        now = time.monotonic()
+        turn = self._pending.get(user_id)
+        if turn is not None:
+            self.merged += 1
+            turn.timer.cancel()
+        else:
+            turn = Turn(user_id, now)
+            active = self._active.get(user_id)
+            if active is not None and not active.delivering:
+                # ответ ещё не отправлен — отменяем, вопрос войдёт в новый ход
+                active.task.cancel()
+                turn.parts.extend(active.parts)
+                turn.previous = active.task
+                self.merged += len(active.parts)
+                self.cancelled += 1
+                del self._active[user_id]
+            elif active is not None:
+                turn.previous = active.task
+            self._pending[user_id] = turn
+
+        turn.parts.append(text)
+        turn.update, turn.context = update, context
+        delay = min(self.window, max(0.0, turn.first_at + self.max_wait - now))
+        turn.timer = asyncio.get_running_loop().call_later(delay, self._start, turn)
+
+    def _start(self, turn: Turn) -> None:
+        if self._pending.get(turn.user_id) is turn:
+            del self._pending[turn.user_id]
+        self._active[turn.user_id] = turn
+        turn.task = asyncio.create_task(self._execute(turn))
+        self._tasks.add(turn.task)
+        turn.task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, turn: Turn) -> None:
+        try:
+            if turn.previous is not None:
+                # история должна включать предыдущий ответ
+                await asyncio.wait([turn.previous])
+            async with self._slots:
+                self.turns += 1
+                await self._run(turn)
+        except Exception:
+            logger.exception("Ошибка при обработке хода пользователя %s", turn.user_id)
+        finally:
+            if self._active.get(turn.user_id) is turn:
+                del self._active[turn.user_id]
+
+    async def drain(self, timeout: float) -> None:
+        """Запускает ожидающие ходы сразу и ждёт ответы не дольше timeout; остальное отменяется."""
+        for turn in list(self._pending.values()):
+            turn.timer.cancel()
+            self._start(turn)
+        if self._tasks:
+            _, late = await asyncio.wait(list(self._tasks), timeout=timeout)
+            if late:
+                logger.warning("Не дождались %d ответов ИИ при остановке", len(late))
+        await self.close()
+
+    async def close(self) -> None:
+        for turn in self._pending.values():
+            turn.timer.cancel()
+        self._pending.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "active": len(self._active),
+            "turns": self.turns,
+            "merged": self.merged,
+            "cancelled": self.cancelled,
+        }
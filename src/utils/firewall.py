@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from src.config import FIREWALL_RULES_FILE, FIREWALL_RELOAD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+REDACTED = "[REDACTED]"
+
+
+class Rule(NamedTuple):
+    name: str
+    pattern: str
+    action: str = "redact"  # "redact" — замаскировать, "block" — отклонить запрос
+
+
+class FilterResult(NamedTuple):
+    text: str
+    fired: Tuple[str, ...]  # имена сработавших правил, по одному разу, в порядке срабатывания
+    blocked: bool
+
+
+# ====== Правила по умолчанию (входящие сообщения) ======
+DEFAULT_RULES = (
+    Rule("api_key", r"sk-[A-Za-z0-9]{20,}"),  # API ключи
+    Rule("secret_word", r"\bpassword\b|\btoken\b|\bapi_key\b"),  # чувствительные слова
+    Rule("prompt_leak", r"system prompt|hidden prompt|internal instruction"),  # попытка вытащить промпт
+)
+
+# ====== Фильтры ответов ======
+# только кириллица / только латиница + базовые знаки препинания
+_LANG_FILTERS = {
+    "ru": re.compile(r"[^А-Яа-яЁё0-9\s.,:;!?()\[\]«»\"'—\-…]+"),
+    "en": re.compile(r"[^A-Za-z0-9\s.,:;!?()\[\]\"'—\-…]+"),
+}
+
+_STRICT_FILTER = re.compile(
+    r'[^\u0000-\u007F'   # ASCII (латиница, цифры, базовая пунктуация)
+    r'\u0400-\u04FF'     # Кириллица (основной блок)
+    r'\u0500-\u052F'     # Кириллица (доп. блок)
+    r'\u2DE0-\u2DFF'     # Кириллица Extended-A
+    r'\uA640-\uA69F'     # Кириллица Extended-B
+    r'\s.,!?;:()'
+    r']+'
+)
+
+
+def _compile(rules: Iterable[Rule]) -> Tuple[Optional["re.Pattern[str]"], Dict[str, Rule]]:
+    """Склеивает правила в одну альтернацию с именованной группой на правило."""
+    by_group: Dict[str, Rule] = {}
+    parts: List[str] = []
+    for i, rule in enumerate(rules):
+        re.compile(rule.pattern)  # ошибка в правиле должна указывать на само правило
+        group = f"r{i}"
+        by_group[group] = rule
+        parts.append(f"(?P<{group}>{rule.pattern})")
+    if not parts:
+        return None, by_group
+    return re.compile("|".join(parts), re.IGNORECASE), by_group
+
+
+def load_rules(path: str) -> List[Rule]:
+    """Читает правила из JSON: {"rules": [{"name": ..., "pattern": ..., "action": ...}]}.
+
+    Правила из файла полностью заменяют DEFAULT_RULES.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    rules = []
+    for item in data.get("rules", []):
+        action = item.get("action", "redact")
+        if action not in ("redact", "block"):
+            raise ValueError(f"Неизвестное действие правила {item.get('name')}: {action}")
+        rules.append(Rule(item["name"], item["pattern"], action))
+    return rules
+
+
+class TextFirewall:
+    """Фильтр текста: один предкомпилированный проход на направление.
+
+    Входящие правила склеены в одно регулярное выражение — текст
+    просматривается один раз, маскирование и проверка блокировки
+    происходят в том же проходе. Правила можно подгружать из JSON-файла;
+    изменения подхватываются без перезапуска (проверка mtime не чаще
+    reload_interval секунд).
+    """
+
+    def __init__(
+        self,
+        rules: Iterable[Rule] = DEFAULT_RULES,
+        rules_file: str = "",
+        reload_interval: float = 5.0,
+    ):
+        self.rules_file = rules_file
+        self.reload_interval = reload_interval
+        self._default_rules = tuple(rules)
+        self._file_mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._set_rules(self._default_rules)
+        if rules_file:
+            self._maybe_reload(force=True)
+
+    def _set_rules(self, rules: Iterable[Rule]) -> None:
+        self._regex, self._by_group = _compile(rules)
+        self.rules = tuple(self._by_group.values())
+
+    def _maybe_reload(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        try:
+            mtime = os.stat(self.rules_file).st_mtime
+        except OSError:
+            return
+        if mtime == self._file_mtime:
+            return
+        self._file_mtime = mtime
+        try:
+            self._set_rules(load_rules(self.rules_file))
+            logger.info("Правила фильтра загружены из %s: %d шт.", self.rules_file, len(self.rules))
+        except (OSError, ValueError, KeyError, re.error) as e:
+            # Битый файл не должен ронять бота — остаёмся на прежних правилах
+            logger.error("Не удалось загрузить правила фильтра из %s: %s", self.rules_file, e)
+
+    def inspect_request(self, text: str) -> FilterResult:
+        """Маскирует совпадения и сообщает, какие правила сработали."""
+        if self.rules_file:
+            self._maybe_reload()
+        if self._regex is None:
+            return FilterResult(text, (), False)
+
+        fired: Dict[str, None] = {}
+        blocked = False
+        by_group = self._by_group
+
+        def _replace(m: "re.Match[str]") -> str:
+            nonlocal blocked
+            rule = by_group[m.lastgroup]
+            fired[rule.name] = None
+            if rule.action == "block":
+                blocked = True
+            return REDACTED
+
+        clean = self._regex.sub(_replace, text)
+        if fired:
+            logger.warning("Обнаружен запрещённый паттерн в запросе: %s", ", ".join(fired))
+        return FilterResult(clean, tuple(fired), blocked)
+
+    @staticmethod
+    def clean_response(text: str, lang: str = "", strict: bool = False) -> str:
+        """Фильтр ответа ИИ.
+
+        lang ("ru…"/"en…") оставляет только символы этого языка; strict
+        дополнительно приводит текст к NFKC и убирает всё, кроме ASCII и кириллицы.
+        """
+        if strict:
+            text = _STRICT_FILTER.sub("", unicodedata.normalize("NFKC", text))
+        lang_filter = _LANG_FILTERS.get(lang.lower()[:2])
+        if lang_filter is not None:
+            text = lang_filter.sub("", text)
+        return text
+
+
+firewall = TextFirewall(rules_file=FIREWALL_RULES_FILE, reload_interval=FIREWALL_RELOAD_INTERVAL)
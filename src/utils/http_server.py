@@ -0,0 +1,202 @@
+"""Минимальный HTTP/1.1-сервер на asyncio для вебхука и служебных эндпоинтов.
+
+Без внешних зависимостей: keep-alive, тело только по Content-Length,
+маршруты по точному пути или по префиксу. При остановке сервер перестаёт
+принимать соединения и дожидается уже начатых обработчиков.
+"""
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+_REASONS = {
+    200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 411: "Length Required", 413: "Payload Too Large",
+    500: "Internal Server Error", 501: "Not Implemented", 503: "Service Unavailable",
+}
+_MAX_HEADER_BYTES = 16 * 1024
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    query: Dict[str, str]
+    headers: Dict[str, str]  # имена в нижнем регистре
+    body: bytes
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class Response(NamedTuple):
+    status: int
+    body: bytes = b""
+    content_type: str = "application/json"
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200) -> "Response":
+        return cls(status, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    @classmethod
+    def text(cls, text: str, status: int = 200) -> "Response":
+        return cls(status, text.encode("utf-8"), "text/plain; charset=utf-8")
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class _BadRequest(Exception):
+    def __init__(self, status: int):
+        self.status = status
+
+
+class HttpServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, max_body: int = 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._prefix_routes: List[Tuple[str, str, Handler]] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._busy = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.requests = 0
+
+    def route(self, method: str, path: str, handler: Handler) -> None:
+        """path, оканчивающийся на "*", — маршрут по префиксу."""
+        if path.endswith("*"):
+            self._prefix_routes.append((method.upper(), path[:-1], handler))
+        else:
+            self._routes[(method.upper(), path)] = handler
+
+    def _resolve(self, method: str, path: str) -> Tuple[Optional[Handler], bool]:
+        """Обработчик и признак того, что путь вообще известен (для 405)."""
+        handler = self._routes.get((method, path))
+        if handler is not None:
+            return handler, True
+        known = any(p == path for _, p in self._routes)
+        for m, prefix, h in self._prefix_routes:
+            if path.startswith(prefix):
+                if m == method:
+                    return h, True
+                known = True
+        return None, known
+
+    # ====== Жизненный цикл ======
+    async def start(self) -> "HttpServer":
+        self._server = await asyncio.start_server(
+            self._handle_conn, self.host, self.port, limit=_MAX_HEADER_BYTES
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP-сервер слушает %s:%d", self.host, self.port)
+        return self
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Перестаёт принимать соединения и ждёт начатые запросы не дольше timeout."""
+        if self._server is None:
+            return
+        self._server.close()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("HTTP-сервер остановлен с %d незавершёнными запросами", self._busy)
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    # ====== Соединение ======
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None  # клиент закрыл соединение между запросами
+        except asyncio.LimitOverrunError:
+            raise _BadRequest(413)
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _version = lines[0].split(" ", 2)
+        except ValueError:
+            raise _BadRequest(400)
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise _BadRequest(400)
+            headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise _BadRequest(501)
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise _BadRequest(400)
+        if length > self.max_body:
+            raise _BadRequest(413)
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        return Request(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler, known = self._resolve(request.method, request.path)
+        if handler is None:
+            return Response.json({"ok": False}, 405 if known else 404)
+        try:
+            return await handler(request)
+        except Exception:
+            logger.exception("Ошибка обработчика %s %s", request.method, request.path)
+            return Response.json({"ok": False}, 500)
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool) -> None:
+        head = (
+            f"HTTP/1.1 {response.status} {_REASONS.get(response.status, 'Unknown')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + response.body)
+
+    async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while self._server is not None and self._server.is_serving():
+                try:
+                    request = await self._read_request(reader)
+                except _BadRequest as e:
+                    self._write_response(writer, Response.json({"ok": False}, e.status), False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                self._busy += 1
+                self._idle.clear()
+                try:
+                    self.requests += 1
+                    response = await self._dispatch(request)
+                    keep_alive = (
+                        request.headers.get("connection", "").lower() != "close"
+                        and self._server is not None and self._server.is_serving()
+                    )
+                    self._write_response(writer, response, keep_alive)
+                    await writer.drain()
+                finally:
+                    self._busy -= 1
+                    if not self._busy:
+                        self._idle.set()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
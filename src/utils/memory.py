@@ -1,38 +1,355 @@
-from collections import defaultdict, deque
+"""История диалогов в памяти процесса.
+
+Сообщения хранятся компактно (__slots__, интернированные роли), у каждой
+истории — время последнего обращения. Истории, к которым давно не
+обращались, сжимаются zlib; неактивные дольше idle_ttl и самые старые при
+превышении общего бюджета байт выгружаются из памяти. Выгрузка ничего не
+теряет: каждое изменение уже поставлено в очередь записи state_store, и
+load() вернёт историю при следующем сообщении пользователя.
+"""
+import heapq
+import json
+import logging
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.config import (
+    MEMORY_MAX_MESSAGES,
+    MEMORY_MAX_BYTES,
+    MEMORY_COMPRESS_AFTER,
+    MEMORY_IDLE_TTL,
+    MEMORY_COMPACT_INTERVAL,
+)
+from src.utils.state_store import state_store
+
+logger = logging.getLogger(__name__)
+
+_ROLES = {role: sys.intern(role) for role in ("system", "user", "assistant")}
+_EMPTY: Tuple[Dict[str, str], ...] = ()
+
+
+class Message:
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = _ROLES.get(role) or sys.intern(role)
+        self.content = content
+
+    def as_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+# Постоянные накладные расходы: объект сообщения, объект истории, список, узел словаря
+_MESSAGE_SIZE = sys.getsizeof(Message("user", ""))
+_HISTORY_OVERHEAD = 200
+
+
+def _pack(messages: List[Message]) -> bytes:
+    raw = json.dumps([[m.role, m.content] for m in messages], ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(raw.encode("utf-8"))
+
+
+def _unpack(packed: bytes) -> List[Message]:
+    return [Message(role, content) for role, content in json.loads(zlib.decompress(packed))]
+
+
+class _History:
+    """История одного пользователя: либо список сообщений, либо сжатый blob.
+
+    Итерация отдаёт словари {"role", "content"} — так история сериализуется
+    state_store без промежуточной копии.
+    """
+
+    __slots__ = ("messages", "packed", "nbytes", "last_access")
+
+    def __init__(self, messages: List[Message]):
+        self.messages: Optional[List[Message]] = messages
+        self.packed: Optional[bytes] = None
+        self.last_access = time.monotonic()
+        self.nbytes = 0
+        self.measure()
+
+    def measure(self) -> int:
+        if self.packed is not None:
+            self.nbytes = _HISTORY_OVERHEAD + sys.getsizeof(self.packed)
+        else:
+            self.nbytes = _HISTORY_OVERHEAD + sys.getsizeof(self.messages) + sum(
+                _MESSAGE_SIZE + sys.getsizeof(m.content) for m in self.messages
+            )
+        return self.nbytes
+
+    def pack(self) -> bool:
+        """Сжимает историю, если это действительно экономит память."""
+        if self.packed is not None or not self.messages:
+            return False
+        before = self.nbytes
+        packed = _pack(self.messages)
+        if _HISTORY_OVERHEAD + sys.getsizeof(packed) >= before:
+            return False
+        self.messages, self.packed = None, packed
+        self.measure()
+        return True
+
+    def unpack(self) -> None:
+        if self.packed is not None:
+            self.messages, self.packed = _unpack(self.packed), None
+            self.measure()
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        messages = self.messages if self.packed is None else _unpack(self.packed)
+        return (m.as_dict() for m in messages)
 
 
 class SimpleMemory:
-    def __init__(self, max_messages=10):
-        # user_id -> deque([{"role": "user"/"assistant", "content": str}, ...])
-        self.storage = defaultdict(lambda: deque(maxlen=max_messages))
+    def __init__(
+        self,
+        max_messages: int = MEMORY_MAX_MESSAGES,
+        store=None,
+        max_bytes: int = MEMORY_MAX_BYTES,
+        compress_after: float = MEMORY_COMPRESS_AFTER,
+        idle_ttl: float = MEMORY_IDLE_TTL,
+        compact_interval: float = MEMORY_COMPACT_INTERVAL,
+    ):
+        self.max_messages = max_messages
+        # хранилище для истории между перезапусками (пространство "history")
+        self.store = store
+        self.max_bytes = max_bytes
+        self.compress_after = compress_after
+        self.idle_ttl = idle_ttl
+        self.compact_interval = compact_interval
+        # user_id -> _History, от давно неактивных к недавним
+        self._users: "OrderedDict[int, _History]" = OrderedDict()
+        self._bytes = 0
+        self._next_compact = time.monotonic() + compact_interval
+        self.packed = 0
+        self.evicted = 0
+
+    # ====== Учёт и выгрузка ======
+    def _touch(self, user_id: int) -> Optional[_History]:
+        history = self._users.get(user_id)
+        if history is None:
+            return None
+        self._users.move_to_end(user_id)
+        history.last_access = time.monotonic()
+        if history.packed is not None:
+            self._bytes -= history.nbytes
+            history.unpack()
+            self._bytes += history.nbytes
+        return history
+
+    def _insert(self, user_id: int, history: _History) -> None:
+        self._users[user_id] = history
+        self._users.move_to_end(user_id)
+        self._bytes += history.nbytes
+
+    def _evict(self, user_id: int) -> None:
+        history = self._users.pop(user_id)
+        self._bytes -= history.nbytes
+        self.evicted += 1
+        if self.store is not None:
+            # несохранённые изменения остаются в очереди записи, из кэша объект убираем
+            self.store.discard("history", user_id)
+
+    def _enforce_budget(self, keep: int) -> None:
+        while self._bytes > self.max_bytes and len(self._users) > 1:
+            oldest = next(iter(self._users))
+            if oldest == keep:
+                break
+            self._evict(oldest)
+
+    def compact(self, now: Optional[float] = None) -> None:
+        """Сжимает давно неактивные истории и выгружает простаивающие дольше idle_ttl."""
+        now = time.monotonic() if now is None else now
+        self._next_compact = now + self.compact_interval
+        for user_id, history in list(self._users.items()):
+            idle = now - history.last_access
+            if idle < self.compress_after:
+                break  # дальше только более свежие
+            if idle >= self.idle_ttl:
+                self._evict(user_id)
+                continue
+            before = history.nbytes
+            if history.pack():
+                self._bytes += history.nbytes - before
+                self.packed += 1
+
+    def _maybe_compact(self) -> None:
+        now = time.monotonic()
+        if now >= self._next_compact:
+            self.compact(now)
+
+    # ====== Публичный API ======
+    async def load(self, user_id: int):
+        """Подгружает историю пользователя из хранилища, если её ещё нет в памяти"""
+        if self.store is None or user_id in self._users:
+            return
+        saved = await self.store.get("history", user_id, default=list)
+        if user_id in self._users:
+            return
+        if isinstance(saved, _History):
+            # выгруженная история ещё ждёт записи — берём тот же объект
+            saved.last_access = time.monotonic()
+            history = saved
+        else:
+            messages = [Message(m["role"], m["content"]) for m in saved][-self.max_messages:]
+            if not messages:
+                return
+            history = _History(messages)
+        self.store.discard("history", user_id)
+        self._insert(user_id, history)
+        self._enforce_budget(keep=user_id)
 
     def add_message(self, user_id: int, role: str, content: str):
         """Добавляет сообщение в историю пользователя"""
-        self.storage[user_id].append({"role": role, "content": content})
+        history = self._touch(user_id)
+        if history is None:
+            history = _History([Message(role, content)])
+            self._insert(user_id, history)
+        else:
+            self._bytes -= history.nbytes
+            history.messages.append(Message(role, content))
+            if len(history.messages) > self.max_messages:
+                del history.messages[0]
+            self._bytes += history.measure()
+        if self.store is not None:
+            self.store.put("history", user_id, history)
+        self._enforce_budget(keep=user_id)
+        self._maybe_compact()
 
-    def get_context(self, user_id: int):
+    def get_context(self, user_id: int) -> Sequence[Dict[str, str]]:
         """Возвращает список сообщений пользователя (история)"""
-        return list(self.storage[user_id])
+        history = self._touch(user_id)
+        if history is None:
+            return _EMPTY
+        return [m.as_dict() for m in history.messages]
 
     def clear(self, user_id: int):
         """Очищает историю пользователя"""
-        self.storage[user_id].clear()
+        if user_id in self._users:
+            history = self._users.pop(user_id)
+            self._bytes -= history.nbytes
+        if self.store is not None:
+            self.store.put("history", user_id, [])
+
+    # ====== Для фонового конспекта (src/utils/summarizer.py) ======
+    def count(self, user_id: int) -> int:
+        """Число сообщений в памяти; сжатые истории не считаются (их не конспектируют)."""
+        history = self._users.get(user_id)
+        if history is None or history.packed is not None:
+            return 0
+        return len(history.messages)
+
+    def oldest(self, user_id: int, n: int) -> List[Message]:
+        """Первые n сообщений без отметки об обращении."""
+        history = self._users.get(user_id)
+        if history is None or history.packed is not None or n <= 0:
+            return []
+        return history.messages[:n]
+
+    def drop_oldest(self, user_id: int, expected: List[Message]) -> bool:
+        """Убирает начало истории, если оно всё ещё ровно expected (те же объекты)."""
+        history = self._users.get(user_id)
+        if history is None or history.packed is not None or not expected:
+            return False
+        head = history.messages[:len(expected)]
+        if len(head) != len(expected) or any(a is not b for a, b in zip(head, expected)):
+            return False
+        self._bytes -= history.nbytes
+        del history.messages[:len(expected)]
+        self._bytes += history.measure()
+        if self.store is not None:
+            self.store.put("history", user_id, history)
+        return True
+
+    # ====== Интроспекция ======
+    def user_bytes(self, user_id: int) -> int:
+        history = self._users.get(user_id)
+        return history.nbytes if history is not None else 0
+
+    def top_users(self, n: int = 10) -> List[Tuple[int, int]]:
+        """n пользователей с самыми тяжёлыми историями: [(user_id, байт), ...]."""
+        return heapq.nlargest(n, ((uid, h.nbytes) for uid, h in self._users.items()), key=lambda x: x[1])
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._users),
+            "packed_users": sum(1 for h in self._users.values() if h.packed is not None),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "packed": self.packed,
+            "evicted": self.evicted,
+        }
 
 
 # Создаём глобальный объект памяти, который импортируется в commands.py
-user_memory = SimpleMemory(max_messages=10)
-
-def make_history_store(maxlen: int = 40):
-    # history[user_id] -> deque of {"role": "...", "content": "..."}
-    return defaultdict(lambda: deque(maxlen=maxlen))
-
-def approx_len(messages: list[dict]) -> int:
-    return sum(len(m["content"]) for m in messages)
-
-def build_context(history, user_id: int, system_prompt: str, max_chars: int):
-    msgs = [{"role": "system", "content": system_prompt}]
-    msgs.extend(history[user_id])
-    while (sum(len(m["content"]) for m in msgs) > max_chars) and len(history[user_id]) > 2:
-        history[user_id].popleft()
-        msgs = [{"role": "system", "content": system_prompt}, *history[user_id]]
-    return msgs
+user_memory = SimpleMemory(store=state_store)
+
+# Заголовок системного сообщения с конспектом ранней части диалога
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:"
+# Заголовок системного сообщения с найденными прошлыми ходами (src/utils/recall.py)
+RECALL_PREFIX = "Фрагменты прошлых разговоров, которые могут относиться к вопросу:"
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов без токенизатора и сети.
+
+    ~4 байта UTF-8 на токен: для латиницы это ~4 символа, для кириллицы ~2 —
+    близко к реальным BPE-токенизаторам.
+    """
+    return (len(text.encode("utf-8")) + 3) // 4
+
+def build_context(
+    system_prompt: str,
+    history,
+    user_message: str,
+    max_tokens: int,
+    instructions: str = "",
+    summary: str = "",
+    recalled: Sequence[Tuple[str, str]] = (),
+) -> list[dict]:
+    """Собирает messages для chat/completions в пределах бюджета токенов.
+
+    Порядок: системный промпт (стабильный префикс, одинаковый для всех
+    запросов — его кэширует провайдер), инструкции пользователя, конспект
+    ранней части диалога, найденные прошлые ходы, история по ролям, текущее
+    сообщение. История берётся с конца, пока влезает в бюджет; сумма
+    считается нарастающим итогом за один проход. Прошлые ходы получают
+    то, что осталось после истории.
+    """
+    head = [{"role": "system", "content": system_prompt}]
+    if instructions:
+        head.append({"role": "system", "content": instructions})
+    if summary:
+        head.append({"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"})
+    tail = {"role": "user", "content": user_message}
+
+    used = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in head)
+    used += estimate_tokens(user_message) + MESSAGE_OVERHEAD_TOKENS
+
+    kept = []
+    for msg in reversed(history):
+        cost = estimate_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > max_tokens:
+            break
+        used += cost
+        kept.append({"role": msg["role"], "content": msg["content"]})
+    kept.reverse()
+
+    if recalled:
+        fragments = []
+        used += estimate_tokens(RECALL_PREFIX) + MESSAGE_OVERHEAD_TOKENS
+        for prompt, reply in recalled:
+            fragment = f"Пользователь: {prompt}\nАссистент: {reply}"
+            cost = estimate_tokens(fragment) + 1
+            if used + cost > max_tokens:
+                break
+            used += cost
+            fragments.append(fragment)
+        if fragments:
+            head.append({"role": "system", "content": "\n\n".join([RECALL_PREFIX, *fragments])})
+    return [*head, *kept, tail]
@@ -0,0 +1,135 @@
+"""Декларативные меню: экраны, кэш клавиатур, маршрутизация кнопок.
+
+Экран — функция, строящая ряды кнопок по состоянию пользователя, и
+функция-ключ: какие поля состояния влияют на клавиатуру. Готовая
+InlineKeyboardMarkup (объекты PTB неизменяемы) кэшируется по (экран, ключ)
+и при следующем нажатии берётся из словаря.
+
+Кнопки маршрутизируются словарём callback_data → обработчик; кнопки с
+параметром (set_model_<имя>) — по короткой таблице префиксов.
+
+show() сравнивает новый текст и клавиатуру с тем, что уже показано в
+сообщении, и не шлёт правку, если ничего не изменилось.
+
+    menu = Menu()
+
+    @menu.screen("settings", key=lambda s: (s["model"], s["lang"]))
+    def settings_rows(state):
+        return [[InlineKeyboardButton(f"Модель: {state['model']}", callback_data="settings_model")]]
+
+    @menu.action("settings")
+    async def open_settings(press):
+        await show(press.query, "Раздел настроек 🛠", menu.keyboard("settings", press.state))
+"""
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+from telegram import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+Rows = Sequence[Sequence[InlineKeyboardButton]]
+
+
+class Press(NamedTuple):
+    """Нажатие кнопки, переданное обработчику."""
+    query: CallbackQuery
+    context: Any
+    user_id: int
+    state: dict
+    arg: str = ""  # хвост callback_data после префикса
+
+
+Action = Callable[[Press], Awaitable[None]]
+
+
+class _Screen(NamedTuple):
+    build: Callable[[dict], Rows]
+    key: Callable[[dict], Hashable]
+
+
+class Menu:
+    def __init__(self, max_keyboards: int = 4096):
+        self._screens: Dict[str, _Screen] = {}
+        self._keyboards: "OrderedDict[Tuple[str, Hashable], InlineKeyboardMarkup]" = OrderedDict()
+        self.max_keyboards = max_keyboards
+        self._actions: Dict[str, Action] = {}
+        self._prefixes: List[Tuple[str, Action]] = []
+        self.hits = 0
+        self.misses = 0
+
+    # ====== Экраны ======
+    def screen(self, name: str, key: Callable[[dict], Hashable] = lambda state: ()):
+        def decorator(build: Callable[[dict], Rows]):
+            self._screens[name] = _Screen(build, key)
+            return build
+        return decorator
+
+    def keyboard(self, name: str, state: dict) -> InlineKeyboardMarkup:
+        screen = self._screens[name]
+        cache_key = (name, screen.key(state))
+        markup = self._keyboards.get(cache_key)
+        if markup is not None:
+            self.hits += 1
+            self._keyboards.move_to_end(cache_key)
+            return markup
+        self.misses += 1
+        markup = InlineKeyboardMarkup(screen.build(state))
+        self._keyboards[cache_key] = markup
+        if len(self._keyboards) > self.max_keyboards:
+            self._keyboards.popitem(last=False)
+        return markup
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """Сбрасывает кэш клавиатур (экрана name или весь), например после смены реестра моделей."""
+        if name is None:
+            self._keyboards.clear()
+            return
+        for cache_key in [k for k in self._keyboards if k[0] == name]:
+            del self._keyboards[cache_key]
+
+    # ====== Кнопки ======
+    def action(self, *data: str):
+        def decorator(fn: Action) -> Action:
+            for item in data:
+                self._actions[item] = fn
+            return fn
+        return decorator
+
+    def prefix(self, prefix: str):
+        def decorator(fn: Action) -> Action:
+            self._prefixes.append((prefix, fn))
+            return fn
+        return decorator
+
+    def route(self, data: str) -> Optional[Tuple[Action, str]]:
+        fn = self._actions.get(data)
+        if fn is not None:
+            return fn, ""
+        for prefix, fn in self._prefixes:
+            if data.startswith(prefix):
+                return fn, data[len(prefix):]
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {"keyboards": len(self._keyboards), "hits": self.hits, "misses": self.misses}
+
+
+async def show(query: CallbackQuery, text: str, markup: Optional[InlineKeyboardMarkup] = None, **kwargs) -> bool:
+    """Правит сообщение с кнопкой, если текст или клавиатура отличаются от показанных."""
+    message = query.message
+    if message is not None and getattr(message, "text", None) == text and message.reply_markup == markup:
+        metrics.inc("menu_edits_skipped")
+        return False
+    try:
+        await query.edit_message_text(text, reply_markup=markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        metrics.inc("menu_edits_skipped")
+        return False
+    return True
@@ -0,0 +1,241 @@
+"""Метрики горячего пути: спаны, гистограммы, счётчики, снимки состояния.
+
+Гистограмма — фиксированные экспоненциальные корзины (от 50 мкс до ~2 мин,
+шаг √2), перцентили оцениваются по корзинам с точностью до шага. Спан —
+два perf_counter() и bisect по корзинам, единицы микросекунд; блокировок
+нет, всё живёт в одном цикле событий.
+
+Снимки (collect) — функции, возвращающие dict со stats() компонентов; они
+вызываются только при запросе /stats или /metrics.
+
+    with metrics.span("memory_read"):
+        ...
+    metrics.inc("ai_rate_limited")
+"""
+import functools
+import re
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from telegram.request import HTTPXRequest
+
+from src.utils.http_server import Response
+
+# Верхние границы корзин, секунды
+BUCKETS: Tuple[float, ...] = tuple(0.00005 * 2 ** (i / 2) for i in range(44))
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]+")
+
+
+class Histogram:
+    __slots__ = ("name", "help", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(BUCKETS) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попал q-й перцентиль."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+class _Span:
+    __slots__ = ("hist", "start")
+
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.hist.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self, prefix: str = "tgbot"):
+        self.prefix = prefix
+        self._hists: Dict[str, Histogram] = {}
+        self._counters: Dict[str, float] = {}
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+
+    # ====== Запись ======
+    def histogram(self, name: str, help: str = "") -> Histogram:
+        hist = self._hists.get(name)
+        if hist is None:
+            hist = self._hists[name] = Histogram(name, help)
+        return hist
+
+    def span(self, name: str) -> _Span:
+        return _Span(self._hists.get(name) or self.histogram(name))
+
+    def timed(self, name: str):
+        """Декоратор корутины: вся её длительность — в гистограмму name."""
+        def decorator(fn):
+            hist = self.histogram(name)
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    hist.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def observe(self, name: str, seconds: float) -> None:
+        (self._hists.get(name) or self.histogram(name)).observe(seconds)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def collect(self, name: str, fn: Callable[[], dict]) -> None:
+        """Регистрирует снимок состояния компонента (обычно его stats())."""
+        self._collectors[name] = fn
+
+    # ====== Чтение ======
+    def _gauges(self) -> Iterator[Tuple[str, float]]:
+        def flatten(prefix: str, value) -> Iterator[Tuple[str, float]]:
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    yield from flatten(f"{prefix}_{key}", item)
+            elif isinstance(value, (list, tuple)):
+                for i, item in enumerate(value):
+                    yield from flatten(f"{prefix}_{i}", item)
+            elif isinstance(value, (int, float)):
+                yield prefix, float(value)
+
+        for name, fn in self._collectors.items():
+            try:
+                yield from flatten(name, fn())
+            except Exception:
+                continue
+
+    def snapshot(self) -> Dict[str, object]:
+        def ms(value: Optional[float]) -> Optional[float]:
+            return round(value * 1000, 2) if value is not None else None
+
+        return {
+            "spans": {
+                name: {
+                    "count": h.count,
+                    "p50_ms": ms(h.quantile(0.5)),
+                    "p95_ms": ms(h.quantile(0.95)),
+                    "p99_ms": ms(h.quantile(0.99)),
+                }
+                for name, h in sorted(self._hists.items())
+            },
+            "counters": dict(sorted(self._counters.items())),
+            "state": {name: _safe_call(fn) for name, fn in self._collectors.items()},
+        }
+
+    def render_text(self) -> str:
+        """Компактный отчёт для /stats."""
+        snap = self.snapshot()
+        lines = ["Спаны (p50 / p95 / p99, мс):"]
+        for name, s in snap["spans"].items():
+            lines.append(f"  {name}: {s['p50_ms']} / {s['p95_ms']} / {s['p99_ms']}  (n={s['count']})")
+        if snap["counters"]:
+            lines.append("Счётчики:")
+            lines.extend(f"  {name}: {value:g}" for name, value in snap["counters"].items())
+        for name, state in snap["state"].items():
+            _format_state(lines, name, state, 0)
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        out: List[str] = []
+        p = self.prefix
+        for name, h in sorted(self._hists.items()):
+            metric = f"{p}_{_metric_name(name)}_seconds"
+            if h.help:
+                out.append(f"# HELP {metric} {h.help}")
+            out.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                out.append(f'{metric}_bucket{{le="{bound:.6g}"}} {cumulative}')
+            out.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            out.append(f"{metric}_sum {h.sum:.6f}")
+            out.append(f"{metric}_count {h.count}")
+        for name, value in sorted(self._counters.items()):
+            metric = f"{p}_{_metric_name(name)}_total"
+            out.append(f"# TYPE {metric} counter")
+            out.append(f"{metric} {value:g}")
+        seen = set()
+        for name, value in self._gauges():
+            metric = f"{p}_{_metric_name(name)}"
+            if metric in seen:
+                continue
+            seen.add(metric)
+            out.append(f"# TYPE {metric} gauge")
+            out.append(f"{metric} {value:g}")
+        return "\n".join(out) + "\n"
+
+
+def _format_state(lines: List[str], label: str, value, depth: int) -> None:
+    """Вложенные stats(): узлы — отдельными строками, плоские словари — одной строкой."""
+    pad = "  " * depth
+    if isinstance(value, list):
+        value = dict(enumerate(value))
+    if isinstance(value, dict) and any(isinstance(v, (dict, list)) for v in value.values()):
+        lines.append(f"{pad}{label}:")
+        for key, item in value.items():
+            _format_state(lines, str(key), item, depth + 1)
+    elif isinstance(value, dict):
+        lines.append(f"{pad}{label}: " + ", ".join(f"{k}={v}" for k, v in value.items()))
+    else:
+        lines.append(f"{pad}{label}: {value}")
+
+
+def _metric_name(name: str) -> str:
+    return _NAME_RE.sub("_", name).strip("_").lower()
+
+
+def _safe_call(fn: Callable[[], dict]):
+    try:
+        return fn()
+    except Exception as e:
+        return f"ошибка: {e}"
+
+
+metrics = Metrics()
+
+
+# ====== Эндпоинт для Prometheus ======
+async def prometheus_handler(request) -> Response:
+    return Response(200, metrics.render_prometheus().encode("utf-8"),
+                    "text/plain; version=0.0.4; charset=utf-8")
+
+
+# ====== Запросы к Bot API ======
+class TimedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который меряет каждый вызов Bot API (кроме getUpdates — у него свой запрос)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc("telegram_errors")
+            raise
+        finally:
+            metrics.observe("telegram_send", time.perf_counter() - start)
@@ -0,0 +1,295 @@
+"""Долгая память: поиск похожих прошлых ходов пользователя.
+
+В контекст обычно идут последние реплики, независимо от того, о чём
+вопрос. Здесь каждый завершённый ход (реплика пользователя + ответ)
+превращается в вектор локальным эмбеддером: слова и пары слов с обрезанными
+окончаниями хешируются в dim знаковых признаков, вес — 1 + log(tf).
+Векторы пользователя лежат строками одной матрицы float16; запрос
+взвешивается по idf внутри истории пользователя, и все ходы оцениваются
+одним умножением матрицы на вектор. В контекст попадают top_k самых похожих
+старых ходов вместе с несколькими последними репликами.
+
+Тексты ходов хранятся в state_store (пространство "recall"), матрица
+строится из них при первом обращении. Если задан RECALL_DIR, матрица —
+файл np.memmap на пользователя и не пересчитывается после перезапуска:
+рядом с текстом хода хранится crc32 его строки, и заново считаются только
+строки, которые с ней не сходятся (файл пишется раньше текстов, и после
+падения между ними строки могут сдвинуться относительно ходов).
+
+Нужен numpy; без него модуль выключается (recall.enabled = False).
+"""
+import logging
+import math
+import os
+import re
+import time
+import zlib
+from collections import Counter, OrderedDict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from src.config import (
+    RECALL_ENABLED,
+    RECALL_DIM,
+    RECALL_MAX_TURNS,
+    RECALL_MAX_CHARS,
+    RECALL_CACHE_USERS,
+    RECALL_DIR,
+)
+from src.utils.state_store import state_store
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w{3,}")  # предлоги и союзы почти не различают ходы
+_STEM_LEN = 5  # грубая замена стеммеру: «модели», «моделью» -> «модел»
+
+Turn = Tuple[str, str]  # (реплика пользователя, ответ)
+
+
+# ====== Эмбеддер ======
+def features(text: str) -> List[str]:
+    """Признаки текста: основы слов и пары соседних основ."""
+    stems = [word[:_STEM_LEN] for word in _WORD_RE.findall(text.lower())]
+    return stems + [f"{a} {b}" for a, b in zip(stems, stems[1:])]
+
+
+class HashingEmbedder:
+    """Хеширующий векторизатор без словаря: одинаковый в любом процессе."""
+
+    def __init__(self, dim: int = RECALL_DIM):
+        self.dim = dim
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        """Матрица (len(texts), dim) float32 с нормированными строками."""
+        rows: List[int] = []
+        cols: List[int] = []
+        values: List[float] = []
+        for row, text in enumerate(texts):
+            for feature, count in Counter(features(text)).items():
+                h = zlib.crc32(feature.encode("utf-8"))
+                rows.append(row)
+                cols.append(h % self.dim)
+                # знак из старшего бита: коллизии чаще гасят друг друга, чем складываются
+                values.append((1.0 + math.log(count)) * (1.0 if h & 0x80000000 else -1.0))
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if rows:
+            np.add.at(matrix, (np.asarray(rows), np.asarray(cols)), np.asarray(values, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+# ====== Индекс пользователя ======
+def _row_crc(row: "np.ndarray") -> int:
+    return zlib.crc32(row.tobytes())
+
+
+class _Index:
+    """Ходы одного пользователя и их векторы (строки 0..count-1, от старых к новым).
+
+    Итерация отдаёт [реплика, ответ, crc32 строки] — так индекс сериализуется
+    state_store без промежуточной копии, как история в memory.py.
+    """
+
+    __slots__ = ("turns", "vectors", "df", "path")
+
+    def __init__(self, turns: List[Turn], vectors: "np.ndarray", path: str = ""):
+        self.turns = turns
+        self.vectors = vectors  # float16, строк не меньше len(turns)
+        # в скольких ходах встречается каждый хеш-признак — для idf запроса
+        self.df = np.count_nonzero(vectors[:len(turns)], axis=0).astype(np.int32)
+        self.path = path
+
+    @property
+    def count(self) -> int:
+        return len(self.turns)
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.path else self.vectors.nbytes
+
+    def __iter__(self) -> Iterator[list]:
+        return ([prompt, reply, _row_crc(row)] for (prompt, reply), row in zip(self.turns, self.vectors))
+
+
+class Recall:
+    def __init__(
+        self,
+        store=None,
+        embedder: Optional[HashingEmbedder] = None,
+        max_turns: int = RECALL_MAX_TURNS,
+        max_chars: int = RECALL_MAX_CHARS,
+        cache_users: int = RECALL_CACHE_USERS,
+        directory: str = RECALL_DIR,
+        enabled: bool = RECALL_ENABLED,
+    ):
+        if enabled and np is None:
+            logger.warning("numpy не установлен — долгая память (RECALL_ENABLED) выключена")
+            enabled = False
+        self.enabled = enabled
+        self.store = store
+        self.embedder = embedder or HashingEmbedder()
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        self.cache_users = cache_users
+        self.directory = directory
+        if enabled and directory:
+            os.makedirs(directory, exist_ok=True)
+        self._indexes: "OrderedDict[int, _Index]" = OrderedDict()
+        self.searches = 0
+        self.hits = 0
+        self.embedded = 0
+        self.search_seconds = 0.0
+
+    # ====== Матрицы ======
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self.directory, f"{user_id}.f16") if self.directory else ""
+
+    def _allocate(self, path: str, rows: int) -> "np.ndarray":
+        if not path:
+            return np.zeros((rows, self.embedder.dim), dtype=np.float16)
+        # файл сразу на max_turns строк: на Linux он разреженный, места не занимает до записи
+        mode = "r+" if os.path.exists(path) else "w+"
+        try:
+            return np.memmap(path, dtype=np.float16, mode=mode, shape=(self.max_turns, self.embedder.dim))
+        except ValueError:
+            # размер не совпал (поменяли RECALL_DIM или RECALL_MAX_TURNS) — начинаем файл заново
+            return np.memmap(path, dtype=np.float16, mode="w+", shape=(self.max_turns, self.embedder.dim))
+
+    def _build(self, user_id: int, saved: List[list]) -> _Index:
+        """saved — сохранённые [реплика, ответ, crc32 строки]; crc нет у записей старого формата."""
+        saved = saved[-self.max_turns:]
+        turns = [(entry[0], entry[1]) for entry in saved]
+        path = self._path(user_id)
+        vectors = self._allocate(path, max(8, len(turns)))
+        # строки, не совпавшие с crc из текстов (нового файла нет, файл сдвинут или
+        # отстал), считаем заново одним вызовом
+        stale = [i for i, entry in enumerate(saved) if len(entry) < 3 or entry[2] != _row_crc(vectors[i])]
+        if stale:
+            vectors[stale] = self._embed([turns[i] for i in stale])
+        return _Index(turns, vectors, path)
+
+    def _embed(self, turns: Sequence[Turn]) -> "np.ndarray":
+        self.embedded += len(turns)
+        return self.embedder.embed([f"{prompt}\n{reply}" for prompt, reply in turns])
+
+    # ====== Кэш индексов ======
+    async def _load(self, user_id: int) -> _Index:
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+            return index
+        saved = await self.store.get("recall", user_id, default=list) if self.store is not None else []
+        index = self._indexes.get(user_id)
+        if index is None:
+            if isinstance(saved, _Index):
+                # выгруженный индекс ещё ждёт записи — берём тот же объект
+                index = saved
+            else:
+                index = self._build(user_id, saved)
+            if self.store is not None:
+                self.store.discard("recall", user_id)
+            self._indexes[user_id] = index
+            while len(self._indexes) > self.cache_users:
+                old_id, old = self._indexes.popitem(last=False)
+                self._release(old_id, old)
+        return index
+
+    def _release(self, user_id: int, index: _Index) -> None:
+        if index.path:
+            index.vectors.flush()
+        if self.store is not None:
+            self.store.discard("recall", user_id)
+
+    # ====== Публичный API ======
+    async def search(self, user_id: int, query: str, k: int, skip_recent: int = 0, min_score: float = 0.0) -> List[Turn]:
+        """До k прошлых ходов, похожих на query, в хронологическом порядке.
+
+        skip_recent последних ходов не рассматриваются: они и так идут в
+        контекст как недавняя история.
+        """
+        if not self.enabled or k <= 0:
+            return []
+        started = time.perf_counter()
+        index = await self._load(user_id)
+        n = index.count - skip_recent
+        self.searches += 1
+        if n <= 0:
+            return []
+        q = self.embedder.embed([query])[0]
+        # idf по ходам пользователя: общие для всех ходов слова почти ничего не решают
+        q *= np.log((1.0 + index.count) / (1.0 + index.df)) + 1.0
+        # признаки, которых нет ни в одном ходе, ничего не находят и только занижали бы порог
+        q[index.df == 0] = 0.0
+        norm = np.linalg.norm(q)
+        if not norm:
+            return []
+        # float16 — только формат хранения: умножение в float32 идёт через BLAS
+        scores = index.vectors[:n].astype(np.float32) @ (q / norm)
+        if k < n:
+            top = np.argpartition(scores, n - k)[n - k:]
+        else:
+            top = np.arange(n)
+        picked = sorted(int(i) for i in top if scores[i] >= min_score)
+        logger.debug("recall %s: %s", user_id, sorted((round(float(scores[i]), 3) for i in top), reverse=True))
+        self.search_seconds += time.perf_counter() - started
+        self.hits += len(picked)
+        return [index.turns[i] for i in picked]
+
+    async def add(self, user_id: int, prompt: str, reply: str) -> None:
+        """Добавляет завершённый ход: одна новая строка матрицы, без пересчёта остальных."""
+        if not self.enabled:
+            return
+        index = await self._load(user_id)
+        if index.count >= self.max_turns:
+            # сдвигаем сразу четверть: дорогое копирование раз в max_turns/4 ходов
+            drop = max(1, self.max_turns // 4)
+            kept = index.count - drop
+            index.df -= np.count_nonzero(index.vectors[:drop], axis=0).astype(np.int32)
+            index.vectors[:kept] = index.vectors[drop:index.count]
+            del index.turns[:drop]
+        elif index.count >= len(index.vectors):
+            grown = np.zeros((min(self.max_turns, 2 * len(index.vectors)), self.embedder.dim), dtype=np.float16)
+            grown[:index.count] = index.vectors[:index.count]
+            index.vectors = grown
+        turn = (prompt[:self.max_chars], reply[:self.max_chars])
+        index.vectors[index.count] = self._embed([turn])[0]
+        index.df += index.vectors[index.count] != 0
+        index.turns.append(turn)
+        if self.store is not None:
+            self.store.put("recall", user_id, index)
+
+    def clear(self, user_id: int) -> None:
+        """Забывает все ходы пользователя."""
+        index = self._indexes.pop(user_id, None)
+        if index is not None and index.path:
+            index.vectors.flush()
+        path = self._path(user_id)
+        if path and os.path.exists(path):
+            os.remove(path)
+        if self.store is not None:
+            self.store.put("recall", user_id, [])
+
+    def close(self) -> None:
+        for index in self._indexes.values():
+            if index.path:
+                index.vectors.flush()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "enabled": int(self.enabled),
+            "users": len(self._indexes),
+            "turns": sum(index.count for index in self._indexes.values()),
+            "bytes": sum(index.nbytes for index in self._indexes.values()),
+            "searches": self.searches,
+            "hits": self.hits,
+            "embedded_turns": self.embedded,
+            "search_ms_avg": round(1000 * self.search_seconds / self.searches, 3) if self.searches else 0.0,
+        }
+
+
+recall = Recall(store=state_store)
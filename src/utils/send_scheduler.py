@@ -0,0 +1,396 @@
+"""Очередь исходящих запросов к Bot API: лимиты Telegram, RetryAfter, приоритеты.
+
+Подключается к Application как rate limiter, поэтому через неё проходит
+каждый reply_text / edit_message_text без изменений в хендлерах. Запрос в
+чат ждёт жетона из двух корзин: общей для бота (~30/с) и корзины чата
+(~1/с в личный, 20/мин в группу). Внутри чата порядок сохраняется, между
+чатами первым уходит запрос с более высоким приоритетом: ответы и меню
+раньше промежуточных правок потокового ответа.
+
+Правки одного сообщения идут строго по одной. Если правка ещё ждёт в
+очереди, а пришла новая, старая не отправляется: её вызывающий получает
+результат новой. Если новую отменили до отправки, место в очереди
+возвращается предыдущей правке. RetryAfter ставит чат на паузу и
+возвращает запрос в начало его очереди. Запросы без chat_id
+(answerCallbackQuery, getMe) идут сразу.
+
+Приоритет передаётся через rate_limit_args методов бота (ExtBot);
+у Message.edit_text и других ярлыков такого аргумента нет:
+
+    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
+                                rate_limit_args=PRIORITY_PROGRESS)
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine, Deque, Dict, Hashable, List, Optional, Set, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from src.utils.metrics import metrics
+from src.config import (
+    SEND_SCHEDULER,
+    SEND_GLOBAL_RATE,
+    SEND_CHAT_RATE,
+    SEND_CHAT_BURST,
+    SEND_GROUP_PER_MIN,
+    SEND_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Меньше — раньше
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_PROGRESS = 2
+
+# Правки, которые заменяют содержимое целиком: устаревшую из очереди можно выбросить
+_COLLAPSIBLE = frozenset({"editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia"})
+# Запросы к одному сообщению не отправляются параллельно
+_PER_MESSAGE = _COLLAPSIBLE | {"deleteMessage"}
+_DEFAULT_PRIORITY = {"sendChatAction": PRIORITY_PROGRESS}
+# Корзины чатов без очереди удаляются не чаще раза в столько секунд
+_SWEEP_INTERVAL = 60.0
+# Результат для ожидающих схлопнутой правки: новую отменили, отправляйте свою
+_REQUEUE = object()
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "chat", "message", "collapse", "granted", "done", "enqueued")
+
+    def __init__(self, priority: int, seq: int, chat: Hashable,
+                 message: Optional[Tuple[Hashable, int]], collapse: Optional[Tuple[str, Hashable, int]]):
+        self.priority = priority
+        self.seq = seq
+        self.chat = chat
+        self.message = message
+        self.collapse = collapse
+        # None — можно отправлять, _Job — запрос заменён более новой правкой
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+        # результат для тех, чьи правки схлопнуты в эту
+        self.done: Optional[asyncio.Future] = None
+        self.enqueued = time.monotonic()
+
+
+class _Chat:
+    __slots__ = ("bucket", "jobs", "paused_until")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs: Deque[_Job] = deque()
+        self.paused_until = 0.0
+
+
+class SendScheduler(BaseRateLimiter):
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: int = 3,
+        group_per_min: float = 20.0,
+        max_retries: int = 3,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_min / 60.0
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Hashable, _Chat] = {}
+        self._pending: Set[Hashable] = set()  # чаты с непустой очередью
+        self._edits: Dict[Tuple[str, Hashable, int], _Job] = {}
+        self._in_flight: Set[Tuple[Hashable, int]] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._seq = 0
+        self._swept_at = 0.0
+        self.sent = 0
+        self.collapsed = 0
+        self.retried = 0
+
+    # ====== BaseRateLimiter ======
+    async def initialize(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        # оставшиеся запросы отпускаем без лимита, чтобы никто не завис
+        for chat in self._chats.values():
+            while chat.jobs:
+                job = chat.jobs.popleft()
+                if not job.granted.done():
+                    job.granted.set_result(None)
+        self._pending.clear()
+        self._edits.clear()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat = data.get("chat_id")
+        if chat is None or self._task is None:
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else _DEFAULT_PRIORITY.get(endpoint, PRIORITY_NORMAL)
+        message_id = data.get("message_id")
+        message = (chat, message_id) if endpoint in _PER_MESSAGE and message_id else None
+        collapse = (endpoint, chat, message_id) if endpoint in _COLLAPSIBLE and message_id else None
+        job = self._submit(chat, priority, message, collapse)
+
+        attempt = 0
+        while True:
+            try:
+                newer = await job.granted
+            except asyncio.CancelledError:
+                self._withdraw(job)
+                raise
+            if newer is not None:
+                result = await asyncio.shield(newer.done)
+                if result is not _REQUEUE:
+                    return result
+                # более новую правку отменили до отправки — в очередь снова идёт эта
+                job = self._submit(chat, priority, message, collapse)
+                continue
+
+            metrics.observe("telegram_queue_wait", time.monotonic() - job.enqueued)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._release(job)
+                if attempt >= self.max_retries:
+                    self._finish(job, error=e)
+                    raise
+                attempt += 1
+                self._retry(job, float(e.retry_after))
+                continue
+            except BaseException as e:
+                self._release(job)
+                self._finish(job, error=e)
+                raise
+            self._release(job)
+            self._finish(job, result=result)
+            return result
+
+    # ====== Очередь ======
+    def _chat(self, chat: Hashable) -> _Chat:
+        state = self._chats.get(chat)
+        if state is None:
+            group = isinstance(chat, str) or chat < 0
+            bucket = TokenBucket(self.group_rate, self.chat_burst) if group else TokenBucket(self.chat_rate, self.chat_burst)
+            state = self._chats[chat] = _Chat(bucket)
+        return state
+
+    def _submit(self, chat: Hashable, priority: int, message, collapse) -> _Job:
+        state = self._chat(chat)
+        old = self._edits.get(collapse) if collapse is not None else None
+        if old is not None:
+            # та же правка ещё в очереди: новая занимает её место, старую не отправляем
+            job = _Job(min(priority, old.priority), old.seq, chat, message, collapse)
+            job.enqueued = old.enqueued
+            if old.done is not None and not old.done.done():
+                job.done = old.done
+            else:
+                job.done = asyncio.get_running_loop().create_future()
+                job.done.add_done_callback(_consume)
+            state.jobs[state.jobs.index(old)] = job
+            self._edits[collapse] = job
+            if not old.granted.done():
+                old.granted.set_result(job)
+            self.collapsed += 1
+            metrics.inc("telegram_edits_collapsed")
+            return job
+
+        self._seq += 1
+        job = _Job(priority, self._seq, chat, message, collapse)
+        state.jobs.append(job)
+        if collapse is not None:
+            self._edits[collapse] = job
+        self._pending.add(chat)
+        self._wakeup.set()
+        return job
+
+    def _withdraw(self, job: _Job) -> None:
+        """Вызывающий отменён, пока запрос ждал очереди.
+
+        Если в этот запрос схлопнуты более старые правки, их вызывающие не
+        отменялись: они получают _REQUEUE и ставят свою правку снова. Запрос
+        остаётся в очереди пустым местом, и первая из них занимает его место
+        (см. _submit); диспетчер пустое место пропускает.
+        """
+        granted = job.granted
+        if granted.done() and not granted.cancelled():
+            if granted.result() is None:
+                # очередь уже пропустила запрос, но отправлять его некому
+                self._release(job)
+                if job.done is not None and not job.done.done():
+                    job.done.set_result(_REQUEUE)
+            return  # иначе запрос заменён новым, его ждут через newer.done
+        if not granted.done():
+            granted.cancel()
+        if job.done is not None and not job.done.done():
+            job.done.set_result(_REQUEUE)
+            return
+        state = self._chats.get(job.chat)
+        if state is not None and job in state.jobs:
+            state.jobs.remove(job)
+            if not state.jobs:
+                self._pending.discard(job.chat)
+        if job.collapse is not None and self._edits.get(job.collapse) is job:
+            del self._edits[job.collapse]
+
+    def _retry(self, job: _Job, retry_after: float) -> None:
+        self.retried += 1
+        metrics.inc("telegram_retry_after")
+        logger.warning("[TG] RetryAfter %.1f с для чата %s", retry_after, job.chat)
+        state = self._chat(job.chat)
+        state.paused_until = max(state.paused_until, time.monotonic() + retry_after)
+        job.granted = asyncio.get_running_loop().create_future()
+        state.jobs.appendleft(job)
+        self._pending.add(job.chat)
+        self._wakeup.set()
+
+    def _release(self, job: _Job) -> None:
+        if job.message is not None:
+            self._in_flight.discard(job.message)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    @staticmethod
+    def _finish(job: _Job, result: Any = None, error: Optional[BaseException] = None) -> None:
+        if job.done is None or job.done.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            job.done.cancel()
+        elif error is not None:
+            job.done.set_exception(error)
+        else:
+            job.done.set_result(result)
+
+    # ====== Диспетчер ======
+    def _pick(self, now: float) -> Tuple[Optional[Hashable], float]:
+        """Чат, чей первый запрос можно отправить сейчас, и время ближайшей готовности."""
+        best = None
+        best_rank = None
+        wake = float("inf")
+        for chat in self._pending:
+            state = self._chats[chat]
+            job = state.jobs[0]
+            if job.message is not None and job.message in self._in_flight:
+                continue  # разбудит _release
+            ready = max(state.paused_until, state.bucket.ready_at(now))
+            if ready > now:
+                wake = min(wake, ready)
+                continue
+            rank = (job.priority, job.seq)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = chat, rank
+        return best, wake
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            chat, wake = self._pick(now)
+            if chat is None:
+                timeout = None if wake == float("inf") else wake - now
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_at = self._global.ready_at(now)
+            if global_at > now:
+                await asyncio.sleep(global_at - now)
+                continue
+
+            state = self._chats[chat]
+            job = state.jobs.popleft()
+            if not state.jobs:
+                self._pending.discard(chat)
+            if job.collapse is not None and self._edits.get(job.collapse) is job:
+                del self._edits[job.collapse]
+            if job.granted.done():
+                continue  # вызывающий уже отменён
+            state.bucket.take(now)
+            self._global.take(now)
+            if job.message is not None:
+                self._in_flight.add(job.message)
+            self.sent += 1
+            job.granted.set_result(None)
+
+            if now - self._swept_at > _SWEEP_INTERVAL:
+                self._sweep(now)
+
+    def _sweep(self, now: float) -> None:
+        self._swept_at = now
+        idle = [
+            chat for chat, state in self._chats.items()
+            if not state.jobs and state.paused_until <= now and state.bucket.full(now)
+        ]
+        for chat in idle:
+            del self._chats[chat]
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        return {
+            "queued": sum(len(self._chats[chat].jobs) for chat in self._pending),
+            "chats": len(self._chats),
+            "paused_chats": sum(1 for state in self._chats.values() if state.paused_until > now),
+            "sent": self.sent,
+            "collapsed": self.collapsed,
+            "retry_after": self.retried,
+        }
+
+
+def _consume(future: asyncio.Future) -> None:
+    # ошибку получают ожидающие; если их уже нет, не шумим в лог
+    if not future.cancelled():
+        future.exception()
+
+
+send_scheduler: Optional[SendScheduler] = SendScheduler(
+    global_rate=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    group_per_min=SEND_GROUP_PER_MIN,
+    max_retries=SEND_MAX_RETRIES,
+) if SEND_SCHEDULER else None
@@ -0,0 +1,430 @@
+"""Несколько процессов: один приёмник апдейтов и SHARD_WORKERS обработчиков.
+
+Приёмник получает апдейты (polling или вебхук) и, не разбирая их в объекты
+PTB, отправляет в процесс-обработчик по user_id. Владелец выбирается
+рандеву-хешированием (HRW): у пользователя всегда один обработчик, порядок
+его сообщений и память диалога остаются в одном процессе, а при выводе
+обработчика из кольца переезжают только его пользователи.
+
+Обработчик — обычное Application из build_app() без Updater; апдейты
+приходят по multiprocessing.Pipe. Перед каналом в приёмнике стоит очередь:
+пока обработчик перезапускается, его апдейты ждут в ней (при падении
+теряется только то, что уже было в канале).
+(multiprocessing.Queue не подходит: процесс, убитый внутри get(), навсегда
+оставляет её блокировку занятой.)
+
+Общее между процессами:
+- состояние пользователей — SQLite в режиме WAL (STATE_DB_PATH);
+- паузы API-ключей после 429 — та же база, обмен раз в SHARD_SYNC_INTERVAL;
+- лимит параллельных запросов на ключ и общий лимит отправки в Telegram
+  делятся между обработчиками поровну.
+Лимиты запросов пользователя остаются локальными: пользователь живёт в одном
+процессе.
+
+SIGINT/SIGTERM — мягкая остановка: обработчики дорабатывают очередь и
+доставляют начатые ответы. SIGHUP — поочерёдный перезапуск обработчиков.
+Упавший обработчик перезапускается; упавший SHARD_RESTART_LIMIT раз за
+минуту выводится из кольца, его очередь перераспределяется.
+
+    SHARD_WORKERS=4 python -m src.bot
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, List, Optional
+
+import httpx
+from telegram import Bot, Update
+
+from src.config import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_API_BASE_URL,
+    BOT_MODE,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_MAX_BODY,
+    SHUTDOWN_DRAIN_TIMEOUT,
+    STATE_IMPORT_FILE,
+    AI_KEY_MAX_IN_FLIGHT,
+    SEND_GLOBAL_RATE,
+    METRICS_PORT,
+    SHARD_RESTART_LIMIT,
+)
+from src.utils.http_server import HttpServer
+from src.utils.webhook import WebhookReceiver, webhook_secret
+
+logger = logging.getLogger(__name__)
+
+# Long polling в приёмнике
+_POLL_TIMEOUT = 30
+# Окно, в котором считаются падения обработчика
+_CRASH_WINDOW = 60.0
+# Пауза перед перезапуском упавшего обработчика
+_RESTART_DELAY = 1.0
+
+
+# ====== Маршрутизация ======
+def update_user_id(data: dict) -> int:
+    """user_id автора апдейта из сырого JSON; без автора — чат, иначе 0."""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user"):
+            user = value.get(field)
+            if isinstance(user, dict) and "id" in user:
+                return int(user["id"])
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return 0
+
+
+class RendezvousRing:
+    """Рандеву-хеширование: владелец ключа — участник с наибольшим весом hash(ключ, участник)."""
+
+    def __init__(self, members: Iterable[int]):
+        self.members: List[int] = sorted(members)
+
+    @staticmethod
+    def _weight(key: int, member: int) -> int:
+        digest = hashlib.blake2b(f"{key}:{member}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def owner(self, key: int) -> int:
+        return max(self.members, key=lambda member: self._weight(key, member))
+
+    def remove(self, member: int) -> None:
+        self.members.remove(member)
+
+
+# ====== Процесс-обработчик ======
+def worker_main(index: int, conn) -> None:
+    """Точка входа обработчика. Останавливается по None из канала или при закрытии канала приёмником."""
+    # сигналы терминала и systemd получает вся группа процессов — останавливает приёмник
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(_serve(index, conn))
+
+
+async def _serve(index: int, conn) -> None:
+    from src.bot import build_app
+
+    app = build_app()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    logger.info("Обработчик %d запущен (pid %d)", index, os.getpid())
+    loop = asyncio.get_running_loop()
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-recv")
+    received = 0
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(reader, conn.recv)
+            except (EOFError, OSError):
+                logger.warning("Обработчик %d: приёмник закрыл канал", index)
+                break
+            if data is None:
+                break
+            received += 1
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        # update_fetcher дорабатывает очередь, затем post_stop дожидается ответов ИИ
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        reader.shutdown(wait=False)
+        logger.info("Обработчик %d остановлен, апдейтов: %d", index, received)
+
+
+# ====== Приёмник ======
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.conn = None
+        self.sender: Optional[asyncio.Task] = None
+        self.pending: Deque[dict] = deque()
+        self.wakeup = asyncio.Event()
+        self.draining = False
+        self.crashes: Deque[float] = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-send-{index}")
+        self.sent = 0
+        self.restarts = 0
+
+
+class ShardIngress:
+    def __init__(self, workers: int, restart_limit: int = SHARD_RESTART_LIMIT):
+        self.size = workers
+        self.restart_limit = restart_limit
+        self._ctx = multiprocessing.get_context("spawn")
+        self.workers: Dict[int, _Worker] = {i: _Worker(i) for i in range(workers)}
+        self.ring = RendezvousRing(self.workers)
+        self.received = 0
+        self.rebalanced = 0
+
+    # ====== Обработчики ======
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        """Настройки процесса-обработчика: его доля общих лимитов."""
+        return {
+            "SHARD_WORKERS": str(self.size),
+            "AI_KEY_MAX_IN_FLIGHT": str(max(1, AI_KEY_MAX_IN_FLIGHT // self.size)),
+            "SEND_GLOBAL_RATE": str(SEND_GLOBAL_RATE / self.size),
+            "METRICS_PORT": str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+            "STATE_IMPORT_FILE": "",  # импорт уже сделал приёмник
+        }
+
+    def _start(self, w: _Worker) -> None:
+        receiver, sender = self._ctx.Pipe(duplex=False)
+        # spawn копирует окружение в момент start()
+        os.environ.update(self._worker_env(w.index))
+        w.process = self._ctx.Process(target=worker_main, args=(w.index, receiver), name=f"shard-{w.index}")
+        w.process.start()
+        receiver.close()
+        w.conn = sender
+        w.draining = False
+        w.sender = asyncio.create_task(self._send_loop(w, sender))
+
+    async def _send_loop(self, w: _Worker, conn) -> None:
+        loop = asyncio.get_running_loop()
+        sending: Optional[asyncio.Future] = None
+        data = None
+        try:
+            while True:
+                if not w.pending:
+                    if w.draining:
+                        data = None
+                        sending = loop.run_in_executor(w.executor, conn.send, None)
+                        await asyncio.shield(sending)
+                        return
+                    w.wakeup.clear()
+                    await w.wakeup.wait()
+                    continue
+                # снимаем до отправки: если задачу отменят, когда send в потоке уже прошёл,
+                # перезапущенный обработчик не получит апдейт второй раз
+                data = w.pending.popleft()
+                sending = loop.run_in_executor(w.executor, conn.send, data)
+                await asyncio.shield(sending)
+                sending = None
+                w.sent += 1
+        except (OSError, EOFError, ValueError):
+            # обработчик умер; неотправленный апдейт вернётся в очередь ниже
+            return
+        finally:
+            if sending is not None:
+                # отмена не прерывает send в потоке: дожидаемся его, прежде чем закрыть pipe
+                await asyncio.wait([sending])
+                if data is not None:
+                    if sending.cancelled() or sending.exception() is not None:
+                        w.pending.appendleft(data)
+                    else:
+                        w.sent += 1
+            conn.close()
+
+    async def _stop(self, w: _Worker, timeout: float) -> None:
+        """Отправляет накопленное, затем None; ждёт, пока обработчик доработает."""
+        if w.process is None:
+            return
+        w.draining = True
+        w.wakeup.set()
+        if w.sender is not None:
+            await w.sender
+        await asyncio.get_running_loop().run_in_executor(None, w.process.join, timeout)
+        if w.process.is_alive():
+            logger.warning("Обработчик %d не остановился за %.0f с, завершаем", w.index, timeout)
+            w.process.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, w.process.join, 5)
+        w.process = None
+
+    async def restart_all(self) -> None:
+        """Поочерёдный перезапуск: апдейты пользователей обработчика ждут в его очереди."""
+        for index in list(self.ring.members):
+            w = self.workers[index]
+            logger.info("Перезапуск обработчика %d", index)
+            await self._stop(w, SHUTDOWN_DRAIN_TIMEOUT + 10)
+            w.restarts += 1
+            self._start(w)
+
+    async def supervise(self) -> None:
+        while True:
+            await asyncio.sleep(0.5)
+            for index in list(self.ring.members):
+                w = self.workers[index]
+                if w.process is None or w.draining or w.process.is_alive():
+                    continue
+                logger.error("Обработчик %d упал (код %s)", index, w.process.exitcode)
+                if w.sender is not None:
+                    w.sender.cancel()
+                    await asyncio.gather(w.sender, return_exceptions=True)
+                now = time.monotonic()
+                w.crashes.append(now)
+                while w.crashes and w.crashes[0] < now - _CRASH_WINDOW:
+                    w.crashes.popleft()
+                if len(w.crashes) >= self.restart_limit and len(self.ring.members) > 1:
+                    self._evict(w)
+                    continue
+                await asyncio.sleep(_RESTART_DELAY)
+                w.restarts += 1
+                self._start(w)
+
+    def _evict(self, w: _Worker) -> None:
+        """Выводит обработчик из кольца; его пользователи и очередь переезжают к остальным."""
+        self.ring.remove(w.index)
+        w.process = None
+        moved = len(w.pending)
+        while w.pending:
+            self.dispatch(w.pending.popleft(), count=False)
+        self.rebalanced += moved
+        logger.error(
+            "Обработчик %d падает слишком часто — выведен из кольца, перенесено апдейтов: %d", w.index, moved
+        )
+
+    # ====== Апдейты ======
+    def dispatch(self, data: dict, count: bool = True) -> None:
+        if count:
+            self.received += 1
+        w = self.workers[self.ring.owner(update_user_id(data))]
+        w.pending.append(data)
+        w.wakeup.set()
+
+    async def deliver(self, data: dict) -> None:
+        self.dispatch(data)
+
+    async def poll(self, bot: Bot) -> None:
+        """Long polling: сырые апдейты без разбора в объекты PTB."""
+        await bot.delete_webhook()
+        url = f"{TELEGRAM_API_BASE_URL}{TELEGRAM_BOT_TOKEN}/getUpdates"
+        offset = 0
+        async with httpx.AsyncClient(timeout=httpx.Timeout(_POLL_TIMEOUT + 10, connect=10)) as client:
+            try:
+                while True:
+                    try:
+                        resp = await client.post(url, json={
+                            "offset": offset, "timeout": _POLL_TIMEOUT, "allowed_updates": Update.ALL_TYPES,
+                        })
+                        resp.raise_for_status()
+                        updates = resp.json()["result"]
+                    except (httpx.HTTPError, ValueError, KeyError) as e:
+                        logger.warning("getUpdates: %s", e)
+                        await asyncio.sleep(3)
+                        continue
+                    for data in updates:
+                        offset = max(offset, int(data["update_id"]) + 1)
+                        self.dispatch(data)
+            finally:
+                # подтверждаем полученное, чтобы Telegram не прислал его снова после перезапуска
+                if offset:
+                    try:
+                        await client.post(url, json={"offset": offset, "timeout": 0})
+                    except httpx.HTTPError:
+                        pass
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "received": self.received,
+            "rebalanced": self.rebalanced,
+            "workers": {
+                w.index: {
+                    "alive": w.process is not None and w.process.is_alive(),
+                    "pending": len(w.pending),
+                    "sent": w.sent,
+                    "restarts": w.restarts,
+                }
+                for w in self.workers.values()
+            },
+        }
+
+
+async def _import_state() -> None:
+    """Разовый импорт settings.json — в приёмнике, до запуска обработчиков."""
+    from src.utils.state_store import state_store
+
+    await state_store.start()
+    try:
+        await state_store.import_settings_json(STATE_IMPORT_FILE)
+    finally:
+        await state_store.close()
+
+
+async def run_sharded(workers: int, stop_event: Optional[asyncio.Event] = None) -> None:
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    ingress = ShardIngress(workers)
+    restart_requested = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        loop.add_signal_handler(signal.SIGHUP, restart_requested.set)
+    except (NotImplementedError, RuntimeError, AttributeError):
+        pass
+
+    # до запуска обработчиков: без секрета вебхук не стартует
+    secret = webhook_secret() if BOT_MODE == "webhook" else ""
+    if STATE_IMPORT_FILE:
+        await _import_state()
+    for w in ingress.workers.values():
+        ingress._start(w)
+
+    bot = Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_BASE_URL)
+    await bot.initialize()
+    server: Optional[HttpServer] = None
+    receiver: Optional[WebhookReceiver] = None
+    if BOT_MODE == "webhook":
+        receiver = WebhookReceiver(ingress.deliver, secret)
+        server = HttpServer(WEBHOOK_HOST, WEBHOOK_PORT, max_body=WEBHOOK_MAX_BODY)
+        server.route("POST", WEBHOOK_PATH, receiver.handle)
+        await server.start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+            logger.info("Вебхук зарегистрирован: %s", WEBHOOK_URL)
+        source = None
+    else:
+        source = asyncio.create_task(ingress.poll(bot))
+    supervisor = asyncio.create_task(ingress.supervise())
+
+    async def restarts() -> None:
+        while True:
+            await restart_requested.wait()
+            restart_requested.clear()
+            await ingress.restart_all()
+
+    restarter = asyncio.create_task(restarts())
+    logger.info("Приёмник запущен, обработчиков: %d", workers)
+    try:
+        await stop_event.wait()
+        logger.info("Остановка: новые апдейты больше не принимаются")
+    finally:
+        if receiver is not None:
+            receiver.accepting = False
+        if server is not None:
+            await server.close()
+        for task in (source, supervisor, restarter):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await asyncio.gather(*(
+            ingress._stop(ingress.workers[i], SHUTDOWN_DRAIN_TIMEOUT + 10) for i in ingress.ring.members
+        ))
+        await bot.shutdown()
+        logger.info("Приёмник остановлен: %s", ingress.stats())
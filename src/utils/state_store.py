@@ -0,0 +1,321 @@
+"""Постоянное хранилище состояния пользователей.
+
+SQLite в режиме WAL, все обращения к базе — в одном выделенном потоке,
+event loop не блокируется. Перед базой — LRU-кэш горячих записей;
+изменения не пишутся сразу, а помечаются «грязными» и сбрасываются
+пачкой раз в flush_interval секунд (write-behind). При старте в память
+ничего не загружается: запись пользователя читается при первом обращении.
+
+Разовый импорт старого settings.json:
+
+    python -m src.utils.state_store import settings.json
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.config import STATE_DB_PATH, STATE_CACHE_SIZE, STATE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, int]  # (пространство имён, user_id)
+
+# Значения языка в старом settings.json -> подписи в меню
+_LANG_ALIASES = {"RU": "Русский", "EN": "English"}
+# Поля settings.json, которые читает бот: model/lang/spec — выбор в меню, temp — температура ответа
+_IMPORT_FIELDS = ("model", "temp", "lang", "spec")
+
+
+def _dumps(value: Any) -> str:
+    # default=list — чтобы объект истории сериализовался без копирования заранее
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=list)
+
+
+class StateStore:
+    def __init__(
+        self,
+        path: str,
+        cache_size: int = STATE_CACHE_SIZE,
+        flush_interval: float = STATE_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
+        self._db: Optional[sqlite3.Connection] = None
+        self._cache: "OrderedDict[Key, Any]" = OrderedDict()
+        self._dirty: Dict[Key, Any] = {}  # ключ -> значение на момент последней пометки
+        self._loading: Dict[Key, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.reads = 0
+        self.writes = 0
+
+    # ====== Поток базы ======
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open_sync(self) -> None:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            "ns TEXT NOT NULL, user_id INTEGER NOT NULL, data TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (ns, user_id)) WITHOUT ROWID"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS shared_until (name TEXT PRIMARY KEY, until REAL NOT NULL)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "scope TEXT NOT NULL, name TEXT NOT NULL, period TEXT NOT NULL, "
+            "prompt INTEGER NOT NULL, completion INTEGER NOT NULL, requests INTEGER NOT NULL, "
+            "PRIMARY KEY (scope, name, period)) WITHOUT ROWID"
+        )
+        db.commit()
+        self._db = db
+
+    def _load_sync(self, key: Key) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT data FROM user_state WHERE ns = ? AND user_id = ?", key
+        ).fetchone()
+        return row[0] if row else None
+
+    def _write_sync(self, rows: List[Tuple[str, int, str, float]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO user_state (ns, user_id, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ns, user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                rows,
+            )
+
+    def _meta_get_sync(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _meta_set_sync(self, key: str, value: str) -> None:
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _share_sync(self, rows: List[Tuple[str, float]], now: float) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO shared_until (name, until) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET until = MAX(until, excluded.until)",
+                rows,
+            )
+            self._db.execute("DELETE FROM shared_until WHERE until < ?", (now,))
+
+    def _shared_sync(self, now: float) -> Dict[str, float]:
+        return dict(self._db.execute("SELECT name, until FROM shared_until WHERE until > ?", (now,)))
+
+    def _usage_add_sync(self, rows: List[Tuple[str, str, str, int, int, int]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO usage (scope, name, period, prompt, completion, requests) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (scope, name, period) DO UPDATE SET prompt = prompt + excluded.prompt, "
+                "completion = completion + excluded.completion, requests = requests + excluded.requests",
+                rows,
+            )
+
+    def _usage_get_sync(self, scope: str, name: str, periods: List[str]) -> Dict[str, Tuple[int, int, int]]:
+        marks = ",".join("?" * len(periods))
+        rows = self._db.execute(
+            f"SELECT period, prompt, completion, requests FROM usage "
+            f"WHERE scope = ? AND name = ? AND period IN ({marks})",
+            (scope, name, *periods),
+        )
+        return {period: (prompt, completion, requests) for period, prompt, completion, requests in rows}
+
+    def _close_sync(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # ====== Жизненный цикл ======
+    async def _ensure_open(self) -> None:
+        if self._db is None:
+            await self._run(self._open_sync)
+
+    async def start(self) -> None:
+        await self._ensure_open()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self._db is not None:
+            await self.flush()
+            await self._run(self._close_sync)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить состояние пользователей")
+
+    # ====== Кэш ======
+    def _remember(self, key: Key, value: Any) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            # грязные записи не теряются: их значение уже лежит в _dirty до сброса
+            self._cache.popitem(last=False)
+
+    async def get(self, ns: str, user_id: int, default: Callable[[], Any] = dict) -> Any:
+        """Значение из кэша или базы; если записи нет — default() (не сохраняется сам)."""
+        key = (ns, user_id)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if key in self._dirty:
+            value = self._dirty[key]
+            self._remember(key, value)
+            return value
+
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            await self._ensure_open()
+            raw = await self._run(self._load_sync, key)
+            self.reads += 1
+            value = json.loads(raw) if raw is not None else default()
+            # пока читали, запись могли изменить и положить в _dirty
+            value = self._dirty.get(key, self._cache.get(key, value))
+            self._remember(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(key, None)
+
+    def put(self, ns: str, user_id: int, value: Any) -> None:
+        """Запоминает значение и ставит его в очередь на запись.
+
+        Вызывается и после изменения на месте объекта, полученного из get().
+        """
+        key = (ns, user_id)
+        self._remember(key, value)
+        self._dirty[key] = value
+
+    def discard(self, ns: str, user_id: int) -> None:
+        """Убирает запись из горячего кэша; несохранённое изменение всё равно будет записано."""
+        self._cache.pop((ns, user_id), None)
+
+    # ====== Общие сроки между процессами ======
+    async def share_until(self, items: Dict[str, float]) -> None:
+        """Публикует сроки (time.time()) для других процессов, например паузы API-ключей."""
+        await self._ensure_open()
+        await self._run(self._share_sync, list(items.items()), time.time())
+
+    async def shared_until(self) -> Dict[str, float]:
+        """Ещё не истёкшие сроки, опубликованные любым процессом."""
+        await self._ensure_open()
+        return await self._run(self._shared_sync, time.time())
+
+    # ====== Расход токенов ======
+    async def add_usage(self, rows: List[Tuple[str, str, str, int, int, int]]) -> None:
+        """Прибавляет к счётчикам (scope, name, period) приращения (prompt, completion, requests)."""
+        await self._ensure_open()
+        await self._run(self._usage_add_sync, rows)
+
+    async def usage(self, scope: str, name: str, periods: List[str]) -> Dict[str, Tuple[int, int, int]]:
+        """Сохранённые счётчики по периодам: {period: (prompt, completion, requests)}."""
+        await self._ensure_open()
+        return await self._run(self._usage_get_sync, scope, name, periods)
+
+    async def flush(self) -> None:
+        """Записывает все изменения одной транзакцией."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            now = time.time()
+            # сериализуем в loop-потоке: значения могут меняться обработчиками
+            rows = [(ns, uid, _dumps(value), now) for (ns, uid), value in dirty.items()]
+            try:
+                await self._ensure_open()
+                await self._run(self._write_sync, rows)
+                self.writes += len(rows)
+            except BaseException:
+                # вернём несохранённое, не затирая более свежие пометки
+                for key, value in dirty.items():
+                    self._dirty.setdefault(key, value)
+                raise
+
+    # ====== Импорт settings.json ======
+    async def import_settings_json(self, path: str, force: bool = False) -> int:
+        """Разовый импорт {user_id: {model, temp, lang, ...}} в пространство "user".
+
+        Переносятся только поля, которые бот читает (_IMPORT_FIELDS);
+        history и theme старого формата отбрасываются.
+        """
+        await self._ensure_open()
+        marker = f"imported:{path}"
+        if not force and await self._run(self._meta_get_sync, marker):
+            return 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+
+        for raw_id, settings in data.items():
+            user_id = int(raw_id)
+            state = await self.get("user", user_id)
+            for field, value in settings.items():
+                if field not in _IMPORT_FIELDS:
+                    continue
+                if field == "lang":
+                    value = _LANG_ALIASES.get(str(value).upper(), value)
+                state.setdefault(field, value)
+            self.put("user", user_id, state)
+        await self.flush()
+        await self._run(self._meta_set_sync, marker, str(time.time()))
+        logger.info("Импортированы настройки %d пользователей из %s", len(data), path)
+        return len(data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "reads": self.reads,
+            "writes": self.writes,
+        }
+
+
+state_store = StateStore(STATE_DB_PATH)
+
+
+async def _cli(argv: List[str]) -> None:
+    if len(argv) != 2 or argv[0] != "import":
+        print("Использование: python -m src.utils.state_store import settings.json")
+        return
+    count = await state_store.import_settings_json(argv[1], force=True)
+    await state_store.close()
+    print(f"Импортировано пользователей: {count}")
+
+
+if __name__ == "__main__":
+    asyncio.run(_cli(sys.argv[1:]))
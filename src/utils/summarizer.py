@@ -0,0 +1,142 @@
+"""Фоновый конспект ранней части диалога.
+
+Когда в памяти пользователя набирается trigger сообщений, старые (все,
+кроме keep_recent последних) сворачиваются в конспект дешёвым вызовом
+модели: на вход идут прежний конспект и только новые реплики, так что
+конспект обновляется, а не пересчитывается с нуля. Вызов идёт в фоне
+после доставки ответа и не задерживает его. Конспект хранится в
+state_store (пространство "summary") и добавляется в контекст вместо
+свёрнутых реплик.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from src.ai_providers.openai_compatible import REQUEST_REJECTED, ask_ai
+from src.config import (
+    SUMMARY_ENABLED,
+    SUMMARY_TRIGGER,
+    SUMMARY_KEEP_RECENT,
+    SUMMARY_MAX_WORDS,
+    SUMMARY_MODEL,
+    SUMMARY_CONCURRENCY,
+)
+from src.utils.memory import Message, SimpleMemory, user_memory
+from src.utils.state_store import state_store
+
+logger = logging.getLogger(__name__)
+
+_ROLE_NAMES = {"user": "Пользователь", "assistant": "Ассистент"}
+
+_INSTRUCTIONS = (
+    "Ты ведёшь краткий конспект диалога пользователя с ассистентом. "
+    "Обнови конспект с учётом новых реплик: сохрани факты о пользователе, "
+    "имена, числа, принятые решения и открытые вопросы, убери повторы. "
+    "Пиши сжато, без вступлений, не длиннее {max_words} слов."
+)
+
+
+def summary_prompt(previous: str, messages: List[Message], max_words: int) -> List[Dict[str, str]]:
+    lines = "\n".join(f"{_ROLE_NAMES.get(m.role, m.role)}: {m.content}" for m in messages)
+    return [
+        {"role": "system", "content": _INSTRUCTIONS.format(max_words=max_words)},
+        {"role": "user", "content": f"Текущий конспект:\n{previous or '(пусто)'}\n\nНовые реплики:\n{lines}"},
+    ]
+
+
+class Summarizer:
+    def __init__(
+        self,
+        memory: SimpleMemory,
+        store,
+        ask: Callable[..., Awaitable[str]] = ask_ai,
+        trigger: int = SUMMARY_TRIGGER,
+        keep_recent: int = SUMMARY_KEEP_RECENT,
+        max_words: int = SUMMARY_MAX_WORDS,
+        model: str = SUMMARY_MODEL,
+        concurrency: int = SUMMARY_CONCURRENCY,
+        enabled: bool = SUMMARY_ENABLED,
+    ):
+        if keep_recent >= trigger:
+            raise ValueError("SUMMARY_KEEP_RECENT должен быть меньше SUMMARY_TRIGGER")
+        self.memory = memory
+        self.store = store
+        self._ask = ask
+        self.trigger = trigger
+        self.keep_recent = keep_recent
+        self.max_words = max_words
+        self.model = model
+        self.enabled = enabled
+        self._slots = asyncio.Semaphore(concurrency)
+        self._running: Dict[int, asyncio.Task] = {}
+        self.runs = 0
+        self.folded = 0
+        self.failed = 0
+
+    async def get(self, user_id: int) -> str:
+        record = await self.store.get("summary", user_id)
+        return record.get("text", "")
+
+    def clear(self, user_id: int) -> None:
+        self.store.put("summary", user_id, {})
+
+    def schedule(self, user_id: int) -> None:
+        """Запускает свёртку в фоне, если история доросла до порога (не чаще одной на пользователя)."""
+        if not self.enabled or user_id in self._running:
+            return
+        if self.memory.count(user_id) < self.trigger:
+            return
+        task = asyncio.create_task(self._fold(user_id))
+        self._running[user_id] = task
+        task.add_done_callback(lambda _: self._running.pop(user_id, None))
+
+    async def _fold(self, user_id: int) -> None:
+        async with self._slots:
+            head = self.memory.oldest(user_id, self.memory.count(user_id) - self.keep_recent)
+            if not head:
+                return
+            record = await self.store.get("summary", user_id)
+            try:
+                text = await self._ask(
+                    summary_prompt(record.get("text", ""), head, self.max_words),
+                    model=self.model,
+                    temperature=0.2,
+                    use_cache=False,
+                )
+            except Exception as e:
+                self.failed += 1
+                logger.warning("Не удалось обновить конспект пользователя %s: %s", user_id, e)
+                return
+            text = text.strip()
+            if not text or text == REQUEST_REJECTED:
+                self.failed += 1
+                return
+            # пока шёл запрос, начало истории могло уйти по лимиту — тогда свернём в следующий раз
+            if not self.memory.drop_oldest(user_id, head):
+                return
+            self.store.put("summary", user_id, {
+                "text": text,
+                "messages": record.get("messages", 0) + len(head),
+                "updated_at": time.time(),
+            })
+            self.runs += 1
+            self.folded += len(head)
+
+    async def close(self) -> None:
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": len(self._running),
+            "runs": self.runs,
+            "folded_messages": self.folded,
+            "failed": self.failed,
+        }
+
+
+summarizer = Summarizer(user_memory, state_store)
@@ -0,0 +1,254 @@
+"""Markdown ответа ИИ -> HTML-подмножество Telegram.
+
+Один линейный проход: строки разбираются на блоки (абзацы, списки, цитаты,
+блоки кода), строки внутри блока — токенизатором инлайн-разметки со стеком,
+поэтому теги всегда сбалансированы, а незакрытые маркеры остаются текстом.
+Весь текст вне тегов экранируется (& < >).
+
+split_messages() режет результат на сообщения не длиннее лимита Telegram
+по границам абзацев/блоков кода; слишком длинный блок режется внутри с
+закрытием и повторным открытием тегов.
+"""
+import re
+from html import escape
+from typing import List, NamedTuple, Tuple
+
+_FENCE_RE = re.compile(r"^\s*```\s*([\w+#.-]*)\s*$")
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET_RE = re.compile(r"^\s*[*\-+]\s+")
+_ORDERED_RE = re.compile(r"^(\s*)(\d+)\.\s+")
+_QUOTE_RE = re.compile(r"^\s*>\s?")
+
+# Инлайн-токены: код, ссылка, маркеры выделения
+_INLINE_RE = re.compile(
+    r"(?P<code>`+)(?P<code_body>.+?)(?P=code)"
+    r"|\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>https?://[^\s)]+)\)"
+    r"|(?P<mark>\*\*|\*|~~)"
+)
+_MARK_TAGS = {"**": "b", "*": "i", "~~": "s"}
+
+# Токены готового HTML для нарезки: тег, сущность, текст
+_HTML_TOKEN_RE = re.compile(r"<(/?)([a-z-]+)[^>]*>|&[#\w]+;|[^<&]+")
+
+
+class Block(NamedTuple):
+    html: str
+    blank_before: bool  # была ли пустая строка перед блоком в исходнике
+
+
+def _render_inline(line: str) -> str:
+    """Инлайн-разметка одной строки; незакрытые маркеры остаются текстом."""
+    out: List[str] = []
+    stack: List[Tuple[str, int]] = []  # (маркер, индекс плейсхолдера в out)
+    pos = 0
+    for m in _INLINE_RE.finditer(line):
+        if m.start() > pos:
+            out.append(escape(line[pos:m.start()], quote=False))
+        pos = m.end()
+
+        if m.group("code"):
+            out.append(f"<code>{escape(m.group('code_body'), quote=False)}</code>")
+            continue
+        if m.group("link_text"):
+            out.append(
+                f'<a href="{escape(m.group("link_url"))}">'
+                f"{escape(m.group('link_text'), quote=False)}</a>"
+            )
+            continue
+
+        mark = m.group("mark")
+        before = line[m.start() - 1] if m.start() else " "
+        after = line[m.end()] if m.end() < len(line) else " "
+        open_idx = next((i for i in range(len(stack) - 1, -1, -1) if stack[i][0] == mark), None)
+
+        if open_idx is not None and not before.isspace() and stack[open_idx][1] != len(out) - 1:
+            # закрываем: всё, что открыто поверх, становится обычным текстом
+            for inner_mark, inner_pos in stack[open_idx + 1:]:
+                out[inner_pos] = escape(inner_mark, quote=False)
+            _, start = stack[open_idx]
+            del stack[open_idx:]
+            tag = _MARK_TAGS[mark]
+            out[start] = f"<{tag}>"
+            out.append(f"</{tag}>")
+        elif not after.isspace():
+            stack.append((mark, len(out)))
+            out.append("")  # плейсхолдер под открывающий тег
+        else:
+            out.append(escape(mark, quote=False))
+
+    if pos < len(line):
+        out.append(escape(line[pos:], quote=False))
+    for mark, idx in stack:
+        out[idx] = escape(mark, quote=False)
+    return "".join(out)
+
+
+def _render_line(line: str) -> str:
+    heading = _HEADING_RE.match(line)
+    if heading:
+        return f"<b>{_render_inline(heading.group(1))}</b>"
+    bullet = _BULLET_RE.match(line)
+    if bullet:
+        return "• " + _render_inline(line[bullet.end():])
+    ordered = _ORDERED_RE.match(line)
+    if ordered:
+        return f"{ordered.group(1)}{ordered.group(2)}) " + _render_inline(line[ordered.end():])
+    return _render_inline(line)
+
+
+def render_blocks(text: str) -> List[Block]:
+    """Разбирает Markdown на готовые HTML-блоки."""
+    blocks: List[Block] = []
+    para: List[str] = []
+    quote: List[str] = []
+    code: List[str] = []
+    code_lang = None
+    in_code = False
+    blank_before = False
+
+    def flush() -> None:
+        nonlocal blank_before
+        if para:
+            blocks.append(Block("\n".join(para), blank_before))
+            para.clear()
+            blank_before = False
+        if quote:
+            blocks.append(Block(f"<blockquote>{chr(10).join(quote)}</blockquote>", blank_before))
+            quote.clear()
+            blank_before = False
+
+    def flush_code() -> None:
+        nonlocal blank_before
+        body = escape("\n".join(code).strip("\n"), quote=False)
+        attr = f' class="language-{escape(code_lang)}"' if code_lang else ""
+        blocks.append(Block(f"<pre><code{attr}>{body}</code></pre>", blank_before))
+        code.clear()
+        blank_before = False
+
+    for line in text.split("\n"):
+        fence = _FENCE_RE.match(line)
+        if in_code:
+            if fence and not fence.group(1):
+                flush_code()
+                in_code = False
+            else:
+                code.append(line)
+            continue
+        if fence:
+            flush()
+            in_code, code_lang = True, fence.group(1)
+            continue
+        if not line.strip():
+            flush()
+            if blocks:
+                blank_before = True
+            continue
+        quoted = _QUOTE_RE.match(line)
+        if quoted:
+            if para:
+                flush()
+            quote.append(_render_inline(line[quoted.end():]))
+        else:
+            if quote:
+                flush()
+            para.append(_render_line(line))
+
+    if in_code:
+        flush_code()  # незакрытый ``` — код до конца ответа
+    flush()
+    return blocks
+
+
+def _split_block(html: str, limit: int) -> List[str]:
+    """Режет один сбалансированный блок, закрывая и заново открывая теги на стыках."""
+    parts: List[str] = []
+    cur: List[str] = []
+    cur_len = 0
+    fresh_len = 0  # длина повторно открытых тегов в начале текущего куска
+    stack: List[Tuple[str, str]] = []  # (имя тега, открывающий тег)
+
+    def closing() -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+    def cut() -> None:
+        nonlocal cur, cur_len, fresh_len
+        if cur_len == fresh_len:
+            raise ValueError(f"Лимит {limit} меньше вложенности тегов")
+        parts.append("".join(cur) + closing())
+        reopen = "".join(tag for _, tag in stack)
+        cur, cur_len, fresh_len = [reopen], len(reopen), len(reopen)
+
+    def fits(extra: int) -> bool:
+        return cur_len + extra + len(closing()) <= limit
+
+    for m in _HTML_TOKEN_RE.finditer(html):
+        token = m.group(0)
+        if m.group(2):  # тег
+            if m.group(1):
+                # место под закрывающий тег уже зарезервировано в closing()
+                stack.pop()
+            else:
+                if not fits(len(token) + len(m.group(2)) + 3) and cur_len > fresh_len:
+                    cut()
+                stack.append((m.group(2), token))
+            cur.append(token)
+            cur_len += len(token)
+            continue
+
+        if token.startswith("&"):  # сущность неделима
+            if not fits(len(token)):
+                cut()
+            cur.append(token)
+            cur_len += len(token)
+            continue
+
+        while token:
+            room = limit - cur_len - len(closing())
+            if len(token) <= room:
+                cur.append(token)
+                cur_len += len(token)
+                break
+            piece = token[:max(room, 0)]
+            br = max(piece.rfind("\n"), piece.rfind(" "))
+            if br > 0:
+                piece = piece[:br + 1]
+            if piece:
+                cur.append(piece)
+                cur_len += len(piece)
+                token = token[len(piece):]
+            cut()
+
+    if cur_len > fresh_len:
+        parts.append("".join(cur))
+    return parts
+
+
+def split_messages(blocks: List[Block], limit: int) -> List[str]:
+    """Упаковывает блоки в сообщения длиной не больше limit."""
+    messages: List[str] = []
+    cur = ""
+    for block in blocks:
+        sep = "\n\n" if block.blank_before else "\n"
+        if cur and len(cur) + len(sep) + len(block.html) <= limit:
+            cur += sep + block.html
+            continue
+        if cur:
+            messages.append(cur)
+            cur = ""
+        if len(block.html) <= limit:
+            cur = block.html
+        else:
+            pieces = _split_block(block.html, limit)
+            messages.extend(pieces[:-1])
+            cur = pieces[-1]
+    if cur:
+        messages.append(cur)
+    return messages
+
+
+def render_markdown(text: str) -> str:
+    blocks = render_blocks(text)
+    return "".join(
+        (("\n\n" if b.blank_before else "\n") if i else "") + b.html
+        for i, b in enumerate(blocks)
+    )
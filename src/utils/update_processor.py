@@ -0,0 +1,152 @@
+"""Параллельная обработка апдейтов Telegram.
+
+Апдейты разных пользователей обрабатываются одновременно, апдейты одного
+пользователя — строго по очереди. Нажатия inline-кнопок и команды идут
+по «быстрой» полосе со своим лимитом и своей очередью на пользователя,
+поэтому никогда не ждут генерации ответа ИИ.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+FAST = "fast"
+SLOW = "slow"
+
+# Ожидание дольше этого порога попадает в лог
+_SLOW_WAIT_WARNING = 5.0
+
+
+def update_lane(update: object) -> str:
+    """Кнопки и команды — быстрая полоса, всё остальное (сообщения для ИИ) — медленная."""
+    if not isinstance(update, Update):
+        return FAST
+    if update.callback_query is not None:
+        return FAST
+    message = update.message
+    if message is not None and message.text and message.text.startswith("/"):
+        return FAST
+    return SLOW
+
+
+def ordering_key(update: object) -> Optional[Hashable]:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class _LaneStats:
+    __slots__ = ("waiting", "running", "processed", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "processed": self.processed,
+            "wait_avg": round(self.wait_total / self.processed, 4) if self.processed else 0.0,
+            "wait_max": round(self.wait_max, 4),
+        }
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Ограничивает параллелизм по полосам и сохраняет порядок внутри пользователя.
+
+    max_concurrent_updates базового класса — сумма лимитов обеих полос.
+    """
+
+    __slots__ = ("_limits", "_lanes", "_tails", "_stats")
+
+    def __init__(self, slow_limit: int, fast_limit: int):
+        if slow_limit < 1 or fast_limit < 1:
+            raise ValueError("Лимиты полос должны быть положительными")
+        super().__init__(slow_limit + fast_limit)
+        self._limits = {SLOW: slow_limit, FAST: fast_limit}
+        self._lanes = {SLOW: asyncio.Semaphore(slow_limit), FAST: asyncio.Semaphore(fast_limit)}
+        # (полоса, пользователь) -> future последнего апдейта в очереди
+        self._tails: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        self._stats = {SLOW: _LaneStats(), FAST: _LaneStats()}
+
+    async def process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        # Переопределяем целиком: общий семафор базового класса занимался бы
+        # апдейтами, которые ещё ждут своей очереди у пользователя, и медленная
+        # полоса вытесняла бы быструю.
+        lane = update_lane(update)
+        stats = self._stats[lane]
+        key = ordering_key(update)
+        tail_key = (lane, key)
+        prev: Optional[asyncio.Future] = None
+        done: Optional[asyncio.Future] = None
+        if key is not None:
+            prev = self._tails.get(tail_key)
+            done = asyncio.get_running_loop().create_future()
+            self._tails[tail_key] = done
+
+        queued_at = time.monotonic()
+        stats.waiting += 1
+        started = False
+        try:
+            if prev is not None:
+                await asyncio.shield(prev)
+            async with self._lanes[lane]:
+                stats.waiting -= 1
+                started = True
+                wait = time.monotonic() - queued_at
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                if wait > _SLOW_WAIT_WARNING:
+                    logger.warning("Апдейт ждал обработки %.1f с (полоса %s)", wait, lane)
+                stats.running += 1
+                try:
+                    await self.do_process_update(update, coroutine)
+                finally:
+                    stats.running -= 1
+                    stats.processed += 1
+        finally:
+            if not started:
+                # отменили в очереди: корутина так и не запускалась
+                stats.waiting -= 1
+                getattr(coroutine, "close", lambda: None)()
+            if done is not None:
+                if not started and prev is not None and not prev.done():
+                    # следующий апдейт пользователя всё равно ждёт предыдущий
+                    prev.add_done_callback(lambda _: done.done() or done.set_result(None))
+                else:
+                    done.set_result(None)
+                if self._tails.get(tail_key) is done:
+                    del self._tails[tail_key]
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Глубина очереди, число выполняемых и время ожидания по полосам."""
+        return {
+            lane: {
+                "limit": self._limits[lane],
+                "users_active": sum(1 for (l, _) in self._tails if l == lane),
+                **st.as_dict(),
+            }
+            for lane, st in self._stats.items()
+        }
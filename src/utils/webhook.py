@@ -0,0 +1,170 @@
+"""Режим вебхука: Telegram сам присылает апдейты POST-запросами.
+
+Встроенный HTTP-сервер принимает апдейт, проверяет секретный токен
+(заголовок X-Telegram-Bot-Api-Secret-Token), отбрасывает повторы по
+update_id (Telegram повторяет доставку при таймаутах) и кладёт апдейт в
+очередь Application — дальше всё так же, как при polling. Ответ Telegram
+уходит сразу, не дожидаясь обработки.
+
+Без секрета вебхук не запускается: иначе апдейты мог бы подделать любой,
+кто достучится до порта. Если WEBHOOK_SECRET пуст, а WEBHOOK_URL задан,
+секрет генерируется при старте и передаётся в setWebhook.
+
+Проверка без Telegram: TELEGRAM_API_BASE_URL указывает на локальную
+заглушку Bot API, записанные апдейты отправляются скриптом
+
+    python -m bench.replay_updates bench/updates_sample.jsonl
+"""
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+from src.config import (
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_BODY,
+)
+from src.utils.http_server import HttpServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+def webhook_secret() -> str:
+    """WEBHOOK_SECRET или случайный секрет, если вебхук регистрирует сам бот."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    if not WEBHOOK_URL:
+        # вебхук зарегистрирован снаружи — сгенерированный секрет Telegram не узнает
+        raise RuntimeError("BOT_MODE=webhook: задайте WEBHOOK_SECRET (тот же, что передан в setWebhook)")
+    logger.info("WEBHOOK_SECRET не задан — сгенерирован случайный секрет для setWebhook")
+    return secrets.token_urlsafe(32)
+
+
+class RecentIds:
+    """Последние update_id для отсева повторных доставок."""
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+
+    def seen(self, update_id: int) -> bool:
+        """True, если id уже был; иначе запоминает его."""
+        if update_id in self._ids:
+            return True
+        self._ids[update_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return False
+
+    def forget(self, update_id: int) -> None:
+        """Апдейт не доставлен — повтор от Telegram должен пройти."""
+        self._ids.pop(update_id, None)
+
+
+class WebhookReceiver:
+    """Проверяет и отсеивает апдейты; deliver(data) получает разобранный JSON."""
+
+    def __init__(self, deliver: Callable[[dict], Awaitable[None]], secret: str):
+        if not secret:
+            raise ValueError("Вебхук без секретного токена принимал бы чужие апдейты")
+        self.deliver = deliver
+        self.secret = secret
+        self.recent = RecentIds()
+        self.accepting = True
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    async def handle(self, request: Request) -> Response:
+        if not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()
+        ):
+            self.rejected += 1
+            return Response.json({"ok": False}, 403)
+        if not self.accepting:
+            # идёт остановка — Telegram повторит доставку позже
+            return Response.json({"ok": False}, 503)
+        try:
+            data = request.json()
+            update_id = int(data["update_id"])
+        except (ValueError, KeyError, TypeError):
+            self.rejected += 1
+            return Response.json({"ok": False}, 400)
+
+        if self.recent.seen(update_id):
+            self.duplicates += 1
+            return Response.json({"ok": True})
+        # id запоминается сразу: одновременный повтор не пройдёт, пока идёт доставка
+        try:
+            await self.deliver(data)
+        except BaseException:
+            self.recent.forget(update_id)
+            raise
+        self.received += 1
+        return Response.json({"ok": True})
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+        }
+
+
+async def run_webhook(app: Application, stop_event: Optional[asyncio.Event] = None) -> None:
+    """Аналог app.run_polling() для вебхука: те же хуки post_* в том же порядке."""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows / не главный поток
+
+    async def deliver(data: dict) -> None:
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    secret = webhook_secret()
+    receiver = WebhookReceiver(deliver, secret)
+    server = HttpServer(WEBHOOK_HOST, WEBHOOK_PORT, max_body=WEBHOOK_MAX_BODY)
+    server.route("POST", WEBHOOK_PATH, receiver.handle)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    try:
+        await app.start()
+        await server.start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=secret,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info("Вебхук зарегистрирован: %s", WEBHOOK_URL)
+        await stop_event.wait()
+        logger.info("Остановка: новые апдейты больше не принимаются")
+    finally:
+        receiver.accepting = False
+        await server.close()
+        if app.running:
+            # update_fetcher дорабатывает очередь, затем post_stop дожидается ответов ИИ
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        logger.info("Вебхук остановлен, принято апдейтов: %d", receiver.received)
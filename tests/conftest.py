@@ -0,0 +1,11 @@
+"""Окружение для импорта src.* без .env: конфиг читается при импорте модулей."""
+import os
+import tempfile
+
+from bench._env import setup_env
+
+setup_env(
+    STATE_DB_PATH=os.path.join(tempfile.mkdtemp(prefix="tg-ai-bot-tests-"), "state.db"),
+    STATE_IMPORT_FILE="",
+    METRICS_PORT="0",
+)
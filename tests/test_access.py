@@ -0,0 +1,57 @@
+import pytest
+
+from src.utils.access import TokenBucket, parse_ids
+
+
+def test_take_and_wait():
+    bucket = TokenBucket(rate=10.0, capacity=100.0, now=0.0)
+    assert bucket.try_take(60, now=0.0) == 0.0
+    # осталось 40: на 60 не хватает 20 токенов, это 2 с при 10/с
+    assert bucket.try_take(60, now=0.0) == pytest.approx(2.0)
+    assert bucket.try_take(60, now=2.0) == 0.0
+
+
+def test_charge_goes_into_debt():
+    bucket = TokenBucket(rate=10.0, capacity=100.0, now=0.0)
+    bucket.try_take(80, now=0.0)
+    bucket.charge(50, now=0.0)
+    assert bucket.tokens == pytest.approx(-30.0)
+    # долг сначала гасится пополнением: 1 токен ждёт (1 + 30) / 10 с
+    assert bucket.try_take(1, now=0.0) == pytest.approx(3.1)
+    assert bucket.try_take(1, now=3.1) == 0.0
+
+
+def test_refund_capped_at_capacity():
+    bucket = TokenBucket(rate=10.0, capacity=100.0, now=0.0)
+    bucket.try_take(30, now=0.0)
+    bucket.refund(30, now=0.0)
+    assert bucket.tokens == pytest.approx(100.0)
+    bucket.refund(500, now=1.0)
+    assert bucket.tokens == pytest.approx(100.0)
+    assert bucket.is_full(now=1.0)
+
+
+def test_request_larger_than_capacity_passes_only_when_full():
+    bucket = TokenBucket(rate=10.0, capacity=100.0, now=0.0)
+    bucket.try_take(1, now=0.0)
+    # не хватает до полного ведра — ждём, пока оно наполнится
+    assert bucket.try_take(250, now=0.0) == pytest.approx(0.1)
+    assert bucket.try_take(250, now=0.1) == 0.0
+    # списывается вся стоимость: следующий запрос ждёт погашения долга
+    assert bucket.tokens == pytest.approx(-150.0)
+    assert bucket.try_take(1, now=0.1) == pytest.approx(15.1)
+
+
+def test_parse_ids():
+    assert parse_ids("123, 4325 # комментарий\n77") == {123, 4325, 77}
+
+
+def test_env_ids_accepts_documented_forms(monkeypatch, caplog):
+    from src.config import env_ids
+
+    for raw in ("123,4325", "{123, 4325}", "123 4325", " 123 ;4325 "):
+        monkeypatch.setenv("TEST_IDS", raw)
+        assert env_ids("TEST_IDS") == {123, 4325}
+    monkeypatch.setenv("TEST_IDS", "123, abc, -5")
+    assert env_ids("TEST_IDS") == {123, -5}
+    assert "'abc'" in caplog.text
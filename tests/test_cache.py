@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from src.ai_providers.cache import ResponseCache
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_calls_share_one_factory_call():
+    async def main():
+        cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        results = await asyncio.gather(*(cache.get_or_call("k", factory) for _ in range(5)))
+        assert results == ["ответ"] * 5
+        assert calls == 1
+        assert cache.coalesced == 4
+        assert await cache.get_or_call("k", factory) == "ответ"
+        assert calls == 1
+
+    run(main())
+
+
+def test_follower_gets_answer_when_leader_is_cancelled():
+    async def main():
+        cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+        started = asyncio.Event()
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            started.set()
+            await asyncio.sleep(0.05)
+            return f"ответ {calls}"
+
+        leader = asyncio.create_task(cache.get_or_call("k", factory))
+        await started.wait()
+        follower = asyncio.create_task(cache.get_or_call("k", factory))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # ждущий стал ведущим и сделал свой запрос
+        assert await follower == "ответ 2"
+        assert calls == 2
+        assert not cache._inflight
+
+    run(main())
+
+
+def test_leader_error_reaches_followers():
+    async def main():
+        cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+
+        async def factory():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream")
+
+        results = await asyncio.gather(
+            *(cache.get_or_call("k", factory) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+        assert not cache._inflight
+
+    run(main())
+
+
+def test_lru_evicts_by_bytes():
+    async def main():
+        cache = ResponseCache(max_bytes=1000, ttl=60)
+        for i in range(10):
+            await cache.put(f"k{i}", "x" * 200)
+        assert cache.stats()["bytes"] <= 1000
+        assert await cache.get("k0") is None
+        assert await cache.get("k9") == "x" * 200
+
+    run(main())
@@ -0,0 +1,194 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from src.ai_providers.key_pool import KeyPool, KeyPoolExhausted, parse_duration, parse_retry_after
+from src.utils.state_store import StateStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_pool(keys=("key-a", "key-b"), **kwargs) -> KeyPool:
+    kwargs.setdefault("max_in_flight", 2)
+    kwargs.setdefault("acquire_timeout", 1.0)
+    kwargs.setdefault("default_cooldown", 1.0)
+    return KeyPool(keys, **kwargs)
+
+
+def response(status: int = 200, **headers) -> httpx.Response:
+    return httpx.Response(status, headers={k.replace("_", "-"): v for k, v in headers.items()})
+
+
+def test_parse_durations():
+    assert parse_duration("7.66s") == pytest.approx(7.66)
+    assert parse_duration("1m30s") == pytest.approx(90.0)
+    assert parse_duration("250ms") == pytest.approx(0.25)
+    assert parse_duration("12") == 12.0
+    assert parse_duration("soon") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_least_loaded_key_first():
+    async def main():
+        pool = make_pool(("key-a", "key-b", "key-c"), max_in_flight=5)
+        first = await pool.acquire()
+        second = await pool.acquire()
+        third = await pool.acquire()
+        # каждый новый запрос — на ключ без запросов в полёте
+        assert len({first.key, second.key, third.key}) == 3
+        await pool.release(second)
+        assert (await pool.acquire()).key == second.key
+
+    run(main())
+
+
+def test_quota_and_health_break_ties():
+    async def main():
+        pool = make_pool(("key-a", "key-b"))
+        a = await pool.acquire()
+        pool.observe(a, response(x_ratelimit_remaining_requests="5", x_ratelimit_limit_requests="100"))
+        await pool.release(a)
+        # у key-a осталось 5% квоты — при равной загрузке выбирается key-b
+        assert (await pool.acquire()).key == "key-b"
+
+    run(main())
+
+
+def test_max_in_flight_waits_for_release():
+    async def main():
+        pool = make_pool(("key-a",), max_in_flight=1, acquire_timeout=1.0)
+        held = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        await pool.release(held)
+        assert (await asyncio.wait_for(waiter, 0.5)).key == "key-a"
+
+    run(main())
+
+
+def test_max_in_flight_times_out():
+    async def main():
+        pool = make_pool(("key-a",), max_in_flight=1, acquire_timeout=0.1)
+        await pool.acquire()
+        started = time.monotonic()
+        with pytest.raises(KeyPoolExhausted):
+            await pool.acquire()
+        assert 0.08 <= time.monotonic() - started < 0.5
+
+    run(main())
+
+
+def test_retry_after_parks_key():
+    async def main():
+        pool = make_pool(("key-a", "key-b"), acquire_timeout=0.1)
+        st = await pool.acquire()
+        pool.observe(st, response(429, retry_after="30"))
+        await pool.release(st)
+        assert pool.snapshot()[0]["cooldown"] == pytest.approx(30, abs=0.5)
+        # запаркованный ключ не выдаётся, пока есть другой
+        for _ in range(3):
+            other = await pool.acquire()
+            assert other.key == "key-b"
+            await pool.release(other)
+
+    run(main())
+
+
+def test_ratelimit_reset_headers_park_key():
+    async def main():
+        pool = make_pool(("key-a",))
+        st = await pool.acquire()
+        pool.observe(st, response(429, x_ratelimit_reset_requests="2s", x_ratelimit_reset_tokens="1m"))
+        assert st.cooldown_until - time.monotonic() == pytest.approx(60, abs=0.5)
+        # квота кончилась без 429 — тоже пауза до сброса окна
+        pool.observe(st, response(200, x_ratelimit_remaining_requests="0", x_ratelimit_reset_requests="5s"))
+        assert st.cooldown_until - time.monotonic() == pytest.approx(5, abs=0.5)
+
+    run(main())
+
+
+def test_429_without_hints_backs_off_exponentially():
+    async def main():
+        pool = make_pool(("key-a",), default_cooldown=1.0)
+        st = await pool.acquire()
+        waits = []
+        for _ in range(3):
+            pool.observe(st, response(429))
+            waits.append(st.cooldown_until - time.monotonic())
+        assert waits == pytest.approx([1.0, 2.0, 4.0], abs=0.1)
+        pool.observe(st, response(200))
+        assert st.consecutive_429 == 0
+
+    run(main())
+
+
+def test_all_keys_parked_fails_fast():
+    async def main():
+        pool = make_pool(("key-a",), acquire_timeout=5.0)
+        st = await pool.acquire()
+        pool.observe(st, response(429, retry_after="60"))
+        await pool.release(st)
+        started = time.monotonic()
+        # ключ не освободится до таймаута — ошибка сразу, а не через 5 с
+        with pytest.raises(KeyPoolExhausted):
+            await pool.acquire()
+        assert time.monotonic() - started < 0.5
+
+    run(main())
+
+
+def test_consecutive_errors_park_key():
+    async def main():
+        pool = make_pool(("key-a",), error_threshold=2, error_cooldown=3.0)
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                async with pool.lease():
+                    raise httpx.ConnectError("down")
+        assert pool.snapshot()[0]["cooldown"] == pytest.approx(3.0, abs=0.5)
+
+    run(main())
+
+
+def test_apply_parked_extends_only():
+    pool = make_pool(("key-a", "key-b"))
+    now = time.monotonic()
+    wall = time.time()
+    pool._states[1].cooldown_until = now + 100
+    pool.apply_parked({
+        KeyPool.fingerprint("key-a"): wall + 20,
+        KeyPool.fingerprint("key-b"): wall + 5,
+        KeyPool.fingerprint("other"): wall + 50,
+    })
+    assert pool._states[0].cooldown_until - now == pytest.approx(20, abs=0.5)
+    assert pool._states[1].cooldown_until - now == pytest.approx(100, abs=0.5)
+
+
+def test_parked_keys_shared_between_processes(tmp_path):
+    """Два пула с общей базой — как два процесса-обработчика (см. _share_key_cooldowns)."""
+    async def main():
+        path = str(tmp_path / "shared.db")
+        store_a, store_b = StateStore(path), StateStore(path)
+        pool_a, pool_b = make_pool(), make_pool()
+        try:
+            st = await pool_a.acquire()
+            pool_a.observe(st, response(429, retry_after="30"))
+            parked = pool_a.parked()
+            assert list(parked) == [KeyPool.fingerprint(st.key)]
+            assert all(st.key not in name for name in parked)  # сам ключ в базу не пишется
+
+            await store_a.share_until(parked)
+            pool_b.apply_parked(await store_b.shared_until())
+            snapshot = {s["key"]: s["cooldown"] for s in pool_b.snapshot()}
+            parked_key = next(s for s in pool_b._states if s.key == st.key)
+            assert parked_key.cooldown_until - time.monotonic() == pytest.approx(30, abs=1.0)
+            assert sorted(snapshot.values())[0] == 0
+        finally:
+            await store_a.close()
+            await store_b.close()
+
+    run(main())
@@ -0,0 +1,93 @@
+from src.utils.memory import (
+    MESSAGE_OVERHEAD_TOKENS,
+    RECALL_PREFIX,
+    SUMMARY_PREFIX,
+    build_context,
+    estimate_tokens,
+)
+
+SYSTEM = "Ты — полезный ассистент."
+
+
+def cost(text: str) -> int:
+    return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+def turns(n: int) -> list:
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"реплика номер {i:03d} " + "x" * 40}
+        for i in range(n)
+    ]
+
+
+def total(messages: list) -> int:
+    return sum(cost(m["content"]) for m in messages)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    # кириллица — два байта на символ: вдвое больше токенов на символ
+    assert estimate_tokens("абвг") == 2
+
+
+def test_order_and_roles():
+    history = turns(2)
+    messages = build_context(SYSTEM, history, "вопрос", max_tokens=10_000, instructions="[Язык: Русский]")
+    assert [m["role"] for m in messages] == ["system", "system", "user", "assistant", "user"]
+    assert messages[0]["content"] == SYSTEM
+    assert messages[-1] == {"role": "user", "content": "вопрос"}
+
+
+def test_history_truncated_newest_first():
+    history = turns(20)
+    base = cost(SYSTEM) + cost("вопрос")
+    per_turn = cost(history[0]["content"])
+    budget = base + 5 * per_turn + per_turn // 2
+    messages = build_context(SYSTEM, history, "вопрос", max_tokens=budget)
+    kept = messages[1:-1]
+    # влезли ровно пять последних реплик, в исходном порядке
+    assert kept == history[-5:]
+    assert total(messages) <= budget
+
+
+def test_summary_counts_against_budget():
+    history = turns(20)
+    summary = "Пользователь изучает очереди сообщений. " * 5
+    budget = 300
+    without = build_context(SYSTEM, history, "вопрос", max_tokens=budget)
+    with_summary = build_context(SYSTEM, history, "вопрос", max_tokens=budget, summary=summary)
+    assert with_summary[1] == {"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"}
+    # конспект всегда попадает в контекст, а история получает то, что осталось
+    assert len(with_summary) - 1 < len(without)
+    assert total(with_summary) <= budget
+    assert with_summary[2:-1] == history[-(len(with_summary) - 3):]
+
+
+def test_recall_gets_leftover_budget():
+    history = turns(4)
+    recalled = [(f"старый вопрос {i}", "старый ответ " + "y" * 200) for i in range(10)]
+    roomy = build_context(SYSTEM, history, "вопрос", max_tokens=10_000, recalled=recalled)
+    block = roomy[1]["content"]
+    assert block.startswith(RECALL_PREFIX)
+    assert block.count("Пользователь: старый вопрос") == 10
+    # вся история на месте: прошлые ходы её не вытесняют
+    assert roomy[2:-1] == history
+
+    budget = total(build_context(SYSTEM, history, "вопрос", max_tokens=10_000)) + 200
+    tight = build_context(SYSTEM, history, "вопрос", max_tokens=budget, recalled=recalled)
+    assert tight[2:-1] == history
+    assert 0 < tight[1]["content"].count("Пользователь:") < 10
+    assert total(tight) <= budget + len(recalled)
+
+    no_room = build_context(SYSTEM, history, "вопрос", max_tokens=budget - 200, recalled=recalled)
+    assert all(not m["content"].startswith(RECALL_PREFIX) for m in no_room)
+
+
+def test_user_message_larger_than_budget():
+    huge = "очень длинное сообщение " * 500
+    messages = build_context(SYSTEM, turns(6), huge, max_tokens=100, summary="конспект",
+                             recalled=[("вопрос", "ответ")])
+    # история и прошлые ходы не влезают, само сообщение не обрезается
+    assert [m["role"] for m in messages] == ["system", "system", "user"]
+    assert messages[-1]["content"] == huge
@@ -0,0 +1,81 @@
+import asyncio
+
+import numpy as np
+
+from src.utils.recall import Recall
+from src.utils.state_store import StateStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_recall(store, directory) -> Recall:
+    return Recall(store=store, max_turns=4, directory=str(directory), enabled=True)
+
+
+def assert_aligned(recall: Recall, index) -> None:
+    expected = recall.embedder.embed([f"{p}\n{r}" for p, r in index.turns]).astype(np.float16)
+    assert np.array_equal(np.asarray(index.vectors[:index.count]), expected)
+
+
+WORDS = ["модель", "погода", "рецепт", "футбол", "музыка"]
+
+
+def test_restart_reuses_saved_rows(tmp_path):
+    async def main():
+        db = str(tmp_path / "state.db")
+        store = StateStore(db)
+        recall = make_recall(store, tmp_path / "vectors")
+        for i in range(3):
+            await recall.add(1, f"вопрос про {WORDS[i]}", f"ответ про {WORDS[i]}")
+        recall.close()
+        await store.close()
+
+        store = StateStore(db)
+        restarted = make_recall(store, tmp_path / "vectors")
+        index = await restarted._load(1)
+        await store.close()
+        assert index.count == 3
+        assert restarted.embedded == 0
+        assert_aligned(restarted, index)
+
+    run(main())
+
+
+def test_rows_shifted_before_texts_saved_are_rebuilt(tmp_path):
+    async def main():
+        db = str(tmp_path / "state.db")
+        store = StateStore(db)
+        recall = make_recall(store, tmp_path / "vectors")
+        for word in WORDS[:4]:
+            await recall.add(1, f"вопрос {word}", f"ответ {word}")
+        await store.flush()
+        # матрица уже сдвинута пятым ходом, а тексты до падения не записались
+        await recall.add(1, f"вопрос {WORDS[4]}", f"ответ {WORDS[4]}")
+        recall.close()
+
+        other = StateStore(db)
+        restarted = make_recall(other, tmp_path / "vectors")
+        index = await restarted._load(1)
+        await other.close()
+        await store.close()
+        assert [p for p, _ in index.turns] == [f"вопрос {word}" for word in WORDS[:4]]
+        assert restarted.embedded == 4
+        assert_aligned(restarted, index)
+        assert await restarted.search(1, "рецепт", k=1) == [("вопрос рецепт", "ответ рецепт")]
+
+    run(main())
+
+
+def test_old_format_without_crc_is_embedded(tmp_path):
+    async def main():
+        store = StateStore(str(tmp_path / "state.db"))
+        store.put("recall", 5, [["старый вопрос", "старый ответ"]])
+        recall = make_recall(store, tmp_path / "vectors")
+        index = await recall._load(5)
+        await store.close()
+        assert recall.embedded == 1
+        assert_aligned(recall, index)
+
+    run(main())
@@ -0,0 +1,194 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from src.utils.send_scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_PROGRESS, SendScheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class Recorder:
+    """Колбэки запросов: пишут, что и когда ушло в «Telegram»."""
+
+    def __init__(self):
+        self.sent = []
+        self.started = time.monotonic()
+
+    def call(self, label, fail_with=None):
+        async def callback():
+            if fail_with:
+                error = fail_with.pop(0) if fail_with else None
+                if error is not None:
+                    raise error
+            self.sent.append((label, time.monotonic() - self.started))
+            return label
+        return callback
+
+    @property
+    def labels(self):
+        return [label for label, _ in self.sent]
+
+
+async def request(scheduler, rec, label, chat, endpoint="sendMessage", message_id=None, priority=None, fail_with=None):
+    data = {"chat_id": chat}
+    if message_id is not None:
+        data["message_id"] = message_id
+    return await scheduler.process_request(rec.call(label, fail_with), (), {}, endpoint, data, priority)
+
+
+async def started(scheduler: SendScheduler) -> SendScheduler:
+    await scheduler.initialize()
+    return scheduler
+
+
+def test_priority_order_between_chats():
+    async def main():
+        s = await started(SendScheduler(global_rate=20, chat_burst=3))
+        rec = Recorder()
+        s._global.tokens = 0  # общая корзина пуста — всё встаёт в очередь
+        tasks = [
+            asyncio.create_task(request(s, rec, "progress", 1, priority=PRIORITY_PROGRESS)),
+            asyncio.create_task(request(s, rec, "normal", 2, priority=PRIORITY_NORMAL)),
+            asyncio.create_task(request(s, rec, "high", 3, priority=PRIORITY_HIGH)),
+        ]
+        await asyncio.gather(*tasks)
+        assert rec.labels == ["high", "normal", "progress"]
+        await s.shutdown()
+
+    run(main())
+
+
+def test_order_within_chat_is_kept():
+    async def main():
+        s = await started(SendScheduler(global_rate=20, chat_rate=50, chat_burst=1))
+        rec = Recorder()
+        s._global.tokens = 0
+        await asyncio.gather(
+            request(s, rec, "first", 1, priority=PRIORITY_PROGRESS),
+            request(s, rec, "second", 1, priority=PRIORITY_HIGH),
+        )
+        assert rec.labels == ["first", "second"]
+        await s.shutdown()
+
+    run(main())
+
+
+def test_progress_edits_collapse_into_one():
+    async def main():
+        s = await started(SendScheduler(chat_rate=2, chat_burst=1))
+        rec = Recorder()
+        await request(s, rec, "reply", 1)  # жетон чата потрачен, правки ждут
+        edits = [
+            asyncio.create_task(request(s, rec, f"edit {i}", 1, "editMessageText", 7, PRIORITY_PROGRESS))
+            for i in range(5)
+        ]
+        results = await asyncio.gather(*edits)
+        assert rec.labels == ["reply", "edit 4"]
+        # все вызывающие получают результат отправленной правки
+        assert results == ["edit 4"] * 5
+        assert s.collapsed == 4
+        await s.shutdown()
+
+    run(main())
+
+
+def test_final_edit_replaces_queued_progress_edit():
+    async def main():
+        s = await started(SendScheduler(chat_rate=2, chat_burst=1))
+        rec = Recorder()
+        await request(s, rec, "reply", 1)
+        progress = asyncio.create_task(request(s, rec, "progress", 1, "editMessageText", 7, PRIORITY_PROGRESS))
+        await asyncio.sleep(0)
+        final = asyncio.create_task(request(s, rec, "final", 1, "editMessageText", 7))
+        assert await final == "final"
+        assert await progress == "final"
+        assert rec.labels == ["reply", "final"]
+        await s.shutdown()
+
+    run(main())
+
+
+def test_cancelled_newer_edit_hands_slot_back():
+    async def main():
+        s = await started(SendScheduler(chat_rate=2, chat_burst=1))
+        rec = Recorder()
+        await request(s, rec, "reply", 1)
+        a = asyncio.create_task(request(s, rec, "A", 1, "editMessageText", 7, PRIORITY_PROGRESS))
+        await asyncio.sleep(0.01)
+        b = asyncio.create_task(request(s, rec, "B", 1, "editMessageText", 7, PRIORITY_PROGRESS))
+        await asyncio.sleep(0.01)
+        c = asyncio.create_task(request(s, rec, "C", 1, "editMessageText", 7, PRIORITY_PROGRESS))
+        await asyncio.sleep(0.01)
+        c.cancel()
+        # A и B не отменялись: уходит последняя из оставшихся правок, B
+        assert await asyncio.wait_for(asyncio.gather(a, b), 3) == ["B", "B"]
+        assert rec.labels == ["reply", "B"]
+        with pytest.raises(asyncio.CancelledError):
+            await c
+        await s.shutdown()
+
+    run(main())
+
+
+def test_cancelled_single_request_is_dropped():
+    async def main():
+        s = await started(SendScheduler(chat_rate=5, chat_burst=1))
+        rec = Recorder()
+        await request(s, rec, "reply", 1)
+        edit = asyncio.create_task(request(s, rec, "edit", 1, "editMessageText", 7))
+        await asyncio.sleep(0.01)
+        edit.cancel()
+        await asyncio.sleep(0.4)
+        assert rec.labels == ["reply"]
+        assert s.stats()["queued"] == 0
+        await s.shutdown()
+
+    run(main())
+
+
+def test_retry_after_pauses_only_that_chat():
+    async def main():
+        s = await started(SendScheduler(chat_rate=20, chat_burst=5))
+        rec = Recorder()
+        retried = asyncio.create_task(request(s, rec, "retried", 1, fail_with=[RetryAfter(1)]))
+        await asyncio.sleep(0.05)
+        same_chat = asyncio.create_task(request(s, rec, "same chat", 1))
+        other_chat = asyncio.create_task(request(s, rec, "other chat", 2))
+        await asyncio.gather(retried, same_chat, other_chat)
+        sent = dict(rec.sent)
+        assert sent["other chat"] < 0.5
+        # повтор — после паузы и раньше следующих запросов того же чата
+        assert sent["retried"] >= 0.95
+        assert rec.labels.index("retried") < rec.labels.index("same chat")
+        assert s.retried == 1
+        await s.shutdown()
+
+    run(main())
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def main():
+        s = await started(SendScheduler(max_retries=0))
+        rec = Recorder()
+        with pytest.raises(RetryAfter):
+            await request(s, rec, "x", 1, fail_with=[RetryAfter(1)])
+        assert rec.labels == []
+        await s.shutdown()
+
+    run(main())
+
+
+def test_requests_without_chat_bypass_queue():
+    async def main():
+        s = await started(SendScheduler())
+        rec = Recorder()
+        s._global.tokens = 0
+        result = await s.process_request(rec.call("getMe"), (), {}, "getMe", {}, None)
+        assert result == "getMe"
+        await s.shutdown()
+
+    run(main())
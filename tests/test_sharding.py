@@ -0,0 +1,85 @@
+import asyncio
+import threading
+
+from src.utils.sharding import ShardIngress, _Worker
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class SlowConn:
+    """Pipe, у которого send держит поток, пока тест не отпустит."""
+
+    def __init__(self, error: Exception = None):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.error = error
+        self.sent = []
+        self.events = []
+
+    def send(self, data):
+        self.entered.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        self.sent.append(data)
+        self.events.append("sent")
+
+    def close(self):
+        self.events.append("closed")
+
+
+async def start_send(conn: SlowConn):
+    ingress = ShardIngress(1)
+    w = _Worker(0)
+    w.pending.append({"update_id": 1})
+    task = asyncio.create_task(ingress._send_loop(w, conn))
+    await asyncio.get_running_loop().run_in_executor(None, conn.entered.wait, 5)
+    return w, task
+
+
+def test_cancel_during_send_does_not_resend():
+    async def main():
+        conn = SlowConn()
+        w, task = await start_send(conn)
+        task.cancel()
+        await asyncio.sleep(0.05)
+        # pipe не закрыт, пока send ещё в потоке
+        assert conn.events == []
+        conn.release.set()
+        await asyncio.gather(task, return_exceptions=True)
+        assert conn.events == ["sent", "closed"]
+        assert not w.pending
+        assert w.sent == 1
+        w.executor.shutdown()
+
+    run(main())
+
+
+def test_failed_send_returns_update_to_queue():
+    async def main():
+        conn = SlowConn(error=BrokenPipeError())
+        w, task = await start_send(conn)
+        conn.release.set()
+        await task
+        assert list(w.pending) == [{"update_id": 1}]
+        assert w.sent == 0
+        assert conn.events == ["closed"]
+        w.executor.shutdown()
+
+    run(main())
+
+
+def test_cancel_during_failed_send_returns_update_to_queue():
+    async def main():
+        conn = SlowConn(error=BrokenPipeError())
+        w, task = await start_send(conn)
+        task.cancel()
+        conn.release.set()
+        await asyncio.gather(task, return_exceptions=True)
+        assert list(w.pending) == [{"update_id": 1}]
+        assert conn.events == ["closed"]
+        w.executor.shutdown()
+
+    run(main())
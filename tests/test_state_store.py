@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from src.handlers.commands import _temperature
+from src.utils.state_store import StateStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_import_keeps_only_used_fields(tmp_path):
+    async def main():
+        source = tmp_path / "settings.json"
+        source.write_text(json.dumps({
+            "42": {"model": "m", "temp": 0.2, "history": [["q", "a"]], "lang": "RU", "theme": "dark"},
+        }), encoding="utf-8")
+        store = StateStore(str(tmp_path / "state.db"))
+        try:
+            assert await store.import_settings_json(str(source)) == 1
+            state = await store.get("user", 42)
+            assert state == {"model": "m", "temp": 0.2, "lang": "Русский"}
+            # повторный импорт того же файла пропускается
+            assert await store.import_settings_json(str(source)) == 0
+        finally:
+            await store.close()
+
+    run(main())
+
+
+def test_import_does_not_override_existing_choice(tmp_path):
+    async def main():
+        source = tmp_path / "settings.json"
+        source.write_text(json.dumps({"7": {"model": "old", "temp": 1.1}}), encoding="utf-8")
+        store = StateStore(str(tmp_path / "state.db"))
+        try:
+            store.put("user", 7, {"model": "new"})
+            await store.import_settings_json(str(source))
+            assert await store.get("user", 7) == {"model": "new", "temp": 1.1}
+        finally:
+            await store.close()
+
+    run(main())
+
+
+def test_imported_temp_is_used_for_answers():
+    assert _temperature({"temp": 0.2}) == 0.2
+    assert _temperature({"temp": "1.5"}) == 1.5
+    assert _temperature({}) == 0.7
+    assert _temperature({"temp": "hot"}) == 0.7
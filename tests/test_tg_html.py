@@ -0,0 +1,192 @@
+"""Рендер Markdown -> HTML Telegram и нарезка на сообщения (src/utils/tg_html.py).
+
+Для любого входа каждое сообщение не длиннее лимита, содержит только теги
+подмножества Telegram, корректно вложенные и закрытые, без неэкранированных
+< и &, а видимый текст сохраняется целиком и по порядку.
+"""
+import random
+from html import unescape
+from html.parser import HTMLParser
+
+import pytest
+
+from src.utils.tg_html import _split_block, render_blocks, render_markdown, split_messages
+
+ALLOWED_TAGS = {"b", "i", "u", "s", "code", "pre", "a", "blockquote", "tg-spoiler"}
+ALLOWED_ATTRS = {"a": {"href"}, "code": {"class"}}
+URL = "http://x.io/p?q=1&r=2"
+
+PIECES = [
+    "word", "слово", "a<b", "x & y", "1 < 2 > 0", "**", "*", "~~", "`", "``",
+    " ", " ", " ", "\n", "\n", "\n\n", "\n```\n", "\n- ", "\n1. ", "\n> ", "\n## ",
+    "**bold**", "*it*", "`co<de>`", f"[link]({URL})", "snake_case_name", "&amp;", "<b>",
+    "2*3*4", "~~old~~", " ", "😀",
+]
+
+
+class _Validator(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.errors = []
+        self.text = []
+        self.opened = []  # все открывающие теги по порядку
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED_TAGS:
+            self.errors.append(f"тег <{tag}> вне подмножества Telegram")
+        for name, _ in attrs:
+            if name not in ALLOWED_ATTRS.get(tag, ()):
+                self.errors.append(f"атрибут {name} у <{tag}>")
+        self.stack.append(tag)
+        self.opened.append(tag)
+        if tag == "code":
+            # язык блока кода (```lang) переезжает в атрибут class
+            self.text.append(dict(attrs).get("class", "").replace("language-", "", 1))
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.errors.append(f"несбалансированный </{tag}>, стек {self.stack}")
+        else:
+            self.stack.pop()
+
+    def handle_data(self, data):
+        if "<" in data or "&" in data:
+            self.errors.append(f"неэкранированный текст: {data[:40]!r}")
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        if name not in ("lt", "gt", "amp", "quot"):
+            self.errors.append(f"сущность &{name};")
+        self.text.append(unescape(f"&{name};"))
+
+    def handle_charref(self, name):
+        self.errors.append(f"числовая сущность &#{name};")
+
+
+def _validate(chunk: str) -> _Validator:
+    v = _Validator()
+    v.feed(chunk)
+    v.close()
+    return v
+
+
+_URL_VISIBLE = "".join(ch for ch in URL if ch.isalnum())
+
+
+def _visible(s: str) -> str:
+    # адрес ссылки уходит в href (и при нарезке может повториться) — не сравниваем его
+    return "".join(ch for ch in s if ch.isalnum()).replace(_URL_VISIBLE, "")
+
+
+def assert_valid(source: str, limit: int, same_text: bool = True) -> list:
+    chunks = split_messages(render_blocks(source), limit)
+    text = []
+    for chunk in chunks:
+        assert len(chunk) <= limit, chunk
+        v = _validate(chunk)
+        assert not v.errors, (v.errors, chunk)
+        assert not v.stack, (v.stack, chunk)
+        text.append("".join(v.text))
+    if same_text:
+        assert _visible("".join(text)) == _visible(source)
+    return chunks
+
+
+# ====== Рендер ======
+def test_inline_markup():
+    assert render_markdown("**жирный *курсив* текст** и `код`") == "<b>жирный <i>курсив</i> текст</b> и <code>код</code>"
+    assert render_markdown("~~old~~") == "<s>old</s>"
+
+
+def test_escaping():
+    assert render_markdown("1 < 2 & 3 > 0") == "1 &lt; 2 &amp; 3 &gt; 0"
+    assert render_markdown("`a<b>&c`") == "<code>a&lt;b&gt;&amp;c</code>"
+    assert render_markdown("<b>не тег</b>") == "&lt;b&gt;не тег&lt;/b&gt;"
+    assert render_markdown(f"[ссылка]({URL})") == '<a href="http://x.io/p?q=1&amp;r=2">ссылка</a>'
+
+
+def test_unclosed_and_intraword_markers_stay_text():
+    assert render_markdown("**не закрыт") == "**не закрыт"
+    assert render_markdown("snake_case_name") == "snake_case_name"
+
+
+def test_blocks():
+    html = render_markdown("## Заголовок\n- пункт\n1. первый\n> цитата **b**\n\n```py\nx<1\n```")
+    assert html == (
+        "<b>Заголовок</b>\n• пункт\n1) первый\n<blockquote>цитата <b>b</b></blockquote>\n\n"
+        '<pre><code class="language-py">x&lt;1</code></pre>'
+    )
+
+
+def test_unclosed_fence_runs_to_end():
+    assert render_markdown("```\nкод **не разметка**") == "<pre><code>код **не разметка**</code></pre>"
+
+
+# ====== Нарезка ======
+def test_short_text_is_one_message():
+    assert split_messages(render_blocks("Привет"), 4096) == ["Привет"]
+
+
+def test_blocks_are_packed_up_to_limit():
+    chunks = assert_valid("\n\n".join(["абзац " * 10] * 20), 200)
+    assert len(chunks) > 1
+    assert all(len(c) <= 200 for c in chunks)
+
+
+def test_bold_reopened_across_chunks():
+    source = "**" + "слово " * 30 + "конец**"
+    chunks = assert_valid(source, 60)
+    assert len(chunks) > 2
+    for chunk in chunks:
+        assert chunk.startswith("<b>") and chunk.endswith("</b>")
+
+
+def test_nested_tags_reopened_in_order():
+    source = "> **жирный *курсив " + "слово " * 40 + "хвост* конец**"
+    chunks = assert_valid(source, 80)
+    assert len(chunks) > 2
+    # в середине — все три уровня, открытые заново в исходном порядке
+    middle = chunks[len(chunks) // 2]
+    assert middle.startswith("<blockquote><b><i>")
+    assert middle.endswith("</i></b></blockquote>")
+    assert chunks[-1].endswith("</b></blockquote>")
+
+
+def test_code_block_with_language_reopened():
+    source = "```python\n" + "\n".join(f"x{i} = {i} < {i + 1}" for i in range(60)) + "\n```"
+    # язык повторяется в каждом куске, поэтому видимый текст сравниваем без него
+    chunks = assert_valid(source, 120, same_text=False)
+    assert len(chunks) > 2
+    body = "".join(unescape(c.replace('<pre><code class="language-python">', "").replace("</code></pre>", ""))
+                   for c in chunks)
+    assert _visible(body) == _visible(source.replace("```python", "").replace("```", ""))
+    for chunk in chunks:
+        assert chunk.startswith('<pre><code class="language-python">')
+        assert chunk.endswith("</code></pre>")
+
+
+def test_entities_are_not_split():
+    html = "&lt;" * 100
+    for piece in _split_block(html, 21):
+        assert len(piece) <= 21
+        assert unescape(piece) == "<" * (len(piece) // 4)
+
+
+def test_telegram_limit():
+    chunks = assert_valid("**" + "длинный текст " * 1000 + "конец**", 4096)
+    assert len(chunks) > 1
+    assert max(len(c) for c in chunks) <= 4096
+
+
+def test_limit_below_nesting_raises():
+    with pytest.raises(ValueError):
+        _split_block("<blockquote><b>" + "слово " * 10 + "</b></blockquote>", 20)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fuzz(seed):
+    rnd = random.Random(seed)
+    for _ in range(300):
+        source = "".join(rnd.choice(PIECES) for _ in range(rnd.randint(1, 120)))
+        assert_valid(source, rnd.choice([200, 300, 1000, 4096]))
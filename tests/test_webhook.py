@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import pytest
+
+from src.utils.http_server import Request
+from src.utils.webhook import SECRET_HEADER, WebhookReceiver
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def post(update_id: int, secret: str = "s3cret") -> Request:
+    headers = {SECRET_HEADER: secret} if secret else {}
+    return Request("POST", "/telegram", {}, headers, json.dumps({"update_id": update_id}).encode())
+
+
+def test_secret_is_required():
+    with pytest.raises(ValueError):
+        WebhookReceiver(lambda data: None, "")
+
+
+def test_wrong_or_missing_secret_rejected():
+    async def main():
+        delivered = []
+
+        async def deliver(data):
+            delivered.append(data)
+
+        receiver = WebhookReceiver(deliver, "s3cret")
+        assert (await receiver.handle(post(1, "wrong"))).status == 403
+        assert (await receiver.handle(post(1, ""))).status == 403
+        assert (await receiver.handle(post(1))).status == 200
+        assert delivered == [{"update_id": 1}]
+
+    run(main())
+
+
+def test_duplicates_dropped():
+    async def main():
+        delivered = []
+
+        async def deliver(data):
+            delivered.append(data["update_id"])
+
+        receiver = WebhookReceiver(deliver, "s3cret")
+        for update_id in (1, 2, 1, 2, 3):
+            assert (await receiver.handle(post(update_id))).status == 200
+        assert delivered == [1, 2, 3]
+        assert receiver.stats()["duplicates"] == 2
+
+    run(main())
+
+
+def test_failed_delivery_is_retried():
+    async def main():
+        delivered = []
+        failures = [RuntimeError("очередь недоступна")]
+
+        async def deliver(data):
+            if failures:
+                raise failures.pop()
+            delivered.append(data["update_id"])
+
+        receiver = WebhookReceiver(deliver, "s3cret")
+        with pytest.raises(RuntimeError):
+            await receiver.handle(post(5))  # сервер ответит 500
+        # повтор от Telegram не считается дублем
+        assert (await receiver.handle(post(5))).status == 200
+        assert delivered == [5]
+        assert receiver.stats() == {"received": 1, "duplicates": 0, "rejected": 0}
+
+    run(main())